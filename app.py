@@ -8,6 +8,8 @@ from aws_glue_cdk_observability_dashboard.s3_stack import S3Stack
 from aws_glue_cdk_observability_dashboard.metrics_sender_stack import MetricsSenderStack
 from aws_glue_cdk_observability_dashboard.catalog_stack import CatalogStack
 from aws_glue_cdk_observability_dashboard.quicksight_stack import QuickSightStack
+from aws_glue_cdk_observability_dashboard.compaction_stack import CompactionStack
+from aws_glue_cdk_observability_dashboard.rollup_stack import RollupStack
 
 
 app = cdk.App()
@@ -25,6 +27,8 @@ s3_stack = None
 metrics_sender_stack = None
 catalog_stack = None
 quicksight_stack = None
+compaction_stack = None
+rollup_stack = None
 
 if config["create_s3_stack"]:
     s3_stack = S3Stack(
@@ -54,13 +58,34 @@ if config["create_quicksight_stack"]:
         config=config
     )
 
-# S3Stack -> MetricsSenderStack/CatalogStack -> QuickSightStack
+if config.get("create_compaction_stack", False):
+    compaction_stack = CompactionStack(
+        app,
+        "CompactionStack",
+        config=config
+    )
+
+if config.get("create_rollup_stack", False):
+    rollup_stack = RollupStack(
+        app,
+        "RollupStack",
+        config=config
+    )
+
+# S3Stack -> MetricsSenderStack/CatalogStack -> RollupStack -> QuickSightStack
+# CatalogStack -> CompactionStack
 if s3_stack and metrics_sender_stack:
     metrics_sender_stack.add_dependency(s3_stack)
 if s3_stack and catalog_stack:
     catalog_stack.add_dependency(s3_stack)
 if catalog_stack and quicksight_stack:
     quicksight_stack.add_dependency(catalog_stack)
+if catalog_stack and rollup_stack:
+    rollup_stack.add_dependency(catalog_stack)
+if rollup_stack and quicksight_stack:
+    quicksight_stack.add_dependency(rollup_stack)
+if catalog_stack and compaction_stack:
+    compaction_stack.add_dependency(catalog_stack)
 
 
 app.synth()
@@ -1,13 +1,95 @@
+import json
 import os
 from typing import Dict
 
 from aws_cdk import (
+    Duration,
     Stack,
     aws_iam as iam,
     aws_glue as glue,
+    aws_lambda as awslambda,
+    aws_s3 as s3,
+    aws_s3_notifications as s3_notifications,
+    custom_resources as cr,
 )
 from constructs import Construct
 
+from aws_glue_cdk_observability_dashboard.partition_scheme import (
+    OTHER_METRIC_FAMILY,
+    metric_families,
+    partition_path_template,
+    partition_scheme,
+)
+
+METRIC_DATA_COLUMNS = [
+    {
+        "name": "metric_stream_name",
+        "type": "string"
+    },
+    {
+        "name": "namespace",
+        "type": "string"
+    },
+    {
+        "name": "metric_name",
+        "type": "string"
+    },
+    {
+        "name": "dimensions",
+        "type": "struct<JobName:string,JobRunId:string,Type:string,Source:string,Sink:string,ObservabilityGroup:string,ExecutionClass:string,GlueVersion:string,JobType:string>"
+    },
+    {
+        "name": "timestamp",
+        "type": "bigint"
+    },
+    {
+        "name": "value",
+        "type": "struct<max:double,min:double,sum:double,count:double>"
+    },
+    {
+        "name": "unit",
+        "type": "string"
+    }
+]
+
+STORAGE_FORMAT_JSON = "json"
+STORAGE_FORMAT_PARQUET = "parquet"
+STORAGE_FORMAT_ORC = "orc"
+
+STORAGE_FORMATS = {
+    STORAGE_FORMAT_JSON: {
+        "input_format": "org.apache.hadoop.mapred.TextInputFormat",
+        "output_format": "org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat",
+        "serialization_library": "org.openx.data.jsonserde.JsonSerDe",
+        "serde_parameters": {
+            "serialization.format": "json"
+        }
+    },
+    STORAGE_FORMAT_PARQUET: {
+        "input_format": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+        "output_format": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+        "serialization_library": "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe",
+        "serde_parameters": {
+            "serialization.format": "1"
+        }
+    },
+    STORAGE_FORMAT_ORC: {
+        "input_format": "org.apache.hadoop.hive.ql.io.orc.OrcInputFormat",
+        "output_format": "org.apache.hadoop.hive.ql.io.orc.OrcOutputFormat",
+        "serialization_library": "org.apache.hadoop.hive.ql.io.orc.OrcSerde",
+        "serde_parameters": {
+            "serialization.format": "1"
+        }
+    },
+}
+
+PARTITION_DISCOVERY_CRAWLER = "crawler"
+PARTITION_DISCOVERY_PROJECTION = "projection"
+PARTITION_DISCOVERY_EVENTS = "events"
+
+# Glue allows up to 3 partition indexes per table
+MAX_PARTITION_INDEXES = 3
+
 
 class CatalogStack(Stack):
 
@@ -17,6 +99,31 @@ class CatalogStack(Stack):
         account_id = os.getenv('CDK_DEFAULT_ACCOUNT')
         region = os.getenv('CDK_DEFAULT_REGION')
 
+        output_format = config.get("firehose_output_format", STORAGE_FORMAT_JSON)
+        if output_format not in STORAGE_FORMATS:
+            raise ValueError(f"Unsupported firehose_output_format: {output_format}")
+        storage_format = STORAGE_FORMATS[output_format]
+
+        partition_discovery = config.get("glue_partition_discovery", PARTITION_DISCOVERY_CRAWLER)
+        if partition_discovery not in (PARTITION_DISCOVERY_CRAWLER, PARTITION_DISCOVERY_PROJECTION,
+                                       PARTITION_DISCOVERY_EVENTS):
+            raise ValueError(f"Unsupported glue_partition_discovery: {partition_discovery}")
+
+        scheme = partition_scheme(config)
+
+        table_parameters = {
+            "classification": output_format
+        }
+        if partition_discovery == PARTITION_DISCOVERY_PROJECTION:
+            table_parameters.update(partition_projection_parameters(config, scheme))
+
+        partition_indexes = config.get("glue_partition_indexes") or []
+        if partition_indexes:
+            if partition_discovery == PARTITION_DISCOVERY_PROJECTION:
+                raise ValueError("glue_partition_indexes require catalog partitions, not partition projection")
+            # Lets Athena resolve predicates on indexed keys with the indexes
+            table_parameters["partition_filtering.enabled"] = "true"
+
         glue_database = glue.CfnDatabase(
             self,
             "GlueDatabase",
@@ -33,122 +140,213 @@ class CatalogStack(Stack):
             table_input=glue.CfnTable.TableInputProperty(
                 name=config["glue_table_name"],
                 table_type="EXTERNAL_TABLE",
-                parameters={
-                    "classification": "json"
-                },
+                parameters=table_parameters,
                 storage_descriptor=glue.CfnTable.StorageDescriptorProperty(
-                    columns=[
-                        {
-                            "name": "metric_stream_name",
-                            "type": "string"
-                        },
-                        {
-                            "name": "namespace",
-                            "type": "string"
-                        },
-                        {
-                            "name": "metric_name",
-                            "type": "string"
-                        },
-                        {
-                            "name": "dimensions",
-                            "type": "struct<JobName:string,JobRunId:string,Type:string,Source:string,Sink:string,ObservabilityGroup:string,ExecutionClass:string,GlueVersion:string,JobType:string>"
-                        },
-                        {
-                            "name": "timestamp",
-                            "type": "bigint"
-                        },
-                        {
-                            "name": "value",
-                            "type": "struct<max:double,min:double,sum:double,count:double>"
-                        },
-                        {
-                            "name": "unit",
-                            "type": "string"
-                        }
-                    ],
+                    columns=METRIC_DATA_COLUMNS,
                     location=f"s3://{config['s3_bucket_name']}/data/",
-                    input_format="org.apache.hadoop.mapred.TextInputFormat",
-                    output_format="org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat",
-                    compressed=False,
+                    input_format=storage_format["input_format"],
+                    output_format=storage_format["output_format"],
+                    compressed=output_format != STORAGE_FORMAT_JSON,
                     serde_info=glue.CfnTable.SerdeInfoProperty(
-                        serialization_library="org.openx.data.jsonserde.JsonSerDe",
-                        parameters={
-                            "serialization.format": "json"
-                        }
+                        serialization_library=storage_format["serialization_library"],
+                        parameters=storage_format["serde_parameters"]
                     ),
                 ),
                 partition_keys=[
                     {
-                        "name": "account_id",
-                        "type": "string"
-                    },
-                    {
-                        "name": "region",
-                        "type": "string"
-                    },
-                    {
-                        "name": "year",
-                        "type": "string"
-                    },
-                    {
-                        "name": "month",
-                        "type": "string"
-                    },
-                    {
-                        "name": "day",
-                        "type": "string"
-                    },
-                    {
-                        "name": "hour",
+                        "name": key,
                         "type": "string"
                     }
+                    for key in scheme
                 ]
             )
         )
         glue_table.add_dependency(glue_database)
 
-        crawler_role = iam.Role(
-            self,
-            'CrawlerRole',
-            assumed_by=iam.ServicePrincipal("glue.amazonaws.com")
-        )
-        crawler_role.add_to_policy(
-            iam.PolicyStatement(
-                actions=[
-                    's3:GetObject',
-                    's3:ListBucket',
-                ],
-                resources=[
-                    f"arn:aws:s3:::{config['s3_bucket_name']}",
-                    f"arn:aws:s3:::{config['s3_bucket_name']}/*",
-                ],
+        validate_partition_indexes(partition_indexes, [key.name for key in glue_table.table_input.partition_keys])
+        previous_index = glue_table
+        for partition_index in partition_indexes:
+            index = cr.AwsCustomResource(
+                self,
+                f"PartitionIndex-{partition_index['name']}",
+                on_create=cr.AwsSdkCall(
+                    service="Glue",
+                    action="createPartitionIndex",
+                    parameters={
+                        "CatalogId": account_id,
+                        "DatabaseName": glue_database.database_input.name,
+                        "TableName": glue_table.table_input.name,
+                        "PartitionIndex": {
+                            "IndexName": partition_index["name"],
+                            "Keys": partition_index["keys"]
+                        }
+                    },
+                    physical_resource_id=cr.PhysicalResourceId.of(partition_index["name"])
+                ),
+                on_delete=cr.AwsSdkCall(
+                    service="Glue",
+                    action="deletePartitionIndex",
+                    parameters={
+                        "CatalogId": account_id,
+                        "DatabaseName": glue_database.database_input.name,
+                        "TableName": glue_table.table_input.name,
+                        "IndexName": partition_index["name"]
+                    }
+                ),
+                policy=cr.AwsCustomResourcePolicy.from_statements([
+                    iam.PolicyStatement(
+                        actions=[
+                            'glue:CreatePartitionIndex',
+                            'glue:DeletePartitionIndex',
+                            'glue:GetTable',
+                            'glue:UpdateTable',
+                        ],
+                        resources=[
+                            f"arn:aws:glue:{self.region}:{self.account}:catalog",
+                            f"arn:aws:glue:{self.region}:{self.account}:database/{config['glue_database_name']}",
+                            f"arn:aws:glue:{self.region}:{self.account}:table/{config['glue_database_name']}/{config['glue_table_name']}",
+                        ],
+                    )
+                ]),
+                install_latest_aws_sdk=False
             )
-        )
-        crawler_role.add_managed_policy(
-            iam.ManagedPolicy.from_aws_managed_policy_name('service-role/AWSGlueServiceRole'))
+            # Glue rejects concurrent changes to the indexes of a table, so create them one after the other
+            index.node.add_dependency(previous_index)
+            previous_index = index
 
-        glue_crawler = glue.CfnCrawler(
-            self,
-            "GlueCrawler",
-            name=config["glue_crawler_name"],
-            role=crawler_role.role_arn,
-            targets={
-                "catalogTargets": [
-                    {
-                        "databaseName": glue_database.database_input.name,
-                        "tables": [glue_table.table_input.name]
-                    }
-                ]
-            },
-            configuration="{\"Version\":1.0,\"CrawlerOutput\":{\"Partitions\":{\"AddOrUpdateBehavior\":\"InheritFromTable\"}},\"Grouping\":{\"TableGroupingPolicy\":\"CombineCompatibleSchemas\"}}",
-            schema_change_policy=glue.CfnCrawler.SchemaChangePolicyProperty(
-                update_behavior="LOG",
-                delete_behavior="LOG"
-            ),
-            database_name=glue_database.database_input.name,
-            schedule=glue.CfnCrawler.ScheduleProperty(
-                schedule_expression=config["glue_crawler_cron_schedule"]
+        # With partition projection Athena computes partition locations from the table parameters
+        if partition_discovery == PARTITION_DISCOVERY_CRAWLER:
+            crawler_role = iam.Role(
+                self,
+                'CrawlerRole',
+                assumed_by=iam.ServicePrincipal("glue.amazonaws.com")
             )
-        )
-        glue_crawler.add_dependency(glue_table)
\ No newline at end of file
+            crawler_role.add_to_policy(
+                iam.PolicyStatement(
+                    actions=[
+                        's3:GetObject',
+                        's3:ListBucket',
+                    ],
+                    resources=[
+                        f"arn:aws:s3:::{config['s3_bucket_name']}",
+                        f"arn:aws:s3:::{config['s3_bucket_name']}/*",
+                    ],
+                )
+            )
+            crawler_role.add_managed_policy(
+                iam.ManagedPolicy.from_aws_managed_policy_name('service-role/AWSGlueServiceRole'))
+
+            glue_crawler = glue.CfnCrawler(
+                self,
+                "GlueCrawler",
+                name=config["glue_crawler_name"],
+                role=crawler_role.role_arn,
+                targets={
+                    "catalogTargets": [
+                        {
+                            "databaseName": glue_database.database_input.name,
+                            "tables": [glue_table.table_input.name]
+                        }
+                    ]
+                },
+                configuration="{\"Version\":1.0,\"CrawlerOutput\":{\"Partitions\":{\"AddOrUpdateBehavior\":\"InheritFromTable\"}},\"Grouping\":{\"TableGroupingPolicy\":\"CombineCompatibleSchemas\"}}",
+                schema_change_policy=glue.CfnCrawler.SchemaChangePolicyProperty(
+                    update_behavior="LOG",
+                    delete_behavior="LOG"
+                ),
+                database_name=glue_database.database_input.name,
+                schedule=glue.CfnCrawler.ScheduleProperty(
+                    schedule_expression=config["glue_crawler_cron_schedule"]
+                )
+            )
+            glue_crawler.add_dependency(glue_table)
+
+        if partition_discovery == PARTITION_DISCOVERY_EVENTS:
+            # New objects under data/ register their partition as soon as they are written
+            partition_registrar = awslambda.Function(
+                self,
+                'PartitionRegistrar',
+                runtime=awslambda.Runtime.PYTHON_3_11,
+                code=awslambda.Code.from_asset('aws_glue_cdk_observability_dashboard/partition_registrar/'),
+                handler='partition_registrar.lambda_handler',
+                timeout=Duration.seconds(60),
+                environment={
+                    "DATABASE_NAME": config["glue_database_name"],
+                    "TABLE_NAME": config["glue_table_name"],
+                    "PARTITION_SCHEME": json.dumps(scheme),
+                },
+            )
+            partition_registrar.add_to_role_policy(
+                iam.PolicyStatement(
+                    actions=[
+                        'glue:GetTable',
+                        'glue:BatchCreatePartition',
+                    ],
+                    resources=[
+                        f"arn:aws:glue:{self.region}:{self.account}:catalog",
+                        f"arn:aws:glue:{self.region}:{self.account}:database/{config['glue_database_name']}",
+                        f"arn:aws:glue:{self.region}:{self.account}:table/{config['glue_database_name']}/{config['glue_table_name']}",
+                    ],
+                )
+            )
+            metrics_bucket = s3.Bucket.from_bucket_name(
+                self,
+                'MetricsBucket',
+                bucket_name=config["s3_bucket_name"]
+            )
+            metrics_bucket.add_event_notification(
+                s3.EventType.OBJECT_CREATED,
+                s3_notifications.LambdaDestination(partition_registrar),
+                s3.NotificationKeyFilter(prefix="data/")
+            )
+
+
+def validate_partition_indexes(partition_indexes, partition_keys):
+    if len(partition_indexes) > MAX_PARTITION_INDEXES:
+        raise ValueError(f"glue_partition_indexes supports at most {MAX_PARTITION_INDEXES} indexes")
+    for partition_index in partition_indexes:
+        unknown_keys = [key for key in partition_index["keys"] if key not in partition_keys]
+        if unknown_keys:
+            raise ValueError(f"Partition index {partition_index['name']} uses unknown partition keys: {unknown_keys}")
+
+
+def partition_projection_parameters(config, scheme):
+    """Athena partition projection settings for the partition keys of the scheme."""
+    year_range = config.get("partition_projection_year_range", "2023,NOW")
+    parameters = {
+        "projection.enabled": "true",
+        "storage.location.template": f"s3://{config['s3_bucket_name']}/data/" + partition_path_template(scheme, "${{{key}}}"),
+    }
+    for key in scheme:
+        if key == "year":
+            # A date projection accepts NOW as the end of the range, an integer projection does not
+            parameters.update({"projection.year.type": "date", "projection.year.format": "yyyy",
+                               "projection.year.range": year_range, "projection.year.interval": "1",
+                               "projection.year.interval.unit": "YEARS"})
+        elif key in ("month", "day", "hour"):
+            value_range = {"month": "1,12", "day": "1,31", "hour": "0,23"}[key]
+            parameters.update({f"projection.{key}.type": "integer", f"projection.{key}.range": value_range,
+                               f"projection.{key}.digits": "2"})
+        elif key in ("dt", "dthour"):
+            # Date keys are projected from the first year of the range up to the current time
+            date_format, interval_unit = ("yyyy-MM-dd", "DAYS") if key == "dt" else ("yyyy-MM-dd-HH", "HOURS")
+            start = year_range.split(",")[0].strip() + ("-01-01" if key == "dt" else "-01-01-00")
+            parameters.update({f"projection.{key}.type": "date", f"projection.{key}.format": date_format,
+                               f"projection.{key}.range": f"{start},NOW", f"projection.{key}.interval": "1",
+                               f"projection.{key}.interval.unit": interval_unit})
+    if "metric_family" in scheme:
+        parameters["projection.metric_family.type"] = "enum"
+        parameters["projection.metric_family.values"] = ",".join(list(metric_families(config)) + [OTHER_METRIC_FAMILY])
+    # Injected keys would require an equality predicate in every query, which the data set and the
+    # rollup and compaction queries do not have, so the values must be listed
+    for key, config_key in [("account_id", "partition_projection_account_ids"),
+                            ("region", "partition_projection_regions"),
+                            ("jobname", "partition_projection_job_names")]:
+        if key not in scheme:
+            continue
+        values = config.get(config_key) or []
+        if not values:
+            raise ValueError(f"glue_partition_discovery projection requires {config_key}")
+        parameters[f"projection.{key}.type"] = "enum"
+        parameters[f"projection.{key}.values"] = ",".join(str(value) for value in values)
+    return parameters
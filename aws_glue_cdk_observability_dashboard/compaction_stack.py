@@ -0,0 +1,165 @@
+import os
+from typing import Dict
+
+from aws_cdk import (
+    Stack,
+    aws_iam as iam,
+    aws_glue as glue,
+    aws_s3_assets as s3_assets,
+)
+from constructs import Construct
+
+from aws_glue_cdk_observability_dashboard.catalog_stack import (
+    METRIC_DATA_COLUMNS,
+    STORAGE_FORMATS,
+    STORAGE_FORMAT_JSON,
+    STORAGE_FORMAT_PARQUET,
+)
+from aws_glue_cdk_observability_dashboard.partition_scheme import (
+    DEFAULT_PARTITION_SCHEME,
+    partition_scheme,
+)
+
+CURATED_PARTITION_KEYS = ["account_id", "region", "year", "month", "day"]
+
+
+class CompactionStack(Stack):
+
+    def __init__(self, scope: Construct, construct_id: str, config: Dict, **kwargs) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        account_id = os.getenv('CDK_DEFAULT_ACCOUNT')
+
+        source_format = config.get("firehose_output_format", STORAGE_FORMAT_JSON)
+        if source_format not in (STORAGE_FORMAT_JSON, STORAGE_FORMAT_PARQUET):
+            raise ValueError(f"Compaction does not support firehose_output_format: {source_format}")
+        if partition_scheme(config) != DEFAULT_PARTITION_SCHEME:
+            # The job walks the account_id/region/year/month/day/hour directories of the data/ prefix
+            raise ValueError("Compaction requires the default partition_scheme")
+        curated_prefix = config.get("compaction_curated_prefix", "curated/").strip("/")
+        storage_format = STORAGE_FORMATS[STORAGE_FORMAT_PARQUET]
+
+        curated_table = glue.CfnTable(
+            self,
+            "CuratedGlueTable",
+            catalog_id=account_id,
+            database_name=config["glue_database_name"],
+            table_input=glue.CfnTable.TableInputProperty(
+                name=config.get("glue_curated_table_name", "metric_data_curated"),
+                table_type="EXTERNAL_TABLE",
+                parameters={
+                    "classification": STORAGE_FORMAT_PARQUET
+                },
+                storage_descriptor=glue.CfnTable.StorageDescriptorProperty(
+                    columns=METRIC_DATA_COLUMNS,
+                    location=f"s3://{config['s3_bucket_name']}/{curated_prefix}/",
+                    input_format=storage_format["input_format"],
+                    output_format=storage_format["output_format"],
+                    compressed=True,
+                    serde_info=glue.CfnTable.SerdeInfoProperty(
+                        serialization_library=storage_format["serialization_library"],
+                        parameters=storage_format["serde_parameters"]
+                    ),
+                ),
+                partition_keys=[
+                    {
+                        "name": key,
+                        "type": "string"
+                    }
+                    for key in CURATED_PARTITION_KEYS
+                ]
+            )
+        )
+
+        compaction_script = s3_assets.Asset(
+            self,
+            'CompactionScript',
+            path='aws_glue_cdk_observability_dashboard/glue_jobs/compaction_job.py'
+        )
+
+        compaction_role = iam.Role(
+            self,
+            'CompactionRole',
+            assumed_by=iam.ServicePrincipal("glue.amazonaws.com")
+        )
+        compaction_role.add_managed_policy(
+            iam.ManagedPolicy.from_aws_managed_policy_name('service-role/AWSGlueServiceRole'))
+        compaction_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=[
+                    's3:GetObject',
+                    's3:ListBucket',
+                ],
+                resources=[
+                    f"arn:aws:s3:::{config['s3_bucket_name']}",
+                    f"arn:aws:s3:::{config['s3_bucket_name']}/data/*",
+                ],
+            )
+        )
+        compaction_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=[
+                    's3:GetObject',
+                    's3:PutObject',
+                    's3:DeleteObject',
+                ],
+                resources=[
+                    f"arn:aws:s3:::{config['s3_bucket_name']}/{curated_prefix}/*",
+                ],
+            )
+        )
+        compaction_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=[
+                    'glue:GetTable',
+                    'glue:BatchCreatePartition',
+                ],
+                resources=[
+                    f"arn:aws:glue:{self.region}:{self.account}:catalog",
+                    f"arn:aws:glue:{self.region}:{self.account}:database/{config['glue_database_name']}",
+                    f"arn:aws:glue:{self.region}:{self.account}:table/{config['glue_database_name']}/{curated_table.table_input.name}",
+                ],
+            )
+        )
+        compaction_script.grant_read(compaction_role)
+
+        # Python shell job with the analytics library set, which includes pyarrow
+        compaction_job = glue.CfnJob(
+            self,
+            "CompactionJob",
+            name=config.get("compaction_job_name", "observability_demo_compaction"),
+            role=compaction_role.role_arn,
+            command=glue.CfnJob.JobCommandProperty(
+                name="pythonshell",
+                python_version="3.9",
+                script_location=compaction_script.s3_object_url
+            ),
+            glue_version="3.0",
+            max_capacity=1,
+            default_arguments={
+                "library-set": "analytics",
+                "--bucket_name": config["s3_bucket_name"],
+                "--source_prefix": "data",
+                "--curated_prefix": curated_prefix,
+                "--source_format": source_format,
+                "--closed_after_hours": str(config.get("compaction_closed_after_hours", 2)),
+                "--lookback_days": str(config.get("compaction_lookback_days", 3)),
+                "--max_rows_per_file": str(config.get("compaction_max_rows_per_file", 5000000)),
+                "--database_name": config["glue_database_name"],
+                "--table_name": curated_table.table_input.name,
+            }
+        )
+        compaction_job.add_dependency(curated_table)
+
+        glue.CfnTrigger(
+            self,
+            "CompactionTrigger",
+            type="SCHEDULED",
+            schedule=config.get("compaction_cron_schedule", "cron(30 2 * * ? *)"),
+            start_on_creation=True,
+            actions=[
+                glue.CfnTrigger.ActionProperty(
+                    job_name=compaction_job.name
+                )
+            ]
+        ).add_dependency(compaction_job)
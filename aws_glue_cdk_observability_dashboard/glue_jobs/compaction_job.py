@@ -0,0 +1,197 @@
+import sys
+import time
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pj
+import pyarrow.parquet as pq
+from pyarrow import fs
+
+SOURCE_FORMAT_JSON = "json"
+SOURCE_FORMAT_PARQUET = "parquet"
+
+# Same dimensions as the metric_data table of CatalogStack
+DIMENSION_NAMES = ["JobName", "JobRunId", "Type", "Source", "Sink", "ObservabilityGroup", "ExecutionClass",
+                   "GlueVersion", "JobType"]
+
+CURATED_SCHEMA = pa.schema([
+    ("metric_stream_name", pa.string()),
+    ("namespace", pa.string()),
+    ("metric_name", pa.string()),
+    ("dimensions", pa.struct([(name, pa.string()) for name in DIMENSION_NAMES])),
+    ("timestamp", pa.int64()),
+    ("value", pa.struct([("max", pa.float64()), ("min", pa.float64()), ("sum", pa.float64()), ("count", pa.float64())])),
+    ("unit", pa.string()),
+])
+
+# Missing fields are null, and the account_id and region fields of inline partitioning records are ignored
+JSON_PARSE_OPTIONS = pj.ParseOptions(explicit_schema=CURATED_SCHEMA, unexpected_field_behavior="ignore")
+
+# Rows of the same metric and job run end up next to each other, which keeps row group statistics selective
+SORT_KEYS = ["metric_name", "dimensions.JobName", "dimensions.JobRunId", "timestamp"]
+
+# Written after the Parquet files of a partition, Athena ignores files starting with an underscore
+SUCCESS_MARKER = "_SUCCESS"
+
+DAY_SECONDS = 24 * 3600
+
+
+def list_directories(filesystem, path, prefix):
+    """Values of the key=value directories directly under path."""
+    selector = fs.FileSelector(path, allow_not_found=True)
+    return sorted(
+        info.base_name[len(prefix):]
+        for info in filesystem.get_file_info(selector)
+        if info.type == fs.FileType.Directory and info.base_name.startswith(prefix)
+    )
+
+
+def closed_days(now, closed_after_hours, lookback_days):
+    """(year, month, day) of the UTC days that ended at least closed_after_hours ago, newest first."""
+    last_closed_day_start = (int(now) - closed_after_hours * 3600) // DAY_SECONDS * DAY_SECONDS - DAY_SECONDS
+    return [
+        time.strftime("%Y %m %d", time.gmtime(last_closed_day_start - offset * DAY_SECONDS)).split()
+        for offset in range(lookback_days)
+    ]
+
+
+def day_partition_path(root, account_id, region, year, month, day):
+    return f"{root}/account_id={account_id}/region={region}/year={year}/month={month}/day={day}"
+
+
+def closed_partitions(filesystem, source_root, now, closed_after_hours=2, lookback_days=3):
+    """Yield the (account_id, region, year, month, day) partitions with data of the closed days."""
+    days = closed_days(now, closed_after_hours, lookback_days)
+    for account_id in list_directories(filesystem, source_root, "account_id="):
+        for region in list_directories(filesystem, f"{source_root}/account_id={account_id}", "region="):
+            for year, month, day in days:
+                partition = (account_id, region, year, month, day)
+                if source_files(filesystem, day_partition_path(source_root, *partition)):
+                    yield partition
+
+
+def is_compacted(filesystem, curated_root, partition):
+    marker = f"{day_partition_path(curated_root, *partition)}/{SUCCESS_MARKER}"
+    return filesystem.get_file_info(marker).type == fs.FileType.File
+
+
+def source_files(filesystem, path):
+    selector = fs.FileSelector(path, recursive=True, allow_not_found=True)
+    return sorted(
+        info.path
+        for info in filesystem.get_file_info(selector)
+        if info.type == fs.FileType.File and not info.base_name.startswith(".")
+    )
+
+
+def read_table(filesystem, path, source_format):
+    """Read a source file into a table of CURATED_SCHEMA."""
+    if source_format == SOURCE_FORMAT_PARQUET:
+        table = pq.read_table(path, filesystem=filesystem)
+        return pa.table([table.column(field.name).cast(field.type) if field.name in table.column_names
+                         else pa.nulls(table.num_rows, field.type) for field in CURATED_SCHEMA], schema=CURATED_SCHEMA)
+    with filesystem.open_input_stream(path) as stream:
+        data = stream.read()
+    if not data.strip():
+        return CURATED_SCHEMA.empty_table()
+    return pj.read_json(pa.BufferReader(data), parse_options=JSON_PARSE_OPTIONS)
+
+
+def sort_table(table):
+    """Sort the rows of a table by SORT_KEYS, dimensions are copied to top-level columns for the sort."""
+    for key in SORT_KEYS:
+        if "." in key:
+            parent, name = key.split(".")
+            table = table.append_column(key, pc.struct_field(table.column(parent), name))
+    return table.sort_by([(key, "ascending") for key in SORT_KEYS]).select(CURATED_SCHEMA.names)
+
+
+def compact_partition(filesystem, source_root, curated_root, partition, source_format=SOURCE_FORMAT_JSON,
+                      max_rows_per_file=5000000, row_group_size=500000):
+    """Merge the hourly files of a day partition into sorted Parquet files, returns the written paths."""
+    tables = [read_table(filesystem, path, source_format)
+              for path in source_files(filesystem, day_partition_path(source_root, *partition))]
+    table = sort_table(pa.concat_tables(tables)) if tables else CURATED_SCHEMA.empty_table()
+
+    output_path = day_partition_path(curated_root, *partition)
+    # Remove the files of an interrupted run, which did not write the marker
+    filesystem.create_dir(output_path, recursive=True)
+    filesystem.delete_dir_contents(output_path)
+    written = []
+    for file_index, start in enumerate(range(0, table.num_rows, max_rows_per_file)):
+        path = f"{output_path}/part-{file_index:05d}.parquet"
+        pq.write_table(table.slice(start, max_rows_per_file), path, filesystem=filesystem,
+                       row_group_size=row_group_size, compression="snappy")
+        written.append(path)
+    with filesystem.open_output_stream(f"{output_path}/{SUCCESS_MARKER}") as stream:
+        stream.write(b"")
+    return written
+
+
+def compact(filesystem, source_root, curated_root, now, closed_after_hours=2, lookback_days=3,
+            source_format=SOURCE_FORMAT_JSON, max_rows_per_file=5000000, row_group_size=500000):
+    """Compact the closed partitions that are not compacted yet, returns all the compacted closed partitions."""
+    compacted = []
+    for partition in closed_partitions(filesystem, source_root, now, closed_after_hours, lookback_days):
+        if not is_compacted(filesystem, curated_root, partition):
+            written = compact_partition(filesystem, source_root, curated_root, partition, source_format,
+                                        max_rows_per_file, row_group_size)
+            print(f"Compacted partition {partition} into {len(written)} files")
+        compacted.append(partition)
+    return compacted
+
+
+def register_partitions(glue_client, database_name, table_name, curated_location, partitions):
+    """Add the compacted partitions to the curated table, partitions that already exist are skipped."""
+    storage_descriptor = glue_client.get_table(DatabaseName=database_name, Name=table_name)["Table"]["StorageDescriptor"]
+    partitions = list(partitions)
+    # BatchCreatePartition accepts up to 100 partitions per call
+    for start in range(0, len(partitions), 100):
+        response = glue_client.batch_create_partition(
+            DatabaseName=database_name,
+            TableName=table_name,
+            PartitionInputList=[
+                {
+                    "Values": list(partition),
+                    "StorageDescriptor": {
+                        **storage_descriptor,
+                        "Location": day_partition_path(curated_location, *partition) + "/"
+                    }
+                }
+                for partition in partitions[start:start + 100]
+            ]
+        )
+        for error in response.get("Errors", []):
+            if error["ErrorDetail"]["ErrorCode"] != "AlreadyExistsException":
+                raise RuntimeError(f"Failed to register partition {error['PartitionValues']}: {error['ErrorDetail']}")
+
+
+def main():
+    import boto3
+    from awsglue.utils import getResolvedOptions
+
+    args = getResolvedOptions(sys.argv, [
+        "bucket_name", "source_prefix", "curated_prefix", "source_format", "closed_after_hours", "lookback_days",
+        "max_rows_per_file", "database_name", "table_name"
+    ])
+    filesystem = fs.S3FileSystem()
+    source_root = f"{args['bucket_name']}/{args['source_prefix'].strip('/')}"
+    curated_root = f"{args['bucket_name']}/{args['curated_prefix'].strip('/')}"
+    compacted = compact(
+        filesystem,
+        source_root,
+        curated_root,
+        now=time.time(),
+        closed_after_hours=int(args["closed_after_hours"]),
+        lookback_days=int(args["lookback_days"]),
+        source_format=args["source_format"],
+        max_rows_per_file=int(args["max_rows_per_file"]),
+    )
+    # Partitions compacted by a previous run are registered again in case that run failed before registering them
+    if compacted:
+        register_partitions(boto3.client("glue"), args["database_name"], args["table_name"],
+                            f"s3://{curated_root}", compacted)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import json
+import sys
+import time
+
+HOUR_SECONDS = 3600
+DAY_SECONDS = 24 * HOUR_SECONDS
+
+# Columns of the rollup tables before their partition columns, in table order
+ROLLUP_GROUP_COLUMNS = ["account_id", "region", "namespace", "metric_name", "jobname", "jobrunid", "type", "source",
+                        "sink", "observabilitygroup"]
+ROLLUP_AGGREGATES = "max(max) AS max, min(min) AS min, sum(sum) AS sum, sum(count) AS count"
+
+# Aggregates of the wide table columns over the datapoints of one metric in a minute
+WIDE_STATISTICS = {
+    "max": "max(value.max) FILTER ({condition})",
+    "min": "min(value.min) FILTER ({condition})",
+    "avg": "sum(value.sum) FILTER ({condition}) / sum(value.count) FILTER ({condition})",
+    "sum": "sum(value.sum) FILTER ({condition})",
+    "count": "sum(value.count) FILTER ({condition})",
+}
+
+QUERY_STATES_DONE = ("SUCCEEDED", "FAILED", "CANCELLED")
+
+
+def closed_hours(now, closed_after_minutes, lookback_hours):
+    """(year, month, day, hour) of the UTC hours that ended at least closed_after_minutes ago, oldest first."""
+    last_closed_hour_start = (int(now) - closed_after_minutes * 60) // HOUR_SECONDS * HOUR_SECONDS - HOUR_SECONDS
+    return [
+        tuple(time.strftime("%Y %m %d %H", time.gmtime(last_closed_hour_start - offset * HOUR_SECONDS)).split())
+        for offset in reversed(range(lookback_hours))
+    ]
+
+
+def closed_days(now, closed_after_minutes, lookback_days):
+    """(year, month, day) of the UTC days whose last hour is closed, oldest first."""
+    last_closed_day_start = (int(now) - closed_after_minutes * 60) // DAY_SECONDS * DAY_SECONDS - DAY_SECONDS
+    return [
+        tuple(time.strftime("%Y %m %d", time.gmtime(last_closed_day_start - offset * DAY_SECONDS)).split())
+        for offset in reversed(range(lookback_days))
+    ]
+
+
+def hourly_rollup_query(database_name, source_table_name, hourly_table_name, year, month, day, hour):
+    """Aggregate the per-minute rows of one hour partition of the metric_data table."""
+    return (
+        f"INSERT INTO \"{database_name}\".\"{hourly_table_name}\" "
+        f"SELECT account_id, region, namespace, metric_name, dimensions.jobname, dimensions.jobrunid, dimensions.type, "
+        f"dimensions.source, dimensions.sink, dimensions.observabilitygroup, "
+        f"timestamp - timestamp % 3600000 AS timestamp, "
+        f"max(value.max) AS max, min(value.min) AS min, sum(value.sum) AS sum, sum(value.count) AS count, unit, "
+        f"year, month, day, hour "
+        f"FROM \"{database_name}\".\"{source_table_name}\" "
+        f"WHERE year = '{year}' AND month = '{month}' AND day = '{day}' AND hour = '{hour}' "
+        f"GROUP BY account_id, region, namespace, metric_name, dimensions.jobname, dimensions.jobrunid, dimensions.type, "
+        f"dimensions.source, dimensions.sink, dimensions.observabilitygroup, timestamp - timestamp % 3600000, unit, "
+        f"year, month, day, hour"
+    )
+
+
+def daily_rollup_query(database_name, hourly_table_name, daily_table_name, year, month, day):
+    """Aggregate the rows of one day of the hourly table."""
+    columns = ", ".join(ROLLUP_GROUP_COLUMNS)
+    return (
+        f"INSERT INTO \"{database_name}\".\"{daily_table_name}\" "
+        f"SELECT {columns}, timestamp - timestamp % 86400000 AS timestamp, {ROLLUP_AGGREGATES}, unit, "
+        f"'00' AS hour, year, month, day "
+        f"FROM \"{database_name}\".\"{hourly_table_name}\" "
+        f"WHERE year = '{year}' AND month = '{month}' AND day = '{day}' "
+        f"GROUP BY {columns}, timestamp - timestamp % 86400000, unit, year, month, day"
+    )
+
+
+def wide_rollup_query(database_name, source_table_name, wide_table_name, wide_columns, year, month, day, hour):
+    """Pivot one hour partition of the metric_data table into one row per job run and minute.
+
+    wide_columns is a list of {"name", "metric_name", "statistic"}, in the column order of the wide table.
+    """
+    pivoted_columns = ", ".join(
+        WIDE_STATISTICS[column["statistic"]].format(condition=f"WHERE metric_name = '{column['metric_name']}'")
+        + f" AS {column['name']}"
+        for column in wide_columns
+    )
+    metric_names = ", ".join(sorted({f"'{column['metric_name']}'" for column in wide_columns}))
+    return (
+        f"INSERT INTO \"{database_name}\".\"{wide_table_name}\" "
+        f"SELECT account_id, region, dimensions.jobname, dimensions.jobrunid, "
+        f"timestamp - timestamp % 60000 AS timestamp, {pivoted_columns}, "
+        f"year, month, day, hour "
+        f"FROM \"{database_name}\".\"{source_table_name}\" "
+        f"WHERE year = '{year}' AND month = '{month}' AND day = '{day}' AND hour = '{hour}' "
+        f"AND metric_name IN ({metric_names}) "
+        f"GROUP BY account_id, region, dimensions.jobname, dimensions.jobrunid, timestamp - timestamp % 60000, "
+        f"year, month, day, hour"
+    )
+
+
+def run_query(athena_client, query, workgroup, output_location, sleep=time.sleep):
+    query_execution_id = athena_client.start_query_execution(
+        QueryString=query,
+        WorkGroup=workgroup,
+        ResultConfiguration={"OutputLocation": output_location}
+    )["QueryExecutionId"]
+    while True:
+        status = athena_client.get_query_execution(QueryExecutionId=query_execution_id)["QueryExecution"]["Status"]
+        if status["State"] in QUERY_STATES_DONE:
+            break
+        sleep(2)
+    if status["State"] != "SUCCEEDED":
+        raise RuntimeError(f"Query {query_execution_id} {status['State']}: {status.get('StateChangeReason')}")
+
+
+def table_partitions(glue_client, database_name, table_name):
+    """{partition values: location} of a table."""
+    partitions = {}
+    for page in glue_client.get_paginator("get_partitions").paginate(DatabaseName=database_name, TableName=table_name):
+        for partition in page["Partitions"]:
+            partitions[tuple(partition["Values"])] = partition["StorageDescriptor"]["Location"]
+    return partitions
+
+
+def expired_partitions(partitions, now, retention_days):
+    """Partitions whose day (the first three values) is older than the retention."""
+    cutoff = time.strftime("%Y%m%d", time.gmtime(int(now) - retention_days * DAY_SECONDS))
+    return [values for values in partitions if "".join(values[:3]) < cutoff]
+
+
+def delete_partitions(glue_client, s3_client, database_name, table_name, partitions):
+    """Remove the partitions from the table and delete their objects, partitions is {values: location}."""
+    values = list(partitions)
+    # BatchDeletePartition accepts up to 25 partitions per call
+    for start in range(0, len(values), 25):
+        glue_client.batch_delete_partition(
+            DatabaseName=database_name,
+            TableName=table_name,
+            PartitionsToDelete=[{"Values": list(partition)} for partition in values[start:start + 25]]
+        )
+    for location in partitions.values():
+        bucket, _, prefix = location[len("s3://"):].partition("/")
+        for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+            objects = [{"Key": s3_object["Key"]} for s3_object in page.get("Contents", [])]
+            if objects:
+                s3_client.delete_objects(Bucket=bucket, Delete={"Objects": objects, "Quiet": True})
+
+
+def rollup(athena_client, glue_client, s3_client, now, database_name, source_table_name, hourly_table_name,
+           daily_table_name, workgroup, output_location, closed_after_minutes=90, lookback_hours=6,
+           hourly_retention_days=35, daily_retention_days=400, wide_table_name=None, wide_columns=(),
+           wide_retention_days=35, sleep=time.sleep):
+    """Roll up the closed hours and days that are missing from the rollup tables, then apply the retentions.
+
+    The closed hours are also pivoted into the wide table when wide_table_name is set.
+    """
+    hourly_partitions = table_partitions(glue_client, database_name, hourly_table_name)
+    for partition in closed_hours(now, closed_after_minutes, lookback_hours):
+        if partition not in hourly_partitions:
+            # An hour without data stays missing and is queried again until it leaves the look-back window
+            run_query(athena_client, hourly_rollup_query(database_name, source_table_name, hourly_table_name, *partition),
+                      workgroup, output_location, sleep)
+    hourly_partitions = table_partitions(glue_client, database_name, hourly_table_name)
+
+    daily_partitions = table_partitions(glue_client, database_name, daily_table_name)
+    lookback_days = (lookback_hours + 23) // 24 + 1
+    for partition in closed_days(now, closed_after_minutes, lookback_days):
+        if partition not in daily_partitions and any(values[:3] == partition for values in hourly_partitions):
+            run_query(athena_client, daily_rollup_query(database_name, hourly_table_name, daily_table_name, *partition),
+                      workgroup, output_location, sleep)
+    daily_partitions = table_partitions(glue_client, database_name, daily_table_name)
+
+    retentions = [(hourly_table_name, hourly_partitions, hourly_retention_days),
+                  (daily_table_name, daily_partitions, daily_retention_days)]
+    if wide_table_name:
+        wide_partitions = table_partitions(glue_client, database_name, wide_table_name)
+        for partition in closed_hours(now, closed_after_minutes, lookback_hours):
+            if partition not in wide_partitions:
+                run_query(athena_client,
+                          wide_rollup_query(database_name, source_table_name, wide_table_name, wide_columns, *partition),
+                          workgroup, output_location, sleep)
+        retentions.append((wide_table_name, table_partitions(glue_client, database_name, wide_table_name),
+                           wide_retention_days))
+
+    for table_name, partitions, retention_days in retentions:
+        expired = expired_partitions(partitions, now, retention_days)
+        if expired:
+            delete_partitions(glue_client, s3_client, database_name, table_name,
+                              {values: partitions[values] for values in expired})
+            print(f"Deleted {len(expired)} partitions of {table_name} older than {retention_days} days")
+
+
+def main():
+    import boto3
+    from awsglue.utils import getResolvedOptions
+
+    options = [
+        "database_name", "source_table_name", "hourly_table_name", "daily_table_name", "workgroup",
+        "output_location", "closed_after_minutes", "lookback_hours", "hourly_retention_days", "daily_retention_days"
+    ]
+    # The wide table arguments are only set when the stack creates the wide table
+    wide_enabled = "--wide_table_name" in sys.argv
+    if wide_enabled:
+        options += ["wide_table_name", "wide_columns", "wide_retention_days"]
+    args = getResolvedOptions(sys.argv, options)
+    rollup(
+        boto3.client("athena"),
+        boto3.client("glue"),
+        boto3.client("s3"),
+        now=time.time(),
+        database_name=args["database_name"],
+        source_table_name=args["source_table_name"],
+        hourly_table_name=args["hourly_table_name"],
+        daily_table_name=args["daily_table_name"],
+        workgroup=args["workgroup"],
+        output_location=args["output_location"],
+        closed_after_minutes=int(args["closed_after_minutes"]),
+        lookback_hours=int(args["lookback_hours"]),
+        hourly_retention_days=int(args["hourly_retention_days"]),
+        daily_retention_days=int(args["daily_retention_days"]),
+        wide_table_name=args["wide_table_name"] if wide_enabled else None,
+        wide_columns=json.loads(args["wide_columns"]) if wide_enabled else (),
+        wide_retention_days=int(args["wide_retention_days"]) if wide_enabled else 35,
+    )
+
+
+if __name__ == "__main__":
+    main()
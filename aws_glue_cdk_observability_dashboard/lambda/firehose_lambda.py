@@ -1,56 +1,714 @@
 from __future__ import print_function
 import base64
+import cProfile
+import io
 import json
-import datetime
+import os
+import pstats
+import random
+import re
+import time
+import tracemalloc
+
+import otlp_decoder
+
+LOG_LEVEL_OFF = "OFF"
+LOG_LEVEL_SUMMARY = "SUMMARY"
+LOG_LEVEL_DEBUG = "DEBUG"
+
+# OFF: no logs, SUMMARY: one line per invocation, DEBUG: summary plus a sample of the transformed lines
+LOG_LEVEL = os.environ.get("LOG_LEVEL", LOG_LEVEL_SUMMARY).upper()
+DEBUG_SAMPLE_RATE = float(os.environ.get("DEBUG_SAMPLE_RATE", "0.001"))
+
+# CloudWatch namespace of the Embedded Metric Format record logged per invocation, empty to disable it
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "")
+
+PROFILE_OUTPUT_LOG = "log"
+PROFILE_OUTPUT_TMP = "tmp"
+
+# Profile one in N invocations of each execution environment with cProfile, 0 disables profiling
+PROFILE_EVERY_N_INVOCATIONS = int(os.environ.get("PROFILE_EVERY_N_INVOCATIONS", "0"))
+# Also track the peak memory allocated during the profiled invocations
+PROFILE_TRACEMALLOC = os.environ.get("PROFILE_TRACEMALLOC", "false").lower() == "true"
+PROFILE_TOP_FUNCTIONS = int(os.environ.get("PROFILE_TOP_FUNCTIONS", "20"))
+# log: print the top functions, tmp: dump the full profile to PROFILE_DIRECTORY and print its path
+PROFILE_OUTPUT = os.environ.get("PROFILE_OUTPUT", PROFILE_OUTPUT_LOG).lower()
+PROFILE_DIRECTORY = "/tmp"
+
+invocation_count = 0
+
+ENCODING_MODE_JSON = "json"
+ENCODING_MODE_PASSTHROUGH = "passthrough"
+
+# json: parse and re-serialize every line, passthrough: cut account_id/region out of the raw line
+ENCODING_MODE = os.environ.get("ENCODING_MODE", ENCODING_MODE_PASSTHROUGH).lower()
+
+INPUT_FORMAT_JSON = "json"
+INPUT_FORMAT_OPENTELEMETRY = "opentelemetry1.0"
+
+# Output format of the metric stream, OpenTelemetry records are decoded into the same lines as the json format
+INPUT_FORMAT = os.environ.get("INPUT_FORMAT", INPUT_FORMAT_JSON).lower()
+
+JSON_CODEC_AUTO = "auto"
+JSON_CODEC_ORJSON = "orjson"
+JSON_CODEC_STDLIB = "stdlib"
+
+# auto: use orjson when it is bundled with the function, stdlib json otherwise
+JSON_CODEC = os.environ.get("JSON_CODEC", JSON_CODEC_AUTO).lower()
+
+
+def load_json_codec(name):
+    """Return the (name, loads, dumps) of the JSON codec; dumps always returns bytes."""
+    if name in (JSON_CODEC_AUTO, JSON_CODEC_ORJSON):
+        try:
+            import orjson
+            return JSON_CODEC_ORJSON, orjson.loads, orjson.dumps
+        except ImportError:
+            if name == JSON_CODEC_ORJSON:
+                print("orjson is not bundled with the function, falling back to the json module")
+    # Compact separators, like orjson, so that rewritten lines are not larger than the metric stream ones
+    return JSON_CODEC_STDLIB, json.loads, lambda value: json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+JSON_CODEC_NAME, json_loads, json_dumps = load_json_codec(JSON_CODEC)
+
+# A key can only be preceded by '{' or ',' outside of a string, because quotes inside strings are escaped
+ACCOUNT_ID_PATTERN = re.compile(rb'(?<=[{,])\s*"account_id"\s*:\s*"([^"\\]*)"\s*')
+REGION_PATTERN = re.compile(rb'(?<=[{,])\s*"region"\s*:\s*"([^"\\]*)"\s*')
+# Only plain integers, other numbers such as 1.7e12 fall back to the json transform
+TIMESTAMP_PATTERN = re.compile(rb'(?<=[{,])\s*"timestamp"\s*:\s*(\d+)\s*(?=[,}])')
+
+
+def transform_line_json(line):
+    json_value = json_loads(line)
+    if not isinstance(json_value, dict):
+        raise ValueError(f"Metric line is not a JSON object: {line[:100]!r}")
+    account_id = json_value.pop('account_id')
+    region = json_value.pop('region')
+    return json_dumps(json_value), account_id, region, json_value['timestamp']
+
+
+def transform_line_passthrough(line):
+    account_id_match = ACCOUNT_ID_PATTERN.search(line)
+    region_match = REGION_PATTERN.search(line)
+    timestamp_match = TIMESTAMP_PATTERN.search(line)
+    if not (account_id_match and region_match and timestamp_match):
+        return transform_line_json(line)
+
+    # Remove the later field first so that the offsets of the earlier one stay valid
+    output_line = line
+    for match in sorted((account_id_match, region_match), key=lambda m: m.start(), reverse=True):
+        output_line = remove_field(output_line, match.start(), match.end())
+    return (output_line,
+            account_id_match.group(1).decode('utf-8'),
+            region_match.group(1).decode('utf-8'),
+            int(timestamp_match.group(1)))
+
+
+def remove_field(line, start, end):
+    # Drop the separating comma on one side of the field so the object stays valid JSON
+    if line[end:end + 1] == b",":
+        end += 1
+    elif line[start - 1:start] == b",":
+        start -= 1
+    return line[:start] + line[end:]
+
+
+TRANSFORM_LINE = {
+    ENCODING_MODE_JSON: transform_line_json,
+    ENCODING_MODE_PASSTHROUGH: transform_line_passthrough,
+}[ENCODING_MODE]
+
+METRIC_NAME_PATTERN = re.compile(rb'(?<=[{,])\s*"metric_name"\s*:\s*"([^"\\]*)"')
+
+
+def parse_metric_names(value):
+    """Parse a comma separated list of metric names into exact names and prefixes (names ending with '*')."""
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    return (frozenset(name for name in names if not name.endswith("*")),
+            tuple(name[:-1] for name in names if name.endswith("*")))
+
+
+# Only metrics matching the include list (when set) and not matching the exclude list are delivered
+METRIC_NAME_INCLUDE = parse_metric_names(os.environ.get("METRIC_NAME_INCLUDE", ""))
+METRIC_NAME_EXCLUDE = parse_metric_names(os.environ.get("METRIC_NAME_EXCLUDE", ""))
+# Metric name -> whether it is delivered, a stream only carries a few hundred distinct names
+metric_name_selection_cache = {}
+
+
+def metric_names_match(metric_name, names):
+    exact_names, prefixes = names
+    return metric_name in exact_names or metric_name.startswith(prefixes)
+
+
+def metric_name_selected(metric_name):
+    selected = metric_name_selection_cache.get(metric_name)
+    if selected is None:
+        include_names = METRIC_NAME_INCLUDE[0] or METRIC_NAME_INCLUDE[1]
+        selected = ((not include_names or metric_names_match(metric_name, METRIC_NAME_INCLUDE))
+                    and not metric_names_match(metric_name, METRIC_NAME_EXCLUDE))
+        metric_name_selection_cache[metric_name] = selected
+    return selected
+
+
+def line_metric_name(line):
+    match = METRIC_NAME_PATTERN.search(line)
+    if match:
+        return match.group(1).decode('utf-8')
+    return json_loads(line)['metric_name']
+
+
+HOUR_MILLIS = 3600 * 1000
+DAY_MILLIS = 24 * HOUR_MILLIS
+TIME_PARTITION_KEYS_CACHE_SIZE = 4096
+
+# Ordered partition keys of the data/ prefix, set from the partition_scheme config by MetricsSenderStack
+PARTITION_SCHEME = json.loads(os.environ.get("PARTITION_SCHEME") or
+                              '["account_id", "region", "year", "month", "day", "hour"]')
+# Time partition keys computed from the metric timestamp in UTC
+TIME_PARTITION_FORMATS = {
+    "year": "%Y",
+    "month": "%m",
+    "day": "%d",
+    "hour": "%H",
+    "dt": "%Y-%m-%d",
+    "dthour": "%Y-%m-%d-%H",
+}
+TIME_PARTITION_KEYS = [key for key in PARTITION_SCHEME if key in TIME_PARTITION_FORMATS]
+PARTITION_BUCKET_MILLIS = HOUR_MILLIS if "hour" in PARTITION_SCHEME or "dthour" in PARTITION_SCHEME else DAY_MILLIS
+PARTITION_BY_JOB_NAME = "jobname" in PARTITION_SCHEME
+PARTITION_BY_METRIC_FAMILY = "metric_family" in PARTITION_SCHEME
+JOB_NAME_PATTERN = re.compile(rb'"JobName"\s*:\s*"([^"\\]*)"')
+UNKNOWN_JOB_NAME = "unknown"
+
+# Epoch hour or day -> UTC time partition keys, kept across invocations of a warm function and cleared
+# when it reaches TIME_PARTITION_KEYS_CACHE_SIZE entries
+time_partition_keys_cache = {}
+
+
+def time_partition_keys(time_bucket):
+    """Return the UTC time partition keys of an epoch hour or day. The returned dict is shared and must not be modified."""
+    keys = time_partition_keys_cache.get(time_bucket)
+    if keys is None:
+        if len(time_partition_keys_cache) >= TIME_PARTITION_KEYS_CACHE_SIZE:
+            time_partition_keys_cache.clear()
+        event_time = time.gmtime(time_bucket * PARTITION_BUCKET_MILLIS // 1000)
+        keys = {key: time.strftime(TIME_PARTITION_FORMATS[key], event_time) for key in TIME_PARTITION_KEYS}
+        time_partition_keys_cache[time_bucket] = keys
+    return keys
+
+
+def line_job_name(line):
+    """JobName dimension of a line, '/' is replaced so that the name stays a single path segment."""
+    match = JOB_NAME_PATTERN.search(line)
+    if match:
+        job_name = match.group(1).decode('utf-8')
+    else:
+        job_name = (json_loads(line).get('dimensions') or {}).get('JobName')
+    return (job_name or UNKNOWN_JOB_NAME).replace("/", "_")
+
+
+# Family -> metric names (exact names and prefixes ending with '*'), the first matching family wins
+METRIC_FAMILIES = [
+    (family, parse_metric_names(",".join(metric_names)))
+    for family, metric_names in json.loads(os.environ.get("METRIC_FAMILIES") or "{}").items()
+]
+OTHER_METRIC_FAMILY = "other"
+# Metric name -> family, a stream only carries a few hundred distinct names
+metric_family_cache = {}
+
+
+def metric_family(metric_name):
+    family = metric_family_cache.get(metric_name)
+    if family is None:
+        family = next((family for family, names in METRIC_FAMILIES if metric_names_match(metric_name, names)),
+                      OTHER_METRIC_FAMILY)
+        metric_family_cache[metric_name] = family
+    return family
+
+
+def partition_keys(partition):
+    account_id, region, time_bucket, job_name, family = partition
+    keys = {"account_id": account_id, "region": region, **time_partition_keys(time_bucket)}
+    if job_name is not None:
+        keys["jobname"] = job_name
+    if family is not None:
+        keys["metric_family"] = family
+    return keys
+
+
+# The synchronous Lambda response is limited to 6 MB, keep some room for the JSON around the records
+MAX_RESPONSE_BYTES = int(os.environ.get("MAX_RESPONSE_BYTES", "6000000"))
+RESPONSE_RECORD_OVERHEAD_BYTES = 64
+# Stop transforming when less time than this is left, the remaining records are put back into the stream
+DEADLINE_MARGIN_MILLIS = int(os.environ.get("DEADLINE_MARGIN_MILLIS", "30000"))
+
+# Merge datapoints of the same metric and dimensions into buckets of this size, 0 disables the rollup
+ROLLUP_BUCKET_MILLIS = int(os.environ.get("ROLLUP_BUCKET_SECONDS", "0")) * 1000
+if ROLLUP_BUCKET_MILLIS and HOUR_MILLIS % ROLLUP_BUCKET_MILLIS:
+    # A bucket must not span two time partitions
+    raise ValueError(f"ROLLUP_BUCKET_SECONDS must divide an hour: {ROLLUP_BUCKET_MILLIS // 1000}")
+
+PUT_RECORD_BATCH_MAX_RECORDS = 500
+PUT_RECORD_BATCH_MAX_BYTES = 4 * 1024 * 1024
+PUT_RECORD_MAX_BYTES = 1000 * 1024
+REINGEST_MAX_ATTEMPTS = 3
+
+firehose_client = None
+
+
+def get_firehose_client(region):
+    global firehose_client
+    if firehose_client is None:
+        import boto3
+        firehose_client = boto3.client('firehose', region_name=region)
+    return firehose_client
+
+
+def record_batches(indexes, payloads):
+    """Split payload indexes into batches within the PutRecordBatch record count and size limits."""
+    batch = []
+    batch_size = 0
+    for index in indexes:
+        if batch and (len(batch) == PUT_RECORD_BATCH_MAX_RECORDS
+                      or batch_size + len(payloads[index]) > PUT_RECORD_BATCH_MAX_BYTES):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(index)
+        batch_size += len(payloads[index])
+    if batch:
+        yield batch
+
+
+def split_record_payload(payload):
+    """Split a payload of JSON lines into pieces within the Firehose record size limit, on line boundaries."""
+    if len(payload) <= PUT_RECORD_MAX_BYTES:
+        yield payload
+        return
+    piece = []
+    piece_size = 0
+    for line in payload.split(b"\n"):
+        if not line:
+            continue
+        if piece and piece_size + len(line) + 1 > PUT_RECORD_MAX_BYTES:
+            yield b"\n".join(piece) + b"\n"
+            piece = []
+            piece_size = 0
+        piece.append(line)
+        piece_size += len(line) + 1
+    if piece:
+        yield b"\n".join(piece) + b"\n"
+
+
+def put_record_batches(client, delivery_stream_name, payloads):
+    """Put payloads back into the delivery stream, retrying failed entries.
+
+    Return payload index -> undelivered lines for the payloads that still failed. A payload over the record size
+    limit is put back in several pieces, and only the lines of the pieces that failed are returned.
+    """
+    pieces = []
+    piece_indexes = []
+    failed_pieces = []
+    for index, payload in enumerate(payloads):
+        for piece in split_record_payload(payload):
+            if len(piece) > PUT_RECORD_MAX_BYTES:
+                # A single line over the limit is rejected by Firehose, do not fail the rest of its batch
+                failed_pieces.append((index, piece))
+                continue
+            pieces.append(piece)
+            piece_indexes.append(index)
+    pending = list(range(len(pieces)))
+    for _ in range(REINGEST_MAX_ATTEMPTS):
+        failed = []
+        for batch in record_batches(pending, pieces):
+            try:
+                response = client.put_record_batch(
+                    DeliveryStreamName=delivery_stream_name,
+                    Records=[{'Data': pieces[index]} for index in batch]
+                )
+            except client.exceptions.ClientError as e:
+                # Throttling fails the whole call, retry the batch with the other failed entries
+                if LOG_LEVEL != LOG_LEVEL_OFF:
+                    print(f"Failed to put {len(batch)} records into {delivery_stream_name}: {e!r}")
+                failed.extend(batch)
+                continue
+            if response['FailedPutCount']:
+                failed.extend(index for index, result in zip(batch, response['RequestResponses']) if 'ErrorCode' in result)
+        pending = failed
+        if not pending:
+            break
+    failed_pieces.extend((piece_indexes[index], pieces[index]) for index in pending)
+    undelivered = {}
+    for index, piece in sorted(failed_pieces, key=lambda failed_piece: failed_piece[0]):
+        undelivered[index] = undelivered.get(index, b"") + piece
+    return undelivered
+
+
+def response_record_bytes(firehose_record_output):
+    """Approximate size of a record in the serialized Lambda response."""
+    size = RESPONSE_RECORD_OVERHEAD_BYTES + len(firehose_record_output['recordId']) + len(firehose_record_output.get('data', ''))
+    if 'metadata' in firehose_record_output:
+        size += sum(len(key) + len(value) + 6 for key, value in firehose_record_output['metadata']['partitionKeys'].items())
+    return size
+
+
+def raw_payload(partitions):
+    """Payload of all the untransformed lines of a record, to put it back into the stream."""
+    return b"\n".join(line for _, raw_lines in partitions.values() for line in raw_lines) + b"\n"
+
+
+def payload_lines(payload):
+    """Yield the JSON lines of a record payload."""
+    # Re-ingested records are always JSON lines, a protobuf record never starts with a length prefix of 123 then '"'
+    if INPUT_FORMAT == INPUT_FORMAT_OPENTELEMETRY and not payload.startswith(b'{"'):
+        for row in otlp_decoder.decode_rows(payload):
+            yield json_dumps(row)
+        return
+    for line in payload.split(b"\n"):
+        if line:
+            yield line
+
+
+def transform_payload(payload):
+    """Transform the lines of a record payload, grouped as partition -> (transformed lines, raw lines).
+
+    A partition is (account_id, region, epoch hour or day, job name, metric family), the job name and the
+    metric family are None when the scheme has no jobname or metric_family key.
+    """
+    partitions = {}
+    filter_metric_names = any(METRIC_NAME_INCLUDE) or any(METRIC_NAME_EXCLUDE)
+    for line in payload_lines(payload):
+        metric_name = line_metric_name(line) if filter_metric_names or PARTITION_BY_METRIC_FAMILY else None
+        if filter_metric_names and not metric_name_selected(metric_name):
+            continue
+        output_line, account_id, region, timestamp = TRANSFORM_LINE(line)
+        # The keys end up in the partition path and the response metadata, which only take strings
+        if not isinstance(account_id, str) or not isinstance(region, str):
+            raise ValueError(f"account_id and region must be strings: {line[:100]!r}")
+
+        job_name = line_job_name(line) if PARTITION_BY_JOB_NAME else None
+        family = metric_family(metric_name) if PARTITION_BY_METRIC_FAMILY else None
+        partition = (account_id, region, int(timestamp) // PARTITION_BUCKET_MILLIS, job_name, family)
+        partition_lines = partitions.get(partition)
+        if partition_lines is None:
+            partition_lines = partitions[partition] = ([], [])
+        partition_lines[0].append(output_line)
+        partition_lines[1].append(line)
+        if LOG_LEVEL == LOG_LEVEL_DEBUG and random.random() < DEBUG_SAMPLE_RATE:
+            print(f"Sampled line: {line.decode('utf-8')} -> {output_line.decode('utf-8')} partition: {partition}")
+    return partitions
+
+
+ROLLUP_STATISTICS = ('max', 'min', 'sum', 'count')
+
+
+def rollup_bucket_start(timestamp):
+    return timestamp - timestamp % ROLLUP_BUCKET_MILLIS
+
+
+def rollup_row(line):
+    """Parse a transformed line into (merge key, row). The key is None when the row cannot be merged."""
+    row = json_loads(line)
+    if not isinstance(row, dict):
+        raise ValueError(f"Metric line is not a JSON object: {line[:100]!r}")
+    value = row.get('value')
+    if not (isinstance(row.get('metric_name'), str) and isinstance(row.get('timestamp'), (int, float))
+            and isinstance(value, dict) and isinstance(row.get('dimensions') or {}, dict)
+            and all(isinstance(value.get(statistic), (int, float)) for statistic in ROLLUP_STATISTICS)):
+        # Delivered as is, e.g. OpenTelemetry summaries without the 0 and 1 quantiles have no max and min
+        return None, row
+    key = (row.get('metric_stream_name'), row.get('namespace'), row['metric_name'],
+           tuple(sorted((row.get('dimensions') or {}).items())), row.get('unit'), rollup_bucket_start(row['timestamp']))
+    try:
+        hash(key)
+    except TypeError:
+        return None, row
+    return key, row
+
+
+def rollup_partitions(transformed_records):
+    """Merge the datapoints of all records per partition, metric, dimensions and time bucket.
+
+    The lines of the records were already parsed by rollup_row. The merged lines of a partition are delivered by
+    the first record that contained the partition, so a record can end up with no partition at all when all its
+    lines were merged into other records.
+    """
+    owners = {}
+    merged_rows = {}
+    for index, (_, partitions) in enumerate(transformed_records):
+        for partition, (keyed_rows, _) in partitions.items():
+            owners.setdefault(partition, index)
+            rows = merged_rows.setdefault(partition, {})
+            for key, row in keyed_rows:
+                if key is None:
+                    # Rows that cannot be merged keep their own entry
+                    rows[(None, len(rows))] = row
+                    continue
+                merged = rows.get(key)
+                if merged is None:
+                    row['timestamp'] = key[-1]
+                    rows[key] = row
+                else:
+                    value = merged['value']
+                    other = row['value']
+                    value['max'] = max(value['max'], other['max'])
+                    value['min'] = min(value['min'], other['min'])
+                    value['sum'] += other['sum']
+                    value['count'] += other['count']
+
+    rolled_up_records = [(firehose_record_input, {}) for firehose_record_input, _ in transformed_records]
+    for partition, rows in merged_rows.items():
+        account_id, region = partition[0], partition[1]
+        rolled_up_records[owners[partition]][1][partition] = (
+            [json_dumps(row) for row in rows.values()],
+            # Lines put back into the stream need the fields that the transform removes
+            [json_dumps({**row, 'account_id': account_id, 'region': region}) for row in rows.values()]
+        )
+    return rolled_up_records
+
+
+def emf_record(namespace, dimensions, metrics, timestamp_millis):
+    """CloudWatch Embedded Metric Format record, metrics is a list of (name, unit, value)."""
+    emf = {
+        "_aws": {
+            "Timestamp": timestamp_millis,
+            "CloudWatchMetrics": [{
+                "Namespace": namespace,
+                "Dimensions": [list(dimensions)],
+                "Metrics": [{"Name": name, "Unit": unit} for name, unit, _ in metrics]
+            }]
+        }
+    }
+    emf.update(dimensions)
+    emf.update((name, value) for name, _, value in metrics)
+    return emf
 
 
 def lambda_handler(firehose_records_input, context):
-    print("Received records for processing from DeliveryStream: " + firehose_records_input['deliveryStreamArn']
-          + ", Region: " + firehose_records_input['region']
-          + ", and InvocationId: " + firehose_records_input['invocationId'])
+    global invocation_count
+    invocation_count += 1
+    if PROFILE_EVERY_N_INVOCATIONS and (invocation_count - 1) % PROFILE_EVERY_N_INVOCATIONS == 0:
+        return profile_invocation(process_records, firehose_records_input, context)
+    return process_records(firehose_records_input, context)
+
+
+def profile_invocation(handler, firehose_records_input, context):
+    """Run the handler under cProfile (and tracemalloc) and write a summary of the profile."""
+    profiler = cProfile.Profile()
+    if PROFILE_TRACEMALLOC:
+        tracemalloc.start()
+    try:
+        profiler.enable()
+        try:
+            return handler(firehose_records_input, context)
+        finally:
+            profiler.disable()
+    finally:
+        peak_bytes = None
+        if PROFILE_TRACEMALLOC:
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        write_profile(profiler, peak_bytes, firehose_records_input['invocationId'])
+
+
+def write_profile(profiler, peak_bytes, invocation_id):
+    peak = f", tracemalloc peak: {peak_bytes} bytes" if peak_bytes is not None else ""
+    if PROFILE_OUTPUT == PROFILE_OUTPUT_TMP:
+        path = os.path.join(PROFILE_DIRECTORY, f"firehose_lambda-{invocation_id}.prof")
+        profiler.dump_stats(path)
+        print(f"Profile of InvocationId {invocation_id} written to {path}{peak}")
+        return
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP_FUNCTIONS)
+    # One log event for the whole profile
+    print(f"Profile of InvocationId {invocation_id}{peak}\r" + summary.getvalue().strip().replace("\n", "\r"))
+
+
+def process_records(firehose_records_input, context):
+    start_time = time.perf_counter()
     firehose_records_output = {'records': []}
+    line_count = 0
+    bytes_in = 0
+    bytes_out = 0
+    failed_count = 0
+    dropped_count = 0
+    reingest_failed_count = 0
+    parse_seconds = 0.0
+    encode_seconds = 0.0
+    partitions_touched = set()
+    # Partition -> partition keys, a batch usually spans a few partitions that many records share
+    invocation_partition_keys = {}
+    response_bytes = 0
+    # (input record, partitions) of the records that were transformed successfully
+    transformed_records = []
+    # Lines of other partitions than the one kept in their record, as (output record, raw lines of the kept
+    # partition, raw payload)
+    reingest_payloads = []
+    # Payloads left unprocessed because of the response size limit or the deadline, and their record IDs
+    deferred_payloads = []
+    deferred_record_ids = []
 
     for firehose_record_input in firehose_records_input['records']:
-        # Get user payload
-        payload = base64.b64decode(firehose_record_input['data']).decode('utf-8')
-        print(f"Payload: {payload}")
-        lines = payload.split("\n")
-        print("split lines: ")
-        print(*lines)
-
-        output_payload = ""
-        partition_keys = {}
-        for line in lines:
-            if not line:
-                continue
-            print(f"split line: {line}")
-            json_value = json.loads(line)
-            print("Record that was received")
-            print(json_value)
-            print("\n")
-
-            firehose_record_output = {}
-            event_timestamp = datetime.datetime.fromtimestamp(json_value['timestamp'] / 1000)
-            partition_keys = {
-                "account_id": json_value['account_id'],
-                "region": json_value['region'],
-                "year": event_timestamp.strftime('%Y'),
-                "month": event_timestamp.strftime('%m'),
-                "day": event_timestamp.strftime('%d'),
-                "hour": event_timestamp.strftime('%H')
-            }
-            del json_value['account_id']
-            del json_value['region']
-            output_payload += json.dumps(json_value) + "\n"
-        print(f"output_payload: {output_payload}")
-        print(f"partition keys: {partition_keys}")
-
-        if partition_keys != {}:
+        if deferred_record_ids or (context is not None and context.get_remaining_time_in_millis() < DEADLINE_MARGIN_MILLIS):
+            deferred_payloads.append(base64.b64decode(firehose_record_input['data']))
+            deferred_record_ids.append(firehose_record_input['recordId'])
+            continue
+
+        try:
+            # Get user payload
+            payload = base64.b64decode(firehose_record_input['data'])
+            bytes_in += len(payload)
+            parse_start_time = time.perf_counter()
+            try:
+                partitions = transform_payload(payload)
+                # Out of range timestamps only fail when their time keys are computed
+                for partition in partitions:
+                    if partition not in invocation_partition_keys:
+                        invocation_partition_keys[partition] = partition_keys(partition)
+                if ROLLUP_BUCKET_MILLIS:
+                    # Parse the lines here so that a line that cannot be parsed only fails its record
+                    partitions = {
+                        partition: ([rollup_row(line) for line in output_lines], raw_lines)
+                        for partition, (output_lines, raw_lines) in partitions.items()
+                    }
+            finally:
+                parse_seconds += time.perf_counter() - parse_start_time
+        except (ValueError, KeyError, TypeError, AttributeError, OSError, OverflowError) as e:
+            # Only this record goes to the error output, the rest of the batch is delivered
+            if LOG_LEVEL != LOG_LEVEL_OFF:
+                print(f"Failed to process record {firehose_record_input['recordId']}: {e!r}")
+            failed_count += 1
             firehose_record_output = {'recordId': firehose_record_input['recordId'],
-                                      'data': base64.b64encode(output_payload.encode('utf-8')),
-                                      'result': 'Ok',
-                                      'metadata': {'partitionKeys': partition_keys}}
+                                      'data': firehose_record_input['data'],
+                                      'result': 'ProcessingFailed'}
+            response_bytes += response_record_bytes(firehose_record_output)
+            firehose_records_output['records'].append(firehose_record_output)
+            continue
+
+        line_count += sum(len(output_lines) for output_lines, _ in partitions.values())
+        transformed_records.append((firehose_record_input, partitions))
 
+    if ROLLUP_BUCKET_MILLIS:
+        transformed_records = rollup_partitions(transformed_records)
+
+    response_full = False
+    for firehose_record_input, partitions in transformed_records:
+        if not partitions:
+            # Every input record needs a result, otherwise Firehose treats the record as failed
+            dropped_count += 1
+            firehose_record_output = {'recordId': firehose_record_input['recordId'],
+                                      'result': 'Dropped'}
+            response_bytes += response_record_bytes(firehose_record_output)
             firehose_records_output['records'].append(firehose_record_output)
+            continue
+
+        if response_full:
+            deferred_payloads.append(raw_payload(partitions))
+            deferred_record_ids.append(firehose_record_input['recordId'])
+            continue
+
+        partitions_touched.update(partitions)
+        encode_start_time = time.perf_counter()
+        # A record can only be delivered to one partition. Keep the largest one and put the lines
+        # of the others back into the stream as single-partition records.
+        partition = max(partitions, key=lambda key: len(partitions[key][0]))
+        output_lines = partitions[partition][0]
+
+        # Build the record in one pass instead of growing a string line by line
+        output_payload = b"\n".join(output_lines) + b"\n"
+        firehose_record_output = {'recordId': firehose_record_input['recordId'],
+                                  'data': base64.b64encode(output_payload).decode('utf-8'),
+                                  'result': 'Ok',
+                                  'metadata': {'partitionKeys': invocation_partition_keys[partition]}}
+        encode_seconds += time.perf_counter() - encode_start_time
+        record_bytes = response_record_bytes(firehose_record_output)
+        if response_bytes + record_bytes > MAX_RESPONSE_BYTES:
+            response_full = True
+            deferred_payloads.append(raw_payload(partitions))
+            deferred_record_ids.append(firehose_record_input['recordId'])
+            continue
+        response_bytes += record_bytes
+        bytes_out += len(output_payload)
+
+        firehose_records_output['records'].append(firehose_record_output)
+        for other_partition, (_, raw_lines) in partitions.items():
+            if other_partition != partition:
+                reingest_payloads.append((firehose_record_output, partitions[partition][1], b"\n".join(raw_lines) + b"\n"))
+
+    if deferred_record_ids:
+        # Hand the unprocessed lines back to the stream and drop their records from this batch
+        failed = put_record_batches(
+            get_firehose_client(firehose_records_input['region']),
+            firehose_records_input['deliveryStreamArn'].split('/')[-1],
+            deferred_payloads
+        )
+        reingest_failed_count += len(failed)
+        # Retrying the batch would duplicate the records that were put back, so only the undelivered lines
+        # of the others go to the error output
+        for index, record_id in enumerate(deferred_record_ids):
+            if index in failed:
+                firehose_records_output['records'].append({'recordId': record_id,
+                                                           'data': base64.b64encode(failed[index]).decode('utf-8'),
+                                                           'result': 'ProcessingFailed'})
+            else:
+                firehose_records_output['records'].append({'recordId': record_id,
+                                                           'result': 'Dropped'})
+        if LOG_LEVEL != LOG_LEVEL_OFF:
+            print(f"Reingested {len(deferred_payloads) - len(failed)} of {len(deferred_payloads)} unprocessed records "
+                  f"after {response_bytes} response bytes")
+
+    if reingest_payloads:
+        failed = put_record_batches(
+            get_firehose_client(firehose_records_input['region']),
+            firehose_records_input['deliveryStreamArn'].split('/')[-1],
+            [payload for _, _, payload in reingest_payloads]
+        )
+        reingest_failed_count += len(failed)
+        # Send the undelivered lines of the source record to the error output rather than silently losing them:
+        # the kept partition, which can no longer be Ok, and the partitions that could not be put back.
+        # The partitions that were put back are left out so that they are not both in the table and in error/.
+        failed_payloads = {}
+        for index, payload in failed.items():
+            firehose_record_output, kept_raw_lines, _ = reingest_payloads[index]
+            failed_payloads.setdefault(firehose_record_output['recordId'], (firehose_record_output, kept_raw_lines, []))[2].append(payload)
+        for firehose_record_output, kept_raw_lines, payloads in failed_payloads.values():
+            firehose_record_output['result'] = 'ProcessingFailed'
+            firehose_record_output['data'] = base64.b64encode(
+                b"\n".join(kept_raw_lines) + b"\n" + b"".join(payloads)).decode('utf-8')
+            firehose_record_output.pop('metadata', None)
+        if LOG_LEVEL != LOG_LEVEL_OFF:
+            print(f"Reingested {len(reingest_payloads) - len(failed)} of {len(reingest_payloads)} records spanning multiple partitions")
+
+    # Return the results in the order of the input records
+    record_order = {firehose_record_input['recordId']: index for index, firehose_record_input in enumerate(firehose_records_input['records'])}
+    firehose_records_output['records'].sort(key=lambda record: record_order[record['recordId']])
+
+    elapsed = time.perf_counter() - start_time
+    if METRICS_NAMESPACE:
+        print(json.dumps(emf_record(
+            METRICS_NAMESPACE,
+            {"DeliveryStream": firehose_records_input['deliveryStreamArn'].split('/')[-1]},
+            [
+                ("InputRecords", "Count", len(firehose_records_input['records'])),
+                ("Lines", "Count", line_count),
+                ("BytesIn", "Bytes", bytes_in),
+                ("BytesOut", "Bytes", bytes_out),
+                ("ParseTime", "Milliseconds", parse_seconds * 1000),
+                ("EncodeTime", "Milliseconds", encode_seconds * 1000),
+                ("ProcessingTime", "Milliseconds", elapsed * 1000),
+                ("PartitionsTouched", "Count", len(partitions_touched)),
+                ("FailedRecords", "Count", failed_count + reingest_failed_count),
+                ("DroppedRecords", "Count", dropped_count),
+                ("ReingestedRecords", "Count", len(deferred_payloads) + len(reingest_payloads) - reingest_failed_count),
+            ],
+            int(time.time() * 1000)
+        )))
+
+    if LOG_LEVEL != LOG_LEVEL_OFF:
+        print(f"Processed {len(firehose_records_input['records'])} records ({failed_count} failed, {dropped_count} dropped, {line_count} lines, "
+              f"{bytes_in} bytes in, {bytes_out} bytes out) in {elapsed * 1000:.1f} ms "
+              f"({line_count / elapsed if elapsed else 0:.0f} lines/s) from DeliveryStream: "
+              f"{firehose_records_input['deliveryStreamArn']}, JSON codec: {JSON_CODEC_NAME}, InvocationId: {firehose_records_input['invocationId']}")
 
     return firehose_records_output
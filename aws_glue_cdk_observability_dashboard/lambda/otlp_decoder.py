@@ -0,0 +1,176 @@
+import struct
+
+# Protobuf wire types
+WIRE_TYPE_VARINT = 0
+WIRE_TYPE_FIXED64 = 1
+WIRE_TYPE_LENGTH_DELIMITED = 2
+WIRE_TYPE_FIXED32 = 5
+
+
+def read_varint(buffer, position):
+    result = 0
+    shift = 0
+    while True:
+        if position >= len(buffer):
+            raise ValueError("Truncated protobuf varint")
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
+def iter_fields(buffer):
+    """Yield the (field number, value) of a protobuf message, values of length-delimited fields are memoryviews."""
+    position = 0
+    end = len(buffer)
+    while position < end:
+        tag, position = read_varint(buffer, position)
+        wire_type = tag & 0x07
+        if wire_type == WIRE_TYPE_VARINT:
+            value, position = read_varint(buffer, position)
+            yield tag >> 3, value
+            continue
+        if wire_type == WIRE_TYPE_FIXED64:
+            length = 8
+        elif wire_type == WIRE_TYPE_FIXED32:
+            length = 4
+        elif wire_type == WIRE_TYPE_LENGTH_DELIMITED:
+            length, position = read_varint(buffer, position)
+        else:
+            raise ValueError(f"Unsupported protobuf wire type: {wire_type}")
+        if position + length > end:
+            raise ValueError("Truncated protobuf field")
+        yield tag >> 3, buffer[position:position + length]
+        position += length
+
+
+def decode_any_value(message):
+    # opentelemetry.proto.common.v1.AnyValue
+    for field, value in iter_fields(message):
+        if field == 1:
+            return str(value, 'utf-8')
+        if field == 2:
+            return bool(value)
+        if field == 3:
+            return value - (1 << 64) if value >= 1 << 63 else value
+        if field == 4:
+            return struct.unpack('<d', value)[0]
+        if field == 5:
+            return [decode_any_value(item) for item_field, item in iter_fields(value) if item_field == 1]
+        if field == 6:
+            return decode_key_values(value)
+        if field == 7:
+            return bytes(value)
+    return None
+
+
+def decode_key_value(message):
+    # opentelemetry.proto.common.v1.KeyValue
+    key = None
+    value = None
+    for field, field_value in iter_fields(message):
+        if field == 1:
+            key = str(field_value, 'utf-8')
+        elif field == 2:
+            value = decode_any_value(field_value)
+    return key, value
+
+
+def decode_key_values(message):
+    """Decode the repeated KeyValue field 1 of a message (KeyValueList, Resource) into a dict."""
+    return dict(decode_key_value(value) for field, value in iter_fields(message) if field == 1)
+
+
+def decode_summary_data_point(message, resource_row, unit):
+    # opentelemetry.proto.metrics.v1.SummaryDataPoint, CloudWatch sends min and max as the 0 and 1 quantiles
+    attributes = {}
+    row_value = {"max": None, "min": None, "sum": None, "count": None}
+    timestamp = 0
+    for field, value in iter_fields(message):
+        if field == 7:
+            key, attribute_value = decode_key_value(value)
+            attributes[key] = attribute_value
+        elif field == 3:
+            timestamp = struct.unpack('<Q', value)[0]
+        elif field == 4:
+            row_value["count"] = float(struct.unpack('<Q', value)[0])
+        elif field == 5:
+            row_value["sum"] = struct.unpack('<d', value)[0]
+        elif field == 6:
+            quantile = 0.0
+            quantile_value = 0.0
+            for quantile_field, quantile_field_value in iter_fields(value):
+                if quantile_field == 1:
+                    quantile = struct.unpack('<d', quantile_field_value)[0]
+                elif quantile_field == 2:
+                    quantile_value = struct.unpack('<d', quantile_field_value)[0]
+            if quantile == 0.0:
+                row_value["min"] = quantile_value
+            elif quantile == 1.0:
+                row_value["max"] = quantile_value
+    return {
+        "metric_stream_name": resource_row["metric_stream_name"],
+        "account_id": resource_row["account_id"],
+        "region": resource_row["region"],
+        "namespace": attributes.get("Namespace"),
+        "metric_name": attributes.get("MetricName"),
+        "dimensions": attributes.get("Dimensions") or {},
+        "timestamp": timestamp // 1000000,
+        "value": row_value,
+        "unit": unit
+    }
+
+
+def decode_metric(message, resource_row):
+    # opentelemetry.proto.metrics.v1.Metric, CloudWatch metric streams only send summaries
+    unit = None
+    summaries = []
+    for field, value in iter_fields(message):
+        if field == 3:
+            unit = str(value, 'utf-8')
+        elif field == 11:
+            summaries.append(value)
+    for summary in summaries:
+        for field, value in iter_fields(summary):
+            if field == 1:
+                yield decode_summary_data_point(value, resource_row, unit)
+
+
+def decode_resource_metrics(message):
+    # opentelemetry.proto.metrics.v1.ResourceMetrics
+    resource_attributes = {}
+    scope_metrics = []
+    for field, value in iter_fields(message):
+        if field == 1:
+            resource_attributes = decode_key_values(value)
+        elif field == 2:
+            scope_metrics.append(value)
+    resource_row = {
+        # aws.exporter.arn is the ARN of the metric stream
+        "metric_stream_name": str(resource_attributes.get("aws.exporter.arn", "")).rsplit("/", 1)[-1],
+        "account_id": resource_attributes.get("cloud.account.id"),
+        "region": resource_attributes.get("cloud.region")
+    }
+    for scope_metric in scope_metrics:
+        for field, value in iter_fields(scope_metric):
+            if field == 2:
+                yield from decode_metric(value, resource_row)
+
+
+def decode_rows(payload):
+    """Yield metric_data rows from a record of length-delimited ExportMetricsServiceRequest messages."""
+    buffer = memoryview(payload)
+    position = 0
+    while position < len(buffer):
+        length, position = read_varint(buffer, position)
+        if position + length > len(buffer):
+            raise ValueError("Truncated ExportMetricsServiceRequest")
+        try:
+            for field, value in iter_fields(buffer[position:position + length]):
+                if field == 1:
+                    yield from decode_resource_metrics(value)
+        except struct.error as e:
+            raise ValueError(f"Malformed ExportMetricsServiceRequest: {e}") from e
+        position += length
@@ -1,3 +1,4 @@
+import json
 from typing import Dict
 
 from aws_cdk import (
@@ -9,11 +10,48 @@ from aws_cdk import (
     aws_lambda as awslambda,
     aws_kinesisfirehose_alpha as firehose,
     aws_kinesisfirehose_destinations_alpha as firehose_destinations,
+    BundlingOptions,
     Duration,
     Size,
 )
 from constructs import Construct
 
+from aws_glue_cdk_observability_dashboard.catalog_stack import (
+    STORAGE_FORMAT_JSON,
+    STORAGE_FORMAT_PARQUET,
+    STORAGE_FORMAT_ORC,
+)
+from aws_glue_cdk_observability_dashboard.partition_scheme import (
+    OTHER_METRIC_FAMILY,
+    TIME_PARTITION_FORMATS,
+    metric_families,
+    partition_path_template,
+    partition_scheme,
+)
+
+PARTITIONING_MODE_LAMBDA = "lambda"
+PARTITIONING_MODE_INLINE = "inline"
+
+METRIC_STREAM_FORMAT_JSON = "json"
+METRIC_STREAM_FORMAT_OPENTELEMETRY = "opentelemetry1.0"
+
+JSON_CODEC_STDLIB = "stdlib"
+JSON_CODEC_ORJSON = "orjson"
+
+# JQ expressions evaluated by Firehose for each metric in inline mode.
+# Time partitions are derived from the metric timestamp (epoch millis, UTC) rather than
+# the arrival time so that both modes write a datapoint to the same partition.
+INLINE_PARTITION_KEY_QUERIES = {
+    "account_id": ".account_id",
+    "region": ".region",
+    # Same default and '/' replacement as the Lambda function
+    "jobname": "(.dimensions.JobName // \"unknown\" | split(\"/\") | join(\"_\"))",
+    **{
+        key: f"(.timestamp/1000|floor|strftime(\"{time_format}\"))"
+        for key, time_format in TIME_PARTITION_FORMATS.items()
+    },
+}
+
 
 class MetricsSenderStack(Stack):
 
@@ -53,33 +91,91 @@ class MetricsSenderStack(Stack):
             )
         )
 
-        firehose_lambda = awslambda.Function(
-            self,
-            'FirehoseLambda',
-            runtime=awslambda.Runtime.PYTHON_3_11,
-            code=awslambda.Code.from_asset('aws_glue_cdk_observability_dashboard/lambda/'),
-            handler='firehose_lambda.lambda_handler',
-            timeout=Duration.seconds(300),
-        )
+        output_format = config.get("firehose_output_format", STORAGE_FORMAT_JSON)
+        if output_format not in (STORAGE_FORMAT_JSON, STORAGE_FORMAT_PARQUET, STORAGE_FORMAT_ORC):
+            raise ValueError(f"Unsupported firehose_output_format: {output_format}")
 
-        firehose_role.add_to_policy(
-            iam.PolicyStatement(
-                actions=[
-                    'lambda:InvokeFunction',
-                    'lambda:GetFunctionConfiguration',
-                ],
-                resources=[
-                    firehose_lambda.function_arn,
-                ],
+        metric_stream_format = config.get("metric_stream_output_format", METRIC_STREAM_FORMAT_JSON)
+        if metric_stream_format not in (METRIC_STREAM_FORMAT_JSON, METRIC_STREAM_FORMAT_OPENTELEMETRY):
+            raise ValueError(f"Unsupported metric_stream_output_format: {metric_stream_format}")
+
+        scheme = partition_scheme(config)
+        families = metric_families(config)
+
+        metric_name_include = config.get("metric_name_include") or []
+        metric_name_exclude = config.get("metric_name_exclude") or []
+
+        partitioning_mode = config.get("firehose_partitioning_mode", PARTITIONING_MODE_LAMBDA)
+        if partitioning_mode == PARTITIONING_MODE_LAMBDA:
+            json_codec = config.get("firehose_lambda_json_codec", JSON_CODEC_STDLIB)
+            if json_codec == JSON_CODEC_ORJSON:
+                # Bundle orjson with the function code, this requires Docker when synthesizing
+                firehose_lambda_code = awslambda.Code.from_asset(
+                    'aws_glue_cdk_observability_dashboard/lambda/',
+                    bundling=BundlingOptions(
+                        image=awslambda.Runtime.PYTHON_3_11.bundling_image,
+                        command=["bash", "-c", "pip install orjson -t /asset-output && cp -au . /asset-output"],
+                    )
+                )
+            elif json_codec == JSON_CODEC_STDLIB:
+                firehose_lambda_code = awslambda.Code.from_asset('aws_glue_cdk_observability_dashboard/lambda/')
+            else:
+                raise ValueError(f"Unsupported firehose_lambda_json_codec: {json_codec}")
+
+            firehose_lambda = awslambda.Function(
+                self,
+                'FirehoseLambda',
+                runtime=awslambda.Runtime.PYTHON_3_11,
+                code=firehose_lambda_code,
+                handler='firehose_lambda.lambda_handler',
+                timeout=Duration.seconds(300),
+                environment={
+                    "INPUT_FORMAT": metric_stream_format,
+                    "PARTITION_SCHEME": json.dumps(scheme),
+                    "METRIC_FAMILIES": json.dumps(families),
+                    "LOG_LEVEL": config.get("firehose_lambda_log_level", "SUMMARY"),
+                    "DEBUG_SAMPLE_RATE": str(config.get("firehose_lambda_debug_sample_rate", 0.001)),
+                    "METRICS_NAMESPACE": config.get("firehose_lambda_metrics_namespace") or "",
+                    "PROFILE_EVERY_N_INVOCATIONS": str(config.get("firehose_lambda_profile_every_n_invocations", 0)),
+                    "PROFILE_TRACEMALLOC": str(config.get("firehose_lambda_profile_tracemalloc", False)).lower(),
+                    "PROFILE_OUTPUT": config.get("firehose_lambda_profile_output", "log"),
+                    "ENCODING_MODE": config.get("firehose_lambda_encoding_mode", "passthrough"),
+                    "JSON_CODEC": json_codec,
+                    "ROLLUP_BUCKET_SECONDS": str(config.get("firehose_lambda_rollup_bucket_seconds", 0)),
+                    "METRIC_NAME_INCLUDE": ",".join(metric_name_include),
+                    "METRIC_NAME_EXCLUDE": ",".join(metric_name_exclude),
+                    "DEADLINE_MARGIN_MILLIS": str(config.get("firehose_lambda_deadline_margin_seconds", 30) * 1000),
+                },
             )
-        )
 
-        firehose_lambda_processor = firehose.LambdaFunctionProcessor(
-            firehose_lambda,
-            retries=3,
-            buffer_size=Size.mebibytes(config["firehose_lambda_buffer_size_mb"]),
-            buffer_interval=Duration.seconds(config["firehose_lambda_buffer_interval_seconds"]),
-        )
+            firehose_role.add_to_policy(
+                iam.PolicyStatement(
+                    actions=[
+                        'lambda:InvokeFunction',
+                        'lambda:GetFunctionConfiguration',
+                    ],
+                    resources=[
+                        firehose_lambda.function_arn,
+                    ],
+                )
+            )
+
+            firehose_processor = firehose.LambdaFunctionProcessor(
+                firehose_lambda,
+                retries=3,
+                buffer_size=Size.mebibytes(config["firehose_lambda_buffer_size_mb"]),
+                buffer_interval=Duration.seconds(config["firehose_lambda_buffer_interval_seconds"]),
+            )
+            partition_key_namespace = "partitionKeyFromLambda"
+        elif partitioning_mode == PARTITIONING_MODE_INLINE:
+            if metric_stream_format != METRIC_STREAM_FORMAT_JSON:
+                # The JQ metadata extraction can only read JSON records
+                raise ValueError("firehose_partitioning_mode inline requires metric_stream_output_format json")
+            # Partition keys are extracted by Firehose itself (see the ProcessingConfiguration override below)
+            firehose_processor = None
+            partition_key_namespace = "partitionKeyFromQuery"
+        else:
+            raise ValueError(f"Unsupported firehose_partitioning_mode: {partitioning_mode}")
 
         delivery_stream = firehose.DeliveryStream(
             self,
@@ -92,12 +188,12 @@ class MetricsSenderStack(Stack):
                         bucket_name=config["s3_bucket_name"]
                     ),
                     role=firehose_role,
-                    data_output_prefix="data/account_id=!{partitionKeyFromLambda:account_id}/region=!{partitionKeyFromLambda:region}/year=!{partitionKeyFromLambda:year}/month=!{partitionKeyFromLambda:month}/day=!{partitionKeyFromLambda:day}/hour=!{partitionKeyFromLambda:hour}/",
+                    data_output_prefix=data_output_prefix(scheme, partition_key_namespace),
                     error_output_prefix="error/",
                     buffering_size=Size.mebibytes(config["firehose_s3_buffer_size_mb"]),
                     buffering_interval=Duration.seconds(config["firehose_s3_buffer_interval_seconds"]),
                     log_group=firehose_log_group,
-                    processor=firehose_lambda_processor,
+                    processor=firehose_processor,
                 )
             ]
         )
@@ -106,6 +202,57 @@ class MetricsSenderStack(Stack):
             'ExtendedS3DestinationConfiguration.DynamicPartitioningConfiguration',
             {'Enabled': True}
         )
+        if partitioning_mode == PARTITIONING_MODE_LAMBDA:
+            # Records spanning several partitions are split and their extra lines put back into the stream.
+            # A separate policy avoids a dependency cycle between the function, its role and the stream.
+            iam.Policy(
+                self,
+                'FirehoseLambdaReingestPolicy',
+                roles=[firehose_lambda.role],
+                statements=[
+                    iam.PolicyStatement(
+                        actions=[
+                            'firehose:PutRecordBatch',
+                        ],
+                        resources=[
+                            delivery_stream.delivery_stream_arn
+                        ],
+                    )
+                ]
+            )
+        if partitioning_mode == PARTITIONING_MODE_INLINE:
+            cfn_delivery_stream.add_property_override(
+                'ExtendedS3DestinationConfiguration.ProcessingConfiguration',
+                inline_processing_configuration(scheme, families, append_delimiter=output_format == STORAGE_FORMAT_JSON)
+            )
+        if output_format != STORAGE_FORMAT_JSON:
+            # Convert records to a columnar format using the metric_data table of CatalogStack as the schema
+            catalog_id = str(config.get("glue_catalog_account_id", self.account))
+            firehose_role.add_to_policy(
+                iam.PolicyStatement(
+                    actions=[
+                        'glue:GetTable',
+                        'glue:GetTableVersion',
+                        'glue:GetTableVersions',
+                    ],
+                    resources=[
+                        f"arn:aws:glue:{self.region}:{catalog_id}:catalog",
+                        f"arn:aws:glue:{self.region}:{catalog_id}:database/{config['glue_database_name']}",
+                        f"arn:aws:glue:{self.region}:{catalog_id}:table/{config['glue_database_name']}/{config['glue_table_name']}",
+                    ],
+                )
+            )
+            cfn_delivery_stream.add_property_override(
+                'ExtendedS3DestinationConfiguration.DataFormatConversionConfiguration',
+                data_format_conversion_configuration(
+                    output_format=output_format,
+                    catalog_id=catalog_id,
+                    region=self.region,
+                    database_name=config["glue_database_name"],
+                    table_name=config["glue_table_name"],
+                    role_arn=firehose_role.role_arn,
+                )
+            )
 
         metricstream_role = iam.Role(
             self,
@@ -127,7 +274,102 @@ class MetricsSenderStack(Stack):
             self,
             "ObservabilityMetricStream",
             firehose_arn=delivery_stream.delivery_stream_arn,
-            output_format="json",
-            include_filters=[{"namespace": "Glue"}],
+            output_format=metric_stream_format,
+            include_filters=[metric_stream_include_filter(metric_name_include, metric_name_exclude)],
             role_arn=metricstream_role.role_arn
-        )
\ No newline at end of file
+        )
+
+
+def data_output_prefix(scheme, partition_key_namespace):
+    return "data/" + partition_path_template(scheme, f"!{{{{{partition_key_namespace}:{{key}}}}}}")
+
+
+def inline_partition_keys_query(scheme, families):
+    queries = {**INLINE_PARTITION_KEY_QUERIES, "metric_family": inline_metric_family_query(families)}
+    return "{" + ",".join(f"{key}:{queries[key]}" for key in scheme) + "}"
+
+
+def inline_metric_family_query(families):
+    """JQ expression of the family of a metric, with the same first-match rule as the Lambda function."""
+    query = ".metric_name as $name | "
+    for family, metric_names in families.items():
+        conditions = " or ".join(
+            f"($name | startswith({json.dumps(name[:-1])}))" if name.endswith("*") else f"$name == {json.dumps(name)}"
+            for name in metric_names
+        )
+        query += f"if {conditions} then {json.dumps(family)} else "
+    query += json.dumps(OTHER_METRIC_FAMILY) + " end" * len(families)
+    return f"({query})"
+
+
+def inline_processing_configuration(scheme, families, append_delimiter):
+    processors = [
+        {
+            # Metric streams pack several newline-delimited JSON objects into one Firehose record
+            'Type': 'RecordDeAggregation',
+            'Parameters': [
+                {'ParameterName': 'SubRecordType', 'ParameterValue': 'JSON'}
+            ]
+        },
+        {
+            'Type': 'MetadataExtraction',
+            'Parameters': [
+                {'ParameterName': 'MetadataExtractionQuery', 'ParameterValue': inline_partition_keys_query(scheme, families)},
+                {'ParameterName': 'JsonParsingEngine', 'ParameterValue': 'JQ-1.6'}
+            ]
+        }
+    ]
+    if append_delimiter:
+        processors.append({
+            'Type': 'AppendDelimiterToRecord',
+            'Parameters': []
+        })
+    return {
+        'Enabled': True,
+        'Processors': processors
+    }
+
+
+def data_format_conversion_configuration(output_format, catalog_id, region, database_name, table_name, role_arn):
+    if output_format == STORAGE_FORMAT_PARQUET:
+        serializer = {'ParquetSerDe': {'Compression': 'SNAPPY'}}
+    else:
+        serializer = {'OrcSerDe': {'Compression': 'SNAPPY'}}
+    return {
+        'Enabled': True,
+        'InputFormatConfiguration': {
+            # CaseInsensitive is the default, but CDK drops empty objects from overrides and Firehose
+            # requires the InputFormatConfiguration
+            'Deserializer': {'OpenXJsonSerDe': {'CaseInsensitive': True}}
+        },
+        'OutputFormatConfiguration': {
+            'Serializer': serializer
+        },
+        'SchemaConfiguration': {
+            'CatalogId': catalog_id,
+            'DatabaseName': database_name,
+            'TableName': table_name,
+            'Region': region,
+            'RoleARN': role_arn,
+            'VersionId': 'LATEST'
+        }
+    }
+
+
+def metric_stream_include_filter(metric_name_include, metric_name_exclude):
+    # A metric stream only filters on exact names, prefixes ('glue.error.*') are left to the Lambda function.
+    # Exclude filters cannot be combined with include filters, so the exclude list only narrows the include list.
+    if not metric_name_include or any(name.endswith("*") for name in metric_name_include):
+        return cloudwatch.CfnMetricStream.MetricStreamFilterProperty(namespace="Glue")
+    metric_names = [name for name in metric_name_include if not metric_name_excluded(name, metric_name_exclude)]
+    if not metric_names:
+        # An empty list of metric names streams the whole namespace instead of nothing
+        raise ValueError("metric_name_exclude excludes every name of metric_name_include")
+    return cloudwatch.CfnMetricStream.MetricStreamFilterProperty(namespace="Glue", metric_names=metric_names)
+
+
+def metric_name_excluded(metric_name, metric_name_exclude):
+    return any(
+        metric_name.startswith(name[:-1]) if name.endswith("*") else metric_name == name
+        for name in metric_name_exclude
+    )
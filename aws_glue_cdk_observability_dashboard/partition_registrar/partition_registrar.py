@@ -0,0 +1,105 @@
+import json
+import os
+import re
+from urllib.parse import unquote_plus
+
+DATABASE_NAME = os.environ.get("DATABASE_NAME", "")
+TABLE_NAME = os.environ.get("TABLE_NAME", "")
+KNOWN_PARTITIONS_CACHE_SIZE = int(os.environ.get("KNOWN_PARTITIONS_CACHE_SIZE", "100000"))
+
+# Ordered partition keys of the data/ prefix, set from the partition_scheme config by CatalogStack
+PARTITION_KEYS = json.loads(os.environ.get("PARTITION_SCHEME") or
+                            '["account_id", "region", "year", "month", "day", "hour"]')
+PARTITION_VALUE_PATTERNS = {
+    "year": r"\d{4}",
+    "month": r"\d{2}",
+    "day": r"\d{2}",
+    "hour": r"\d{2}",
+    "dt": r"\d{4}-\d{2}-\d{2}",
+    "dthour": r"\d{4}-\d{2}-\d{2}-\d{2}",
+}
+
+
+def partition_path_pattern(partition_keys):
+    return re.compile(r"^.*?" + "".join(
+        f"{key}=(?P<{key}>{PARTITION_VALUE_PATTERNS.get(key, '[^/]+')})/" for key in partition_keys
+    ))
+
+
+PARTITION_PATH_PATTERN = partition_path_pattern(PARTITION_KEYS)
+
+# BatchCreatePartition accepts up to 100 partitions per call
+BATCH_CREATE_PARTITION_MAX = 100
+
+# Partitions registered or found in the catalog by this execution environment
+known_partitions = set()
+table_storage_descriptor = None
+glue_client = None
+
+
+def get_glue_client():
+    global glue_client
+    if glue_client is None:
+        import boto3
+        glue_client = boto3.client("glue")
+    return glue_client
+
+
+def object_partition(bucket, key):
+    """(partition values, partition location) of an object key, or None when the key is outside the layout."""
+    match = PARTITION_PATH_PATTERN.match(unquote_plus(key))
+    if match is None:
+        return None
+    return tuple(match.group(name) for name in PARTITION_KEYS), f"s3://{bucket}/{match.group(0)}"
+
+
+def partition_input(storage_descriptor, values, location):
+    return {
+        "Values": list(values),
+        "StorageDescriptor": {**storage_descriptor, "Location": location}
+    }
+
+
+def register_partitions(client, database_name, table_name, partitions):
+    """Create the partitions that are not known yet, partitions is {values: location}. Returns the created count."""
+    global table_storage_descriptor
+    new_partitions = {values: location for values, location in partitions.items() if values not in known_partitions}
+    if not new_partitions:
+        return 0
+    if table_storage_descriptor is None:
+        table_storage_descriptor = client.get_table(DatabaseName=database_name, Name=table_name)["Table"]["StorageDescriptor"]
+
+    created = 0
+    values_list = list(new_partitions)
+    for start in range(0, len(values_list), BATCH_CREATE_PARTITION_MAX):
+        batch = values_list[start:start + BATCH_CREATE_PARTITION_MAX]
+        response = client.batch_create_partition(
+            DatabaseName=database_name,
+            TableName=table_name,
+            PartitionInputList=[partition_input(table_storage_descriptor, values, new_partitions[values]) for values in batch]
+        )
+        failed = set()
+        for error in response.get("Errors", []):
+            if error["ErrorDetail"]["ErrorCode"] != "AlreadyExistsException":
+                # Let Lambda retry the event, the partitions created so far are already known
+                raise RuntimeError(f"Failed to register partition {error['PartitionValues']}: {error['ErrorDetail']}")
+            failed.add(tuple(error["PartitionValues"]))
+        created += len(batch) - len(failed)
+        if len(known_partitions) + len(batch) > KNOWN_PARTITIONS_CACHE_SIZE:
+            known_partitions.clear()
+        known_partitions.update(batch)
+    return created
+
+
+def lambda_handler(event, context):
+    partitions = {}
+    for record in event.get("Records", []):
+        s3_record = record["s3"]
+        partition = object_partition(s3_record["bucket"]["name"], s3_record["object"]["key"])
+        if partition is not None:
+            values, location = partition
+            partitions[values] = location
+
+    created = register_partitions(get_glue_client(), DATABASE_NAME, TABLE_NAME, partitions)
+    print(f"Registered {created} new partitions of {len(partitions)} partitions in {len(event.get('Records', []))} records")
+    return {"partitions": len(partitions), "created": created}
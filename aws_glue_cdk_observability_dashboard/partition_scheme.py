@@ -0,0 +1,97 @@
+from typing import Dict, List
+
+DEFAULT_PARTITION_SCHEME = ["account_id", "region", "year", "month", "day", "hour"]
+
+# Keys read from the metric record, jobname is the JobName dimension and metric_family is looked up
+# from the metric name in the metric_families config
+RECORD_PARTITION_KEYS = ["account_id", "region", "jobname", "metric_family"]
+
+# Family of the metrics that match no family of metric_families
+OTHER_METRIC_FAMILY = "other"
+
+# Keys computed from the metric timestamp in UTC, the Lambda function uses the same formats
+TIME_PARTITION_FORMATS = {
+    "year": "%Y",
+    "month": "%m",
+    "day": "%d",
+    "hour": "%H",
+    "dt": "%Y-%m-%d",
+    "dthour": "%Y-%m-%d-%H",
+}
+
+# Supported sets of time keys, from the hourly to the daily layouts
+TIME_PARTITION_KEY_SETS = [
+    {"year", "month", "day", "hour"},
+    {"year", "month", "day"},
+    {"dt", "hour"},
+    {"dt"},
+    {"dthour"},
+]
+
+
+def partition_scheme(config: Dict) -> List[str]:
+    """Validated list of the partition keys of the data/ prefix, in prefix order."""
+    scheme = list(config.get("partition_scheme") or DEFAULT_PARTITION_SCHEME)
+    unknown_keys = [key for key in scheme if key not in RECORD_PARTITION_KEYS and key not in TIME_PARTITION_FORMATS]
+    if unknown_keys:
+        raise ValueError(f"Unsupported partition_scheme keys: {unknown_keys}")
+    if len(set(scheme)) != len(scheme):
+        raise ValueError(f"Duplicate partition_scheme keys: {scheme}")
+    # account_id and region are removed from the records, so they must stay in the path
+    if "account_id" not in scheme or "region" not in scheme:
+        raise ValueError("partition_scheme must contain account_id and region")
+    time_keys = {key for key in scheme if key in TIME_PARTITION_FORMATS}
+    if time_keys not in TIME_PARTITION_KEY_SETS:
+        raise ValueError(f"Unsupported partition_scheme time keys: {sorted(time_keys)}")
+    return scheme
+
+
+def metric_families(config: Dict) -> Dict[str, List[str]]:
+    """Validated family -> metric names mapping, names ending with '*' are prefixes."""
+    families = config.get("metric_families") or {}
+    for family, metric_names in families.items():
+        if family == OTHER_METRIC_FAMILY or not family.replace("_", "").isalnum():
+            raise ValueError(f"Unsupported metric_families family name: {family}")
+        if not metric_names or not all(isinstance(name, str) and name and "'" not in name for name in metric_names):
+            raise ValueError(f"metric_families {family} must list metric names")
+    return families
+
+
+def metric_family_expression(families: Dict[str, List[str]]) -> str:
+    """Athena expression of the family of a row, for tables that are not partitioned by metric_family."""
+    if not families:
+        return f"'{OTHER_METRIC_FAMILY}'"
+    conditions = []
+    for family, metric_names in families.items():
+        matches = [
+            f"substr(metric_name, 1, {len(name) - 1}) = '{name[:-1]}'" if name.endswith("*") else f"metric_name = '{name}'"
+            for name in metric_names
+        ]
+        conditions.append(f"WHEN {' OR '.join(matches)} THEN '{family}'")
+    return f"CASE {' '.join(conditions)} ELSE '{OTHER_METRIC_FAMILY}' END"
+
+
+def partition_path_template(scheme: List[str], value_template: str) -> str:
+    """Partition path where each value is value_template formatted with the key, e.g. "${{{key}}}"."""
+    return "/".join(f"{key}={value_template.format(key=key)}" for key in scheme) + "/"
+
+
+def day_expression(scheme: List[str]) -> str:
+    """Athena expression of the 'YYYY-MM-DD' day of a row that only references partition columns."""
+    if "dt" in scheme:
+        return "dt"
+    if "dthour" in scheme:
+        return "substr(dthour, 1, 10)"
+    return "concat(year, '-', month, '-', day)"
+
+
+def time_column_expressions(scheme: List[str]) -> Dict[str, str]:
+    """Athena expressions of the year/month/day/hour columns of the data set for any scheme."""
+    expressions = {}
+    for key in ["year", "month", "day", "hour"]:
+        if key in scheme:
+            expressions[key] = key
+        else:
+            # Athena date_format uses MySQL specifiers, %H is the hour of the day like in strftime
+            expressions[key] = f"date_format(from_unixtime(timestamp / 1000), '{TIME_PARTITION_FORMATS[key]}')"
+    return expressions
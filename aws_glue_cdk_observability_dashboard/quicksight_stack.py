@@ -7,8 +7,24 @@ from aws_cdk import (
 )
 from constructs import Construct
 
+from aws_glue_cdk_observability_dashboard.rollup_stack import WIDE_METRIC_COLUMNS
+
+from aws_glue_cdk_observability_dashboard.partition_scheme import (
+    OTHER_METRIC_FAMILY,
+    day_expression,
+    metric_families,
+    metric_family_expression,
+    partition_scheme,
+    time_column_expressions,
+)
+
+DATASET_GRANULARITY_RAW = "raw"
+DATASET_GRANULARITY_HOURLY = "hourly"
+DATASET_GRANULARITY_DAILY = "daily"
+
 SHEET_ID_MONITORING = "MONITORING_SHEET"
 SHEET_ID_INSIGHTS = "INSIGHTS_SHEET"
+SHEET_ID_JOB_RUNS = "JOB_RUNS_SHEET"
 VISUAL_ID_JOB_RUN_ERRORS_BREAKDOWN = "JOB_RUN_ERRORS_BREAKDOWN_VISUAL"
 VISUAL_ID_JOB_RUN_ERRORS = "JOB_RUN_ERRORS_VISUAL"
 VISUAL_ID_SKEWNESS_JOB = "SKEWNESS_JOB_VISUAL"
@@ -29,6 +45,31 @@ VISUAL_ID_TOP_RANKED_SKEWNESS_JOB = "TOP_RANKED_SKEWNESS_JOB_INSIGHT"
 VISUAL_ID_FORECAST_WORKER_UTILIZATION = "FORECAST_WORKER_UTILIZATION_INSIGHT"
 VISUAL_ID_TOP_MOVER_THROUGHPUT_READ = "TOP_MOVER_THROUGHPUT_READ_INSIGHT"
 
+VISUAL_ID_WIDE_JOB_RUN_ERRORS = "WIDE_JOB_RUN_ERRORS_VISUAL"
+VISUAL_ID_WIDE_DRIVER_OOM_COUNT = "WIDE_DRIVER_OOM_COUNT_VISUAL"
+VISUAL_ID_WIDE_EXECUTOR_OOM_COUNT = "WIDE_EXECUTOR_OOM_COUNT_VISUAL"
+
+WIDE_DATASET_IDENTIFIER = "observability_demo.metrics_wide"
+
+# Line charts of the job runs sheet: (visual id, title, [(wide table column, aggregation)])
+WIDE_LINE_CHART_VISUALS = [
+    ("WIDE_SKEWNESS_JOB_VISUAL", "[Performance] Skewness Job", [
+        ("skewness_job_max", "MAX"), ("skewness_job_avg", "AVERAGE"), ("skewness_job_min", "MIN")]),
+    ("WIDE_WORKER_UTILIZATION_VISUAL", "[Resource Utilization] Worker Utilization", [
+        ("worker_utilization_max", "MAX"), ("worker_utilization_avg", "AVERAGE"), ("worker_utilization_min", "MIN")]),
+    ("WIDE_THROUGHPUT_READ_VISUAL", "[Throughput] BytesRead, RecordsRead, FilesRead, PartitionsRead (Avg)", [
+        ("bytes_read_avg", "AVERAGE"), ("records_read_avg", "AVERAGE"), ("files_read_avg", "AVERAGE"),
+        ("partitions_read_avg", "AVERAGE")]),
+    ("WIDE_THROUGHPUT_WRITE_VISUAL", "[Throughput] BytesWritten, RecordsWritten, FilesWritten (Avg)", [
+        ("bytes_written_avg", "AVERAGE"), ("records_written_avg", "AVERAGE"), ("files_written_avg", "AVERAGE")]),
+    ("WIDE_DISK_AVAILABLE_VISUAL", "[Resource Utilization] Disk Available GB (Min)", [
+        ("driver_disk_available_gb_min", "MIN"), ("executor_disk_available_gb_min", "MIN")]),
+    ("WIDE_DISK_USED_VISUAL", "[Resource Utilization] Max Disk Used % (Max)", [
+        ("driver_disk_used_percentage_max", "MAX"), ("executor_disk_used_percentage_max", "MAX")]),
+    ("WIDE_HEAP_MEMORY_VISUAL", "[OOM] Max Heap Memory Used % (Max)", [
+        ("driver_heap_used_percentage_max", "MAX"), ("executor_heap_used_percentage_max", "MAX")]),
+]
+
 COLUMN_ID_ANY = "ANY-COLUMN"
 COLUMN_ID_DATE = "DATE-COLUMN"
 
@@ -99,13 +140,14 @@ class QuickSightStack(Stack):
                 "0986fb70-0481-4065-b80c-5247b01b7524": quicksight.CfnDataSet.PhysicalTableProperty(
                     custom_sql=quicksight.CfnDataSet.CustomSqlProperty(
                         data_source_arn=quicksight_datasource.attr_arn,
-                        sql_query=f"SELECT account_id, region, namespace, metric_name, dimensions.jobname, dimensions.jobrunid, dimensions.type, dimensions.source, dimensions.sink, dimensions.observabilitygroup, timestamp, value.max, value.min, value.sum, value.count, unit, year, month, day, hour FROM \"{config['glue_database_name']}\".\"{config['glue_table_name']}\"",
+                        sql_query=dataset_sql_query(config),
                         name="observability_demo.metrics_data",
                         columns=[
                             quicksight.CfnDataSet.InputColumnProperty(name="account_id", type="STRING"),
                             quicksight.CfnDataSet.InputColumnProperty(name="region", type="STRING"),
                             quicksight.CfnDataSet.InputColumnProperty(name="namespace", type="STRING"),
                             quicksight.CfnDataSet.InputColumnProperty(name="metric_name", type="STRING"),
+                            quicksight.CfnDataSet.InputColumnProperty(name="metric_family", type="STRING"),
                             quicksight.CfnDataSet.InputColumnProperty(name="jobname", type="STRING"),
                             quicksight.CfnDataSet.InputColumnProperty(name="jobrunid", type="STRING"),
                             quicksight.CfnDataSet.InputColumnProperty(name="type", type="STRING"),
@@ -121,7 +163,8 @@ class QuickSightStack(Stack):
                             quicksight.CfnDataSet.InputColumnProperty(name="year", type="STRING"),
                             quicksight.CfnDataSet.InputColumnProperty(name="month", type="STRING"),
                             quicksight.CfnDataSet.InputColumnProperty(name="day", type="STRING"),
-                            quicksight.CfnDataSet.InputColumnProperty(name="hour", type="STRING")
+                            quicksight.CfnDataSet.InputColumnProperty(name="hour", type="STRING"),
+                            quicksight.CfnDataSet.InputColumnProperty(name="event_time", type="DATETIME")
                         ]
                     )
                 )
@@ -176,7 +219,8 @@ class QuickSightStack(Stack):
                                     "day",
                                     "hour",
                                     "avg",
-                                    "date"
+                                    "date",
+                                    "event_time"
                                 ]
                             )
                         )
@@ -185,9 +229,11 @@ class QuickSightStack(Stack):
                         physical_table_id="0986fb70-0481-4065-b80c-5247b01b7524"
                     )
                 )
-            }
+            },
+            data_set_refresh_properties=dataset_refresh_properties(config)
         )
 
+        refresh_time_zone = config.get("quicksight_refresh_time_zone", "America/Los_Angeles")
         quicksight_refresh_schedule = quicksight.CfnRefreshSchedule(
             self,
             "ObservabilityRefreshSchedule",
@@ -196,14 +242,164 @@ class QuickSightStack(Stack):
             schedule=quicksight.CfnRefreshSchedule.RefreshScheduleMapProperty(
                 schedule_id="observability_refresh_schedule",
                 refresh_type="FULL_REFRESH",
-                schedule_frequency=quicksight.CfnRefreshSchedule.ScheduleFrequencyProperty(
-                    interval="HOURLY",
-                    time_zone="America/Los_Angeles"
+                schedule_frequency=refresh_schedule_frequency(
+                    interval=full_refresh_interval(config),
+                    time_of_the_day=config.get("quicksight_full_refresh_time_of_day"),
+                    time_zone=refresh_time_zone
                 )
             )
         )
         quicksight_refresh_schedule.add_dependency(quicksight_dataset)
 
+        if config.get("quicksight_incremental_refresh_enabled", False):
+            quicksight_incremental_refresh_schedule = quicksight.CfnRefreshSchedule(
+                self,
+                "ObservabilityIncrementalRefreshSchedule",
+                aws_account_id=account_id,
+                data_set_id="observability_dataset",
+                schedule=quicksight.CfnRefreshSchedule.RefreshScheduleMapProperty(
+                    schedule_id="observability_incremental_refresh_schedule",
+                    refresh_type="INCREMENTAL_REFRESH",
+                    schedule_frequency=refresh_schedule_frequency(
+                        interval=config.get("quicksight_incremental_refresh_interval", "HOURLY"),
+                        time_of_the_day=None,
+                        time_zone=refresh_time_zone
+                    )
+                )
+            )
+            quicksight_incremental_refresh_schedule.add_dependency(quicksight_dataset)
+
+        wide_data_set_identifier_declarations = []
+        wide_sheets = []
+        wide_filter_groups = []
+        if config.get("quicksight_wide_sheet_enabled", False):
+            if not (config.get("create_rollup_stack", False) and config.get("rollup_wide_table_enabled", False)):
+                raise ValueError("quicksight_wide_sheet_enabled requires create_rollup_stack and rollup_wide_table_enabled")
+            # Job run visuals read the pivoted table of RollupStack, one row per job run and minute
+            wide_dataset = quicksight.CfnDataSet(
+                self,
+                "ObservabilityWideDataset",
+                data_set_id="observability_wide_dataset",
+                aws_account_id=account_id,
+                name=WIDE_DATASET_IDENTIFIER,
+                import_mode="SPICE",
+                physical_table_map={
+                    "wide": quicksight.CfnDataSet.PhysicalTableProperty(
+                        custom_sql=quicksight.CfnDataSet.CustomSqlProperty(
+                            data_source_arn=quicksight_datasource.attr_arn,
+                            sql_query=wide_dataset_sql_query(config),
+                            name=WIDE_DATASET_IDENTIFIER,
+                            columns=[
+                                quicksight.CfnDataSet.InputColumnProperty(name=name, type="STRING")
+                                for name in ["account_id", "region", "jobname", "jobrunid"]
+                            ] + [
+                                quicksight.CfnDataSet.InputColumnProperty(name="timestamp", type="INTEGER")
+                            ] + [
+                                quicksight.CfnDataSet.InputColumnProperty(name=column["name"], type="DECIMAL")
+                                for column in WIDE_METRIC_COLUMNS
+                            ] + [
+                                quicksight.CfnDataSet.InputColumnProperty(name="event_time", type="DATETIME")
+                            ]
+                        )
+                    )
+                },
+                logical_table_map={
+                    DATASET_KEY: quicksight.CfnDataSet.LogicalTableProperty(
+                        alias=WIDE_DATASET_IDENTIFIER,
+                        source=quicksight.CfnDataSet.LogicalTableSourceProperty(
+                            physical_table_id="wide"
+                        )
+                    )
+                }
+            )
+            quicksight.CfnRefreshSchedule(
+                self,
+                "ObservabilityWideRefreshSchedule",
+                aws_account_id=account_id,
+                data_set_id="observability_wide_dataset",
+                schedule=quicksight.CfnRefreshSchedule.RefreshScheduleMapProperty(
+                    schedule_id="observability_wide_refresh_schedule",
+                    refresh_type="FULL_REFRESH",
+                    schedule_frequency=refresh_schedule_frequency(
+                        # The wide table gets a new hour after each rollup run, whatever the cadence of the main data set
+                        interval=config.get("quicksight_wide_refresh_interval", "HOURLY"),
+                        time_of_the_day=config.get("quicksight_wide_refresh_time_of_day"),
+                        time_zone=refresh_time_zone
+                    )
+                )
+            ).add_dependency(wide_dataset)
+
+            wide_data_set_identifier_declarations.append(
+                quicksight.CfnAnalysis.DataSetIdentifierDeclarationProperty(
+                    data_set_arn=wide_dataset.attr_arn,
+                    identifier=WIDE_DATASET_IDENTIFIER
+                )
+            )
+            # Each column already holds a single metric, so the visuals need no metric name filter
+            wide_sheets.append(quicksight.CfnAnalysis.SheetDefinitionProperty(
+                sheet_id=SHEET_ID_JOB_RUNS,
+                name="Job Runs",
+                parameter_controls=parameter_controls_for_sheet(SHEET_ID_JOB_RUNS, with_source_and_sink=False),
+                visuals=[
+                    kpi_visual_for_metric(
+                        visual_id=VISUAL_ID_WIDE_JOB_RUN_ERRORS,
+                        visual_title="<visual-title>[Reliability] Job Run Errors (Total)</visual-title>",
+                        column_name="job_run_errors_count",
+                        value_statistics="SUM",
+                        data_set_identifier=WIDE_DATASET_IDENTIFIER,
+                        date_column_name="event_time"
+                    ),
+                    kpi_visual_for_metric(
+                        visual_id=VISUAL_ID_WIDE_DRIVER_OOM_COUNT,
+                        visual_title="<visual-title>[Driver OOM] OOM Error Count</visual-title>",
+                        column_name="driver_oom_count",
+                        value_statistics="SUM",
+                        data_set_identifier=WIDE_DATASET_IDENTIFIER,
+                        date_column_name="event_time"
+                    ),
+                    kpi_visual_for_metric(
+                        visual_id=VISUAL_ID_WIDE_EXECUTOR_OOM_COUNT,
+                        visual_title="<visual-title>[Executor OOM] OOM Error Count</visual-title>",
+                        column_name="executor_oom_count",
+                        value_statistics="SUM",
+                        data_set_identifier=WIDE_DATASET_IDENTIFIER,
+                        date_column_name="event_time"
+                    ),
+                ] + [
+                    line_chart_visual_for_columns(
+                        visual_id=visual_id,
+                        visual_title=f"<visual-title>{visual_title}</visual-title>",
+                        data_set_identifier=WIDE_DATASET_IDENTIFIER,
+                        measures=measures
+                    )
+                    for visual_id, visual_title, measures in WIDE_LINE_CHART_VISUALS
+                ]
+            ))
+            wide_filter_groups.append(filter_group_for_metrics_with_param_all_visuals_date(
+                filter_group_id=f"{FILTER_GROUP_ID_DATE_PARAM}-wide",
+                filter_id=f"{FILTER_GROUP_ID_DATE_PARAM}-wide-filter",
+                column_name="event_time",
+                parameter_name_start="StartTime",
+                parameter_name_end="EndTime",
+                sheet_id=SHEET_ID_JOB_RUNS,
+                data_set_identifier=WIDE_DATASET_IDENTIFIER
+            ))
+            for filter_group_id, column_name, parameter_name in [
+                (FILTER_GROUP_ID_REGION_PARAM, "region", "Region"),
+                (FILTER_GROUP_ID_ACCOUNT_PARAM, "account_id", "Account"),
+                (FILTER_GROUP_ID_JOBNAME_PARAM, "jobname", "JobName"),
+                (FILTER_GROUP_ID_JOBRUN_ID_PARAM, "jobrunid", "JobRunId"),
+            ]:
+                wide_filter_groups.append(filter_group_for_metrics_with_param_all_visuals(
+                    filter_group_id=f"{filter_group_id}-wide",
+                    filter_id=f"{filter_group_id}-wide-filter",
+                    column_name=column_name,
+                    match_operator="EQUALS",
+                    parameter_name=parameter_name,
+                    sheet_id=SHEET_ID_JOB_RUNS,
+                    data_set_identifier=WIDE_DATASET_IDENTIFIER
+                ))
+
         sheet_monitoring = quicksight.CfnAnalysis.SheetDefinitionProperty(
             sheet_id=SHEET_ID_MONITORING,
             name="Monitoring",
@@ -344,11 +540,11 @@ class QuickSightStack(Stack):
                     data_set_arn=quicksight_dataset.attr_arn,
                     identifier="observability_demo.metrics_data"
                 )
-            ],
+            ] + wide_data_set_identifier_declarations,
             sheets=[
                 sheet_monitoring,
                 sheet_insights
-            ],
+            ] + wide_sheets,
             parameter_declarations=[
                 quicksight.CfnAnalysis.ParameterDeclarationProperty(
                     string_parameter_declaration=quicksight.CfnAnalysis.StringParameterDeclarationProperty(
@@ -650,7 +846,7 @@ class QuickSightStack(Stack):
                         VISUAL_ID_TOP_RANKED_SKEWNESS_JOB
                     ]
                 ),
-            ]
+            ] + wide_filter_groups
         )
         analysis = quicksight.CfnAnalysis(
             self,
@@ -662,8 +858,104 @@ class QuickSightStack(Stack):
         )
 
 
-def parameter_controls_for_sheet(sheet_id):
-    return [
+def dataset_sql_query(config):
+    granularity = config.get("quicksight_dataset_granularity", DATASET_GRANULARITY_RAW)
+    # The rollup tables always have year/month/day partitions
+    day_column = "concat(year, '-', month, '-', day)"
+    family_column = metric_family_expression(metric_families(config))
+    if granularity == DATASET_GRANULARITY_RAW:
+        scheme = partition_scheme(config)
+        # The dataset keeps year/month/day/hour columns whatever the partition keys of the table are
+        time_columns = ", ".join(
+            expression if expression == key else f"{expression} AS {key}"
+            for key, expression in time_column_expressions(scheme).items()
+        )
+        day_column = day_expression(scheme)
+        if "metric_family" in scheme:
+            family_column = "metric_family"
+        sql_query = f"SELECT account_id, region, namespace, metric_name, {metric_family_column(family_column)}, dimensions.jobname, dimensions.jobrunid, dimensions.type, dimensions.source, dimensions.sink, dimensions.observabilitygroup, timestamp, value.max, value.min, value.sum, value.count, unit, {time_columns}, from_unixtime(timestamp / 1000) AS event_time FROM \"{config['glue_database_name']}\".\"{config['glue_table_name']}\""
+    elif granularity in (DATASET_GRANULARITY_HOURLY, DATASET_GRANULARITY_DAILY):
+        # The rollup tables of RollupStack already have flat columns with the same names
+        table_name = config.get(f"glue_{granularity}_table_name", f"metric_data_{granularity}")
+        sql_query = f"SELECT account_id, region, namespace, metric_name, {metric_family_column(family_column)}, jobname, jobrunid, type, source, sink, observabilitygroup, timestamp, max, min, sum, count, unit, year, month, day, hour, from_unixtime(timestamp / 1000) AS event_time FROM \"{config['glue_database_name']}\".\"{table_name}\""
+    else:
+        raise ValueError(f"Unsupported quicksight_dataset_granularity: {granularity}")
+
+    # The predicates only reference partition columns when possible, so Athena prunes the other partitions instead of scanning them
+    predicates = []
+    retention_days = config.get("quicksight_dataset_retention_days")
+    if retention_days:
+        predicates.append(f"{day_column} >= date_format(date_add('day', -{int(retention_days)}, current_date), '%Y-%m-%d')")
+    dataset_families = config.get("quicksight_dataset_metric_families") or []
+    unknown_families = [family for family in dataset_families
+                        if family not in metric_families(config) and family != OTHER_METRIC_FAMILY]
+    if unknown_families:
+        raise ValueError(f"Unknown quicksight_dataset_metric_families: {unknown_families}")
+    if dataset_families:
+        family_values = ", ".join(f"'{family}'" for family in dataset_families)
+        predicates.append(f"{family_column} IN ({family_values})")
+    if predicates:
+        sql_query += " WHERE " + " AND ".join(predicates)
+    return sql_query
+
+
+def wide_dataset_sql_query(config):
+    metric_columns = ", ".join(column["name"] for column in WIDE_METRIC_COLUMNS)
+    sql_query = f"SELECT account_id, region, jobname, jobrunid, timestamp, {metric_columns}, from_unixtime(timestamp / 1000) AS event_time FROM \"{config['glue_database_name']}\".\"{config.get('glue_wide_table_name', 'metric_data_wide')}\""
+    retention_days = config.get("quicksight_dataset_retention_days")
+    if retention_days:
+        sql_query += f" WHERE concat(year, '-', month, '-', day) >= date_format(date_add('day', -{int(retention_days)}, current_date), '%Y-%m-%d')"
+    return sql_query
+
+
+def metric_family_column(expression):
+    return expression if expression == "metric_family" else f"{expression} AS metric_family"
+
+
+def dataset_refresh_properties(config):
+    if not config.get("quicksight_incremental_refresh_enabled", False):
+        return None
+    # Each incremental refresh re-imports only the rows whose event_time falls in the look-back window
+    return quicksight.CfnDataSet.DataSetRefreshPropertiesProperty(
+        refresh_configuration=quicksight.CfnDataSet.RefreshConfigurationProperty(
+            incremental_refresh=quicksight.CfnDataSet.IncrementalRefreshProperty(
+                lookback_window=quicksight.CfnDataSet.LookbackWindowProperty(
+                    column_name="event_time",
+                    size=config.get("quicksight_incremental_refresh_lookback_window_size", 6),
+                    size_unit=config.get("quicksight_incremental_refresh_lookback_window_unit", "HOUR")
+                )
+            )
+        )
+    )
+
+
+def full_refresh_interval(config):
+    interval = config.get("quicksight_full_refresh_interval")
+    if interval:
+        return interval
+    # With incremental refresh the full refresh only compacts the data set, so it runs once a day
+    return "DAILY" if config.get("quicksight_incremental_refresh_enabled", False) else "HOURLY"
+
+
+def refresh_schedule_frequency(interval, time_of_the_day, time_zone):
+    if interval in ("MINUTE15", "MINUTE30", "HOURLY"):
+        # The time of the day only applies to daily and longer intervals
+        time_of_the_day = None
+    refresh_on_day = None
+    if interval == "WEEKLY":
+        refresh_on_day = quicksight.CfnRefreshSchedule.RefreshOnDayProperty(day_of_week="SUNDAY")
+    elif interval == "MONTHLY":
+        refresh_on_day = quicksight.CfnRefreshSchedule.RefreshOnDayProperty(day_of_month="1")
+    return quicksight.CfnRefreshSchedule.ScheduleFrequencyProperty(
+        interval=interval,
+        time_of_the_day=time_of_the_day,
+        refresh_on_day=refresh_on_day,
+        time_zone=time_zone
+    )
+
+
+def parameter_controls_for_sheet(sheet_id, with_source_and_sink=True):
+    controls = [
         quicksight.CfnAnalysis.ParameterControlProperty(
             dropdown=quicksight.CfnAnalysis.ParameterDropDownControlProperty(
                 parameter_control_id=sheet_id+"-Region",
@@ -779,6 +1071,11 @@ def parameter_controls_for_sheet(sheet_id):
             )
         ),
     ]
+    if not with_source_and_sink:
+        # Source and Sink only filter the metrics_data data set
+        controls = [control for control in controls
+                    if control.dropdown is None or control.dropdown.source_parameter_name not in ("Source", "Sink")]
+    return controls
 
 def pie_chart_visual_for_metric(visual_id, visual_title, column_name, value_statistics):
     return quicksight.CfnAnalysis.VisualProperty(
@@ -961,6 +1258,79 @@ def line_chart_visual_for_metric(visual_id, visual_title, column_name, color_col
     )
 
 
+def line_chart_visual_for_columns(visual_id, visual_title, data_set_identifier, measures):
+    """Line chart with one line per (column, aggregation) of measures, for data sets with one column per metric."""
+    return quicksight.CfnAnalysis.VisualProperty(
+        line_chart_visual=quicksight.CfnAnalysis.LineChartVisualProperty(
+            visual_id=visual_id,
+            title=quicksight.CfnAnalysis.VisualTitleLabelOptionsProperty(
+                visibility="VISIBLE",
+                format_text=quicksight.CfnAnalysis.ShortFormatTextProperty(
+                    rich_text=visual_title
+                )
+            ),
+            chart_configuration=quicksight.CfnAnalysis.LineChartConfigurationProperty(
+                field_wells=quicksight.CfnAnalysis.LineChartFieldWellsProperty(
+                    line_chart_aggregated_field_wells=quicksight.CfnAnalysis.LineChartAggregatedFieldWellsProperty(
+                        category=[
+                            quicksight.CfnAnalysis.DimensionFieldProperty(
+                                date_dimension_field=quicksight.CfnAnalysis.DateDimensionFieldProperty(
+                                    field_id=f"{PARAM_KEY}.{FIELD_ID_SUFFIX_DATE}",
+                                    column=quicksight.CfnAnalysis.ColumnIdentifierProperty(
+                                        column_name="event_time",
+                                        data_set_identifier=data_set_identifier
+                                    ),
+                                    date_granularity="HOUR",
+                                    hierarchy_id=f"{PARAM_KEY}.{FIELD_ID_SUFFIX_DATE}"
+                                )
+                            )
+                        ],
+                        values=[
+                            quicksight.CfnAnalysis.MeasureFieldProperty(
+                                numerical_measure_field=quicksight.CfnAnalysis.NumericalMeasureFieldProperty(
+                                    field_id=f"{DATASET_KEY}.{column_name}.{value_statistics}",
+                                    column=quicksight.CfnAnalysis.ColumnIdentifierProperty(
+                                        column_name=column_name,
+                                        data_set_identifier=data_set_identifier
+                                    ),
+                                    aggregation_function=quicksight.CfnAnalysis.NumericalAggregationFunctionProperty(
+                                        simple_numerical_aggregation=value_statistics
+                                    )
+                                )
+                            )
+                            for column_name, value_statistics in measures
+                        ]
+                    )
+                ),
+                sort_configuration=quicksight.CfnAnalysis.LineChartSortConfigurationProperty(
+                    category_sort=[
+                        quicksight.CfnAnalysis.FieldSortOptionsProperty(
+                            field_sort=quicksight.CfnAnalysis.FieldSortProperty(
+                                field_id=f"{PARAM_KEY}.{FIELD_ID_SUFFIX_DATE}",
+                                direction="DESC"
+                            )
+                        )
+                    ],
+                    category_items_limit_configuration=quicksight.CfnAnalysis.ItemsLimitConfigurationProperty(
+                        other_categories="INCLUDE"
+                    )
+                ),
+                type="LINE",
+                data_labels=quicksight.CfnAnalysis.DataLabelOptionsProperty(
+                    visibility="HIDDEN"
+                )
+            ),
+            column_hierarchies=[
+                quicksight.CfnAnalysis.ColumnHierarchyProperty(
+                    date_time_hierarchy=quicksight.CfnAnalysis.DateTimeHierarchyProperty(
+                        hierarchy_id=f"{PARAM_KEY}.{FIELD_ID_SUFFIX_DATE}"
+                    )
+                )
+            ]
+        )
+    )
+
+
 def combo_chart_visual_for_metric(visual_id, visual_title):
     return quicksight.CfnAnalysis.VisualProperty(
         combo_chart_visual=quicksight.CfnAnalysis.ComboChartVisualProperty(
@@ -1171,7 +1541,8 @@ def combo_chart_visual_for_metric_min_max_avg(visual_id, visual_title):
     )
 
 
-def kpi_visual_for_metric(visual_id, visual_title, column_name, value_statistics):
+def kpi_visual_for_metric(visual_id, visual_title, column_name, value_statistics,
+                          data_set_identifier="observability_demo.metrics_data", date_column_name="date"):
     return quicksight.CfnAnalysis.VisualProperty(
         kpi_visual=quicksight.CfnAnalysis.KPIVisualProperty(
             visual_id=visual_id,
@@ -1189,7 +1560,7 @@ def kpi_visual_for_metric(visual_id, visual_title, column_name, value_statistics
                                 field_id=f"{COLUMN_ID_ANY}.{FIELD_ID_SUFFIX_ANY}",
                                 column=quicksight.CfnAnalysis.ColumnIdentifierProperty(
                                     column_name=column_name,
-                                    data_set_identifier="observability_demo.metrics_data"
+                                    data_set_identifier=data_set_identifier
                                 ),
                                 aggregation_function=quicksight.CfnAnalysis.NumericalAggregationFunctionProperty(
                                     simple_numerical_aggregation=value_statistics
@@ -1202,8 +1573,8 @@ def kpi_visual_for_metric(visual_id, visual_title, column_name, value_statistics
                             date_dimension_field=quicksight.CfnAnalysis.DateDimensionFieldProperty(
                                 field_id=f"{PARAM_KEY}.{FIELD_ID_SUFFIX_DATE}",
                                 column=quicksight.CfnAnalysis.ColumnIdentifierProperty(
-                                    column_name="date",
-                                    data_set_identifier="observability_demo.metrics_data"
+                                    column_name=date_column_name,
+                                    data_set_identifier=data_set_identifier
                                 ),
                                 date_granularity="DAY",
                                 hierarchy_id=f"{PARAM_KEY}.{FIELD_ID_SUFFIX_DATE}"
@@ -1507,7 +1878,7 @@ def insight_visual_top_mover_for_metrics(visual_id, visual_title, computation_id
     )
 
 
-def filter_group_for_metrics_with_param_all_visuals_date(filter_group_id, filter_id, column_name, parameter_name_start, parameter_name_end, sheet_id):
+def filter_group_for_metrics_with_param_all_visuals_date(filter_group_id, filter_id, column_name, parameter_name_start, parameter_name_end, sheet_id, data_set_identifier="observability_demo.metrics_data"):
     return quicksight.CfnAnalysis.FilterGroupProperty(
         filter_group_id=filter_group_id,
         filters=[
@@ -1515,7 +1886,7 @@ def filter_group_for_metrics_with_param_all_visuals_date(filter_group_id, filter
                 time_range_filter=quicksight.CfnAnalysis.TimeRangeFilterProperty(
                     filter_id=filter_id,
                     column=quicksight.CfnAnalysis.ColumnIdentifierProperty(
-                        data_set_identifier="observability_demo.metrics_data",
+                        data_set_identifier=data_set_identifier,
                         column_name=column_name
                     ),
                     include_minimum=True,
@@ -1546,7 +1917,7 @@ def filter_group_for_metrics_with_param_all_visuals_date(filter_group_id, filter
     )
 
 
-def filter_group_for_metrics_with_param_all_visuals(filter_group_id, filter_id, column_name, match_operator, parameter_name, sheet_id):
+def filter_group_for_metrics_with_param_all_visuals(filter_group_id, filter_id, column_name, match_operator, parameter_name, sheet_id, data_set_identifier="observability_demo.metrics_data"):
     return quicksight.CfnAnalysis.FilterGroupProperty(
         filter_group_id=filter_group_id,
         filters=[
@@ -1554,7 +1925,7 @@ def filter_group_for_metrics_with_param_all_visuals(filter_group_id, filter_id,
                 category_filter=quicksight.CfnAnalysis.CategoryFilterProperty(
                     filter_id=filter_id,
                     column=quicksight.CfnAnalysis.ColumnIdentifierProperty(
-                        data_set_identifier="observability_demo.metrics_data",
+                        data_set_identifier=data_set_identifier,
                         column_name=column_name
                     ),
                     configuration=quicksight.CfnAnalysis.CategoryFilterConfigurationProperty(
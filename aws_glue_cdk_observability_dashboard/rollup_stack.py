@@ -0,0 +1,272 @@
+import json
+import os
+from typing import Dict
+
+from aws_cdk import (
+    Stack,
+    aws_iam as iam,
+    aws_glue as glue,
+    aws_s3_assets as s3_assets,
+)
+from constructs import Construct
+
+from aws_glue_cdk_observability_dashboard.catalog_stack import (
+    STORAGE_FORMATS,
+    STORAGE_FORMAT_PARQUET,
+)
+from aws_glue_cdk_observability_dashboard.partition_scheme import (
+    DEFAULT_PARTITION_SCHEME,
+    partition_scheme,
+)
+
+ROLLUP_COLUMNS = [
+    {"name": name, "type": "string"}
+    for name in ["account_id", "region", "namespace", "metric_name", "jobname", "jobrunid", "type", "source", "sink",
+                 "observabilitygroup"]
+] + [
+    {"name": "timestamp", "type": "bigint"},
+    {"name": "max", "type": "double"},
+    {"name": "min", "type": "double"},
+    {"name": "sum", "type": "double"},
+    {"name": "count", "type": "double"},
+    {"name": "unit", "type": "string"},
+]
+
+# Metric statistics charted by the dashboard, pivoted into one column each of the wide table
+WIDE_METRIC_COLUMNS = [
+    {"name": name, "metric_name": metric_name, "statistic": statistic}
+    for name, metric_name, statistic in [
+        ("job_run_errors_count", "glue.error.ALL", "count"),
+        ("skewness_job_max", "glue.driver.skewness.job", "max"),
+        ("skewness_job_min", "glue.driver.skewness.job", "min"),
+        ("skewness_job_avg", "glue.driver.skewness.job", "avg"),
+        ("worker_utilization_max", "glue.driver.workerUtilization", "max"),
+        ("worker_utilization_min", "glue.driver.workerUtilization", "min"),
+        ("worker_utilization_avg", "glue.driver.workerUtilization", "avg"),
+        ("bytes_read_avg", "glue.driver.aggregate.bytesRead", "avg"),
+        ("records_read_avg", "glue.driver.aggregate.recordsRead", "avg"),
+        ("files_read_avg", "glue.driver.aggregate.filesRead", "avg"),
+        ("partitions_read_avg", "glue.driver.aggregate.partitionsRead", "avg"),
+        ("bytes_written_avg", "glue.driver.aggregate.bytesWritten", "avg"),
+        ("records_written_avg", "glue.driver.aggregate.recordsWritten", "avg"),
+        ("files_written_avg", "glue.driver.aggregate.filesWritten", "avg"),
+        ("driver_disk_available_gb_min", "glue.driver.disk.available_GB", "min"),
+        ("executor_disk_available_gb_min", "glue.ALL.disk.available_GB", "min"),
+        ("driver_disk_used_percentage_max", "glue.driver.disk.used.percentage", "max"),
+        ("executor_disk_used_percentage_max", "glue.ALL.disk.used.percentage", "max"),
+        ("driver_oom_count", "glue.driver.error.OUT_OF_MEMORY_ERROR", "count"),
+        ("executor_oom_count", "glue.ALL.error.OUT_OF_MEMORY_ERROR", "count"),
+        ("driver_heap_used_percentage_max", "glue.driver.memory.heap.used.percentage", "max"),
+        ("executor_heap_used_percentage_max", "glue.ALL.memory.heap.used.percentage", "max"),
+    ]
+]
+
+WIDE_COLUMNS = [
+    {"name": name, "type": "string"} for name in ["account_id", "region", "jobname", "jobrunid"]
+] + [
+    {"name": "timestamp", "type": "bigint"},
+] + [
+    {"name": column["name"], "type": "double"} for column in WIDE_METRIC_COLUMNS
+]
+
+
+class RollupStack(Stack):
+
+    def __init__(self, scope: Construct, construct_id: str, config: Dict, **kwargs) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        account_id = os.getenv('CDK_DEFAULT_ACCOUNT')
+
+        if partition_scheme(config) != DEFAULT_PARTITION_SCHEME:
+            # The hourly rollup queries select the source partitions by year/month/day/hour
+            raise ValueError("Rollups require the default partition_scheme")
+
+        rollup_prefix = config.get("rollup_prefix", "rollup/").strip("/")
+        hourly_table = rollup_table(
+            self,
+            "HourlyGlueTable",
+            account_id=account_id,
+            database_name=config["glue_database_name"],
+            table_name=config.get("glue_hourly_table_name", "metric_data_hourly"),
+            location=f"s3://{config['s3_bucket_name']}/{rollup_prefix}/hourly/",
+            columns=ROLLUP_COLUMNS,
+            partition_keys=["year", "month", "day", "hour"]
+        )
+        daily_table = rollup_table(
+            self,
+            "DailyGlueTable",
+            account_id=account_id,
+            database_name=config["glue_database_name"],
+            table_name=config.get("glue_daily_table_name", "metric_data_daily"),
+            location=f"s3://{config['s3_bucket_name']}/{rollup_prefix}/daily/",
+            # The day rows keep an hour column so that both tables have the same columns
+            columns=ROLLUP_COLUMNS + [{"name": "hour", "type": "string"}],
+            partition_keys=["year", "month", "day"]
+        )
+        wide_arguments = {}
+        wide_table = None
+        if config.get("rollup_wide_table_enabled", False):
+            wide_table = rollup_table(
+                self,
+                "WideGlueTable",
+                account_id=account_id,
+                database_name=config["glue_database_name"],
+                table_name=config.get("glue_wide_table_name", "metric_data_wide"),
+                location=f"s3://{config['s3_bucket_name']}/{rollup_prefix}/wide/",
+                columns=WIDE_COLUMNS,
+                partition_keys=["year", "month", "day", "hour"]
+            )
+            wide_arguments = {
+                "--wide_table_name": wide_table.table_input.name,
+                "--wide_columns": json.dumps(WIDE_METRIC_COLUMNS),
+                "--wide_retention_days": str(config.get("rollup_wide_retention_days", 35)),
+            }
+        output_location = config.get("rollup_athena_output_location") or \
+            f"s3://{config['s3_bucket_name']}/{rollup_prefix}/athena-results/"
+
+        rollup_script = s3_assets.Asset(
+            self,
+            'RollupScript',
+            path='aws_glue_cdk_observability_dashboard/glue_jobs/rollup_job.py'
+        )
+
+        rollup_role = iam.Role(
+            self,
+            'RollupRole',
+            assumed_by=iam.ServicePrincipal("glue.amazonaws.com")
+        )
+        rollup_role.add_managed_policy(
+            iam.ManagedPolicy.from_aws_managed_policy_name('service-role/AWSGlueServiceRole'))
+        rollup_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=[
+                    'athena:StartQueryExecution',
+                    'athena:GetQueryExecution',
+                ],
+                resources=[
+                    f"arn:aws:athena:{self.region}:{self.account}:workgroup/{config['athena_workgroup_name']}",
+                ],
+            )
+        )
+        rollup_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=[
+                    's3:GetObject',
+                    's3:ListBucket',
+                    's3:GetBucketLocation',
+                ],
+                resources=[
+                    f"arn:aws:s3:::{config['s3_bucket_name']}",
+                    f"arn:aws:s3:::{config['s3_bucket_name']}/*",
+                ],
+            )
+        )
+        rollup_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=[
+                    's3:PutObject',
+                    's3:DeleteObject',
+                    's3:AbortMultipartUpload',
+                ],
+                resources=[
+                    f"arn:aws:s3:::{config['s3_bucket_name']}/{rollup_prefix}/*",
+                ],
+            )
+        )
+        rollup_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=[
+                    'glue:GetDatabase',
+                    'glue:GetTable',
+                    'glue:GetPartition',
+                    'glue:GetPartitions',
+                    'glue:BatchCreatePartition',
+                    'glue:BatchDeletePartition',
+                ],
+                resources=[
+                    f"arn:aws:glue:{self.region}:{self.account}:catalog",
+                    f"arn:aws:glue:{self.region}:{self.account}:database/{config['glue_database_name']}",
+                    f"arn:aws:glue:{self.region}:{self.account}:table/{config['glue_database_name']}/*",
+                ],
+            )
+        )
+        rollup_script.grant_read(rollup_role)
+
+        rollup_job = glue.CfnJob(
+            self,
+            "RollupJob",
+            name=config.get("rollup_job_name", "observability_demo_rollup"),
+            role=rollup_role.role_arn,
+            command=glue.CfnJob.JobCommandProperty(
+                name="pythonshell",
+                python_version="3.9",
+                script_location=rollup_script.s3_object_url
+            ),
+            glue_version="3.0",
+            max_capacity=0.0625,
+            default_arguments={
+                "--database_name": config["glue_database_name"],
+                "--source_table_name": config["glue_table_name"],
+                "--hourly_table_name": hourly_table.table_input.name,
+                "--daily_table_name": daily_table.table_input.name,
+                "--workgroup": config["athena_workgroup_name"],
+                "--output_location": output_location,
+                "--closed_after_minutes": str(config.get("rollup_closed_after_minutes", 90)),
+                "--lookback_hours": str(config.get("rollup_lookback_hours", 6)),
+                "--hourly_retention_days": str(config.get("rollup_hourly_retention_days", 35)),
+                "--daily_retention_days": str(config.get("rollup_daily_retention_days", 400)),
+                **wide_arguments,
+            }
+        )
+        rollup_job.add_dependency(hourly_table)
+        rollup_job.add_dependency(daily_table)
+        if wide_table:
+            rollup_job.add_dependency(wide_table)
+
+        glue.CfnTrigger(
+            self,
+            "RollupTrigger",
+            type="SCHEDULED",
+            schedule=config.get("rollup_cron_schedule", "cron(5 * * * ? *)"),
+            start_on_creation=True,
+            actions=[
+                glue.CfnTrigger.ActionProperty(
+                    job_name=rollup_job.name
+                )
+            ]
+        ).add_dependency(rollup_job)
+
+
+def rollup_table(scope, construct_id, account_id, database_name, table_name, location, columns, partition_keys):
+    storage_format = STORAGE_FORMATS[STORAGE_FORMAT_PARQUET]
+    return glue.CfnTable(
+        scope,
+        construct_id,
+        catalog_id=account_id,
+        database_name=database_name,
+        table_input=glue.CfnTable.TableInputProperty(
+            name=table_name,
+            table_type="EXTERNAL_TABLE",
+            parameters={
+                "classification": STORAGE_FORMAT_PARQUET
+            },
+            storage_descriptor=glue.CfnTable.StorageDescriptorProperty(
+                columns=columns,
+                location=location,
+                input_format=storage_format["input_format"],
+                output_format=storage_format["output_format"],
+                compressed=True,
+                serde_info=glue.CfnTable.SerdeInfoProperty(
+                    serialization_library=storage_format["serialization_library"],
+                    parameters=storage_format["serde_parameters"]
+                ),
+            ),
+            partition_keys=[
+                {
+                    "name": key,
+                    "type": "string"
+                }
+                for key in partition_keys
+            ]
+        )
+    )
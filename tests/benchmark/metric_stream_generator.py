@@ -0,0 +1,121 @@
+import base64
+import itertools
+import json
+import random
+
+GLUE_METRIC_NAMES = [
+    "glue.driver.aggregate.bytesRead",
+    "glue.driver.aggregate.recordsRead",
+    "glue.driver.aggregate.filesRead",
+    "glue.driver.aggregate.partitionsRead",
+    "glue.driver.aggregate.bytesWritten",
+    "glue.driver.aggregate.recordsWritten",
+    "glue.driver.aggregate.filesWritten",
+    "glue.driver.workerUtilization",
+    "glue.driver.skewness.job",
+    "glue.driver.memory.heap.used.percentage",
+    "glue.ALL.memory.heap.used.percentage",
+    "glue.driver.disk.used.percentage",
+    "glue.ALL.disk.available_GB",
+    "glue.error.ALL",
+    "glue.driver.error.OUT_OF_MEMORY_ERROR",
+]
+
+HOUR_MILLIS = 3600 * 1000
+
+
+def metric_stream_lines(job_count=10, runs_per_job=1, metric_names=GLUE_METRIC_NAMES, extra_dimensions=None,
+                        account_ids=("123456789012",), regions=("us-east-1",), start_timestamp=1696154400000,
+                        hours=1, datapoints_per_hour=60, seed=0):
+    """Yield CloudWatch metric stream JSON lines for Glue jobs in the order a metric stream sends them.
+
+    Every job, account and region reports every metric once per datapoint interval. The runs of a job follow
+    each other over the hour span. extra_dimensions maps a dimension name to its number of distinct values,
+    every combination of values is reported separately.
+    """
+    rng = random.Random(seed)
+    interval_millis = HOUR_MILLIS // datapoints_per_hour
+    datapoint_count = hours * datapoints_per_hour
+    extra_dimensions = extra_dimensions or {}
+    extra_dimension_values = list(itertools.product(*[
+        [(name, f"{name.lower()}-{value}") for value in range(value_count)]
+        for name, value_count in extra_dimensions.items()
+    ]))
+    for datapoint in range(datapoint_count):
+        timestamp = start_timestamp + datapoint * interval_millis
+        run = datapoint * runs_per_job // datapoint_count
+        for account_id, region, job in itertools.product(account_ids, regions, range(job_count)):
+            job_dimensions = {
+                "JobName": f"job-{job}",
+                "JobRunId": f"jr_{job:032x}{run:032x}",
+            }
+            for metric_name in metric_names:
+                metric_dimensions = {
+                    **job_dimensions,
+                    "Type": "count" if ".error." in metric_name else "gauge",
+                    "ObservabilityGroup": "throughput" if ".aggregate." in metric_name else "resource_utilization"
+                }
+                for extra_dimension in extra_dimension_values:
+                    count = float(rng.randint(1, 4))
+                    minimum = rng.uniform(0, 100)
+                    maximum = minimum + rng.uniform(0, 100)
+                    yield json.dumps({
+                        "metric_stream_name": "ObservabilityMetricStream",
+                        "account_id": account_id,
+                        "region": region,
+                        "namespace": "Glue",
+                        "metric_name": metric_name,
+                        "dimensions": {**metric_dimensions, **dict(extra_dimension)},
+                        "timestamp": timestamp,
+                        "value": {"max": maximum, "min": minimum, "sum": (minimum + maximum) / 2 * count, "count": count},
+                        "unit": "Bytes" if "bytes" in metric_name else "None"
+                    }, separators=(",", ":"))
+
+
+def firehose_event(lines, record_size_bytes=1024 * 1024, max_batch_bytes=2 * 1024 * 1024):
+    """Pack lines into Firehose records of about record_size_bytes, up to max_batch_bytes per event."""
+    return next(firehose_events(lines, record_size_bytes, max_batch_bytes), firehose_event_of_records([]))
+
+
+def firehose_events(lines, record_size_bytes=1024 * 1024, max_batch_bytes=2 * 1024 * 1024):
+    """Yield the Firehose events of all lines, as Firehose buffers them before invoking the Lambda function."""
+    records = []
+    current = []
+    current_size = 0
+    batch_size = 0
+    for line in lines:
+        if batch_size + len(line) + 1 > max_batch_bytes:
+            if current:
+                records.append(current)
+            yield firehose_event_of_records(records)
+            records = []
+            current = []
+            current_size = 0
+            batch_size = 0
+        current.append(line)
+        current_size += len(line) + 1
+        batch_size += len(line) + 1
+        if current_size >= record_size_bytes:
+            records.append(current)
+            current = []
+            current_size = 0
+    if current:
+        records.append(current)
+    if records:
+        yield firehose_event_of_records(records)
+
+
+def firehose_event_of_records(records):
+    return {
+        "invocationId": "benchmark",
+        "deliveryStreamArn": "arn:aws:firehose:us-east-1:123456789012:deliverystream/benchmark",
+        "region": "us-east-1",
+        "records": [
+            {
+                "recordId": f"record-{i}",
+                "approximateArrivalTimestamp": 1696154400000,
+                "data": base64.b64encode(("\n".join(record) + "\n").encode("utf-8")).decode("utf-8")
+            }
+            for i, record in enumerate(records)
+        ]
+    }
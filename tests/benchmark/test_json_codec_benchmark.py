@@ -0,0 +1,72 @@
+import base64
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "aws_glue_cdk_observability_dashboard", "lambda"))
+
+import firehose_lambda  # noqa: E402
+from tests.benchmark.metric_stream_generator import metric_stream_lines, firehose_event  # noqa: E402
+
+pytestmark = pytest.mark.benchmark
+
+CODECS = [firehose_lambda.JSON_CODEC_STDLIB, firehose_lambda.JSON_CODEC_ORJSON]
+ENCODING_MODES = [firehose_lambda.ENCODING_MODE_JSON, firehose_lambda.ENCODING_MODE_PASSTHROUGH]
+
+
+@pytest.fixture(scope="module")
+def event():
+    return firehose_event(metric_stream_lines())
+
+
+def use_codec(monkeypatch, codec, encoding_mode):
+    if codec == firehose_lambda.JSON_CODEC_ORJSON:
+        pytest.importorskip("orjson")
+    name, loads, dumps = firehose_lambda.load_json_codec(codec)
+    monkeypatch.setattr(firehose_lambda, "json_loads", loads)
+    monkeypatch.setattr(firehose_lambda, "json_dumps", dumps)
+    monkeypatch.setattr(firehose_lambda, "JSON_CODEC_NAME", name)
+    monkeypatch.setattr(firehose_lambda, "TRANSFORM_LINE", {
+        firehose_lambda.ENCODING_MODE_JSON: firehose_lambda.transform_line_json,
+        firehose_lambda.ENCODING_MODE_PASSTHROUGH: firehose_lambda.transform_line_passthrough,
+    }[encoding_mode])
+    monkeypatch.setattr(firehose_lambda, "LOG_LEVEL", firehose_lambda.LOG_LEVEL_OFF)
+
+
+def decoded_rows(output):
+    return [
+        json.loads(line)
+        for record in output["records"]
+        for line in base64.b64decode(record["data"]).splitlines()
+    ]
+
+
+@pytest.mark.parametrize("encoding_mode", ENCODING_MODES)
+@pytest.mark.parametrize("codec", CODECS)
+def test_codec_throughput(monkeypatch, event, codec, encoding_mode):
+    use_codec(monkeypatch, codec, encoding_mode)
+    line_count = sum(base64.b64decode(record["data"]).count(b"\n") for record in event["records"])
+
+    iterations = 3
+    start = time.perf_counter()
+    for _ in range(iterations):
+        output = firehose_lambda.lambda_handler(event, None)
+    elapsed = (time.perf_counter() - start) / iterations
+
+    print(f"\ncodec={codec} encoding_mode={encoding_mode}: {line_count} lines in {elapsed * 1000:.1f} ms "
+          f"({line_count / elapsed:.0f} lines/s)")
+    assert len(decoded_rows(output)) == line_count
+
+
+def test_codecs_produce_the_same_rows(monkeypatch, event):
+    pytest.importorskip("orjson")
+    outputs = []
+    for codec in CODECS:
+        use_codec(monkeypatch, codec, firehose_lambda.ENCODING_MODE_JSON)
+        outputs.append(firehose_lambda.lambda_handler(event, None))
+    assert decoded_rows(outputs[0]) == decoded_rows(outputs[1])
+    assert [record["metadata"] for record in outputs[0]["records"]] == \
+        [record["metadata"] for record in outputs[1]["records"]]
@@ -0,0 +1,117 @@
+import base64
+import os
+import sys
+import time
+import tracemalloc
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "aws_glue_cdk_observability_dashboard", "lambda"))
+
+import firehose_lambda  # noqa: E402
+from tests.benchmark.metric_stream_generator import metric_stream_lines, firehose_event, firehose_events  # noqa: E402
+
+pytestmark = pytest.mark.benchmark
+
+# Generator arguments and Lambda settings of each scenario, every scenario is limited to a few full batches
+SCENARIOS = {
+    "single_partition": ({"job_count": 20}, {}),
+    "many_runs": ({"job_count": 20, "runs_per_job": 6}, {}),
+    "accounts_and_regions": ({"job_count": 5, "account_ids": [f"{i:012d}" for i in range(4)],
+                              "regions": ["us-east-1", "eu-west-1"]}, {}),
+    "hour_span": ({"job_count": 5, "hours": 6, "datapoints_per_hour": 12}, {}),
+    "high_cardinality": ({"job_count": 5, "extra_dimensions": {"Source": 4, "Sink": 3}}, {}),
+    "rollup": ({"job_count": 20}, {"ROLLUP_BUCKET_MILLIS": 300 * 1000}),
+}
+MAX_EVENTS = 3
+# Minimum throughput of lambda_handler on a full 2 MB Firehose batch
+TARGET_LINES_PER_SECOND = 10000
+
+
+class RecordingFirehoseClient:
+
+    def __init__(self):
+        self.payload_bytes = 0
+        self.record_count = 0
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.record_count += len(Records)
+        self.payload_bytes += sum(len(record["Data"]) for record in Records)
+        return {"FailedPutCount": 0, "RequestResponses": [{"RecordId": "id"}] * len(Records)}
+
+
+def scenario_events(generator_arguments):
+    events = []
+    for event in firehose_events(metric_stream_lines(**generator_arguments)):
+        events.append(event)
+        if len(events) == MAX_EVENTS:
+            break
+    return events
+
+
+def run_events(events):
+    client = RecordingFirehoseClient()
+    firehose_lambda.firehose_client = client
+    outputs = [firehose_lambda.lambda_handler(event, None) for event in events]
+    output_payloads = [
+        base64.b64decode(record["data"])
+        for output in outputs
+        for record in output["records"]
+        if record["result"] == "Ok"
+    ]
+    return outputs, output_payloads, client
+
+
+@pytest.mark.parametrize("scenario", SCENARIOS)
+def test_lambda_handler_benchmark(monkeypatch, scenario):
+    generator_arguments, settings = SCENARIOS[scenario]
+    monkeypatch.setattr(firehose_lambda, "LOG_LEVEL", firehose_lambda.LOG_LEVEL_OFF)
+    monkeypatch.setattr(firehose_lambda, "METRICS_NAMESPACE", "")
+    monkeypatch.setattr(firehose_lambda, "firehose_client", None)
+    for name, value in settings.items():
+        monkeypatch.setattr(firehose_lambda, name, value)
+    events = scenario_events(generator_arguments)
+    input_payloads = [base64.b64decode(record["data"]) for event in events for record in event["records"]]
+    record_count = len(input_payloads)
+    line_count = sum(payload.count(b"\n") for payload in input_payloads)
+    input_bytes = sum(len(payload) for payload in input_payloads)
+
+    start = time.perf_counter()
+    outputs, output_payloads, client = run_events(events)
+    elapsed = time.perf_counter() - start
+
+    # Measure memory in a separate run, tracemalloc slows the function down
+    tracemalloc.start()
+    try:
+        run_events(events)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    output_bytes = sum(len(payload) for payload in output_payloads)
+    print(f"\n{scenario}: {len(events)} events, {record_count} records, {line_count} lines, {input_bytes} bytes in "
+          f"in {elapsed * 1000:.1f} ms ({record_count / elapsed:.1f} records/s, {line_count / elapsed:.0f} lines/s), "
+          f"peak memory {peak_bytes / 1024 / 1024:.1f} MiB, {output_bytes} bytes out, "
+          f"{client.record_count} records ({client.payload_bytes} bytes) reingested")
+
+    assert all(record["result"] in ("Ok", "Dropped") for output in outputs for record in output["records"])
+    output_line_count = sum(payload.count(b"\n") for payload in output_payloads)
+    if firehose_lambda.ROLLUP_BUCKET_MILLIS:
+        assert output_line_count < line_count
+    else:
+        assert output_line_count <= line_count
+        assert output_line_count == line_count or client.record_count
+
+
+def test_full_batch_throughput(monkeypatch):
+    monkeypatch.setattr(firehose_lambda, "LOG_LEVEL", firehose_lambda.LOG_LEVEL_OFF)
+    monkeypatch.setattr(firehose_lambda, "METRICS_NAMESPACE", "")
+    event = firehose_event(metric_stream_lines(job_count=20))
+    line_count = sum(base64.b64decode(record["data"]).count(b"\n") for record in event["records"])
+
+    start = time.perf_counter()
+    firehose_lambda.lambda_handler(event, None)
+    elapsed = time.perf_counter() - start
+
+    print(f"\nfull batch: {line_count} lines in {elapsed * 1000:.1f} ms ({line_count / elapsed:.0f} lines/s)")
+    assert line_count / elapsed >= TARGET_LINES_PER_SECOND
@@ -1,15 +1,576 @@
 import aws_cdk as core
 import aws_cdk.assertions as assertions
+import pytest
+import yaml
 
-from aws_glue_cdk_observability_dashboard.quicksight_stack import AwsGlueCdkObservabilityDashboardStack
+from aws_glue_cdk_observability_dashboard.s3_stack import S3Stack
+from aws_glue_cdk_observability_dashboard.metrics_sender_stack import MetricsSenderStack
+from aws_glue_cdk_observability_dashboard.catalog_stack import CatalogStack
+from aws_glue_cdk_observability_dashboard.quicksight_stack import QuickSightStack, dataset_sql_query
+from aws_glue_cdk_observability_dashboard.compaction_stack import CompactionStack
+from aws_glue_cdk_observability_dashboard.rollup_stack import RollupStack
+from aws_glue_cdk_observability_dashboard.partition_scheme import DEFAULT_PARTITION_SCHEME
 
-# example tests. To run these tests, uncomment this file along with the example
-# resource in aws_glue_cdk_observability_dashboard/quicksight_stack.py
-def test_sqs_queue_created():
+
+@pytest.fixture
+def config():
+    with open("./default-config.yaml", 'r', encoding="utf-8") as f:
+        return yaml.load(f, Loader=yaml.SafeLoader)
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    monkeypatch.setenv("CDK_DEFAULT_ACCOUNT", "123456789012")
+    monkeypatch.setenv("CDK_DEFAULT_REGION", "us-east-1")
+
+
+def test_s3_stack_creates_bucket(config):
+    app = core.App()
+    stack = S3Stack(app, "S3Stack", config=config)
+    template = assertions.Template.from_stack(stack)
+
+    template.resource_count_is("AWS::S3::Bucket", 1)
+
+
+def test_metrics_sender_stack_partitions_with_lambda(config):
+    app = core.App()
+    stack = MetricsSenderStack(app, "MetricsSenderStack", config=config)
+    template = assertions.Template.from_stack(stack)
+
+    template.resource_count_is("AWS::Lambda::Function", 1)
+    template.has_resource_properties("AWS::CloudWatch::MetricStream", {
+        "OutputFormat": "json"
+    })
+    template.has_resource_properties("AWS::KinesisFirehose::DeliveryStream", {
+        "ExtendedS3DestinationConfiguration": assertions.Match.object_like({
+            "Prefix": "data/account_id=!{partitionKeyFromLambda:account_id}/region=!{partitionKeyFromLambda:region}/"
+                      "year=!{partitionKeyFromLambda:year}/month=!{partitionKeyFromLambda:month}/"
+                      "day=!{partitionKeyFromLambda:day}/hour=!{partitionKeyFromLambda:hour}/",
+            "DynamicPartitioningConfiguration": {"Enabled": True}
+        })
+    })
+
+
+def test_metrics_sender_stack_inline_mode_has_no_lambda(config):
+    config["firehose_partitioning_mode"] = "inline"
+    app = core.App()
+    stack = MetricsSenderStack(app, "MetricsSenderStack", config=config)
+    template = assertions.Template.from_stack(stack)
+
+    template.resource_count_is("AWS::Lambda::Function", 0)
+    template.has_resource_properties("AWS::KinesisFirehose::DeliveryStream", {
+        "ExtendedS3DestinationConfiguration": assertions.Match.object_like({
+            "Prefix": "data/account_id=!{partitionKeyFromQuery:account_id}/region=!{partitionKeyFromQuery:region}/"
+                      "year=!{partitionKeyFromQuery:year}/month=!{partitionKeyFromQuery:month}/"
+                      "day=!{partitionKeyFromQuery:day}/hour=!{partitionKeyFromQuery:hour}/",
+            "ProcessingConfiguration": {
+                "Enabled": True,
+                "Processors": [
+                    {"Type": "RecordDeAggregation",
+                     "Parameters": [{"ParameterName": "SubRecordType", "ParameterValue": "JSON"}]},
+                    {"Type": "MetadataExtraction",
+                     "Parameters": [
+                         {"ParameterName": "MetadataExtractionQuery",
+                          "ParameterValue": '{account_id:.account_id,region:.region,'
+                                            'year:(.timestamp/1000|floor|strftime("%Y")),'
+                                            'month:(.timestamp/1000|floor|strftime("%m")),'
+                                            'day:(.timestamp/1000|floor|strftime("%d")),'
+                                            'hour:(.timestamp/1000|floor|strftime("%H"))}'},
+                         {"ParameterName": "JsonParsingEngine", "ParameterValue": "JQ-1.6"}
+                     ]},
+                    {"Type": "AppendDelimiterToRecord", "Parameters": []}
+                ]
+            }
+        })
+    })
+
+
+def test_metric_stream_only_sends_included_names_that_are_not_excluded(config):
+    config["metric_name_include"] = ["glue.driver.aggregate.bytesRead", "glue.driver.aggregate.recordsRead",
+                                     "glue.driver.workerUtilization"]
+    config["metric_name_exclude"] = ["glue.driver.aggregate.*"]
+    app = core.App()
+    stack = MetricsSenderStack(app, "MetricsSenderStack", config=config)
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::CloudWatch::MetricStream", {
+        "IncludeFilters": [{"Namespace": "Glue", "MetricNames": ["glue.driver.workerUtilization"]}]
+    })
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Environment": {"Variables": assertions.Match.object_like({
+            "METRIC_NAME_INCLUDE": ",".join(config["metric_name_include"]),
+            "METRIC_NAME_EXCLUDE": "glue.driver.aggregate.*"
+        })}
+    })
+
+    # Prefixes can only be applied by the Lambda function, so the stream sends the whole namespace
+    config["metric_name_include"] = ["glue.driver.*"]
+    template = assertions.Template.from_stack(MetricsSenderStack(core.App(), "MetricsSenderStack", config=config))
+    template.has_resource_properties("AWS::CloudWatch::MetricStream", {
+        "IncludeFilters": [{"Namespace": "Glue"}]
+    })
+
+
+def test_metric_stream_rejects_an_include_list_that_is_fully_excluded(config):
+    config["metric_name_include"] = ["glue.driver.aggregate.bytesRead"]
+    config["metric_name_exclude"] = ["glue.driver.aggregate.*"]
+    with pytest.raises(ValueError, match="metric_name_exclude"):
+        MetricsSenderStack(core.App(), "MetricsSenderStack", config=config)
+
+
+def test_inline_mode_requires_json_metric_stream(config):
+    config["firehose_partitioning_mode"] = "inline"
+    config["metric_stream_output_format"] = "opentelemetry1.0"
+    with pytest.raises(ValueError, match="inline requires metric_stream_output_format json"):
+        MetricsSenderStack(core.App(), "MetricsSenderStack", config=config)
+
+
+def test_catalog_stack_declares_the_partition_keys_of_the_path(config):
+    app = core.App()
+    stack = CatalogStack(app, "CatalogStack", config=config)
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::Glue::Table", {
+        "TableInput": assertions.Match.object_like({
+            "PartitionKeys": [{"Name": key, "Type": "string"} for key in DEFAULT_PARTITION_SCHEME],
+            "StorageDescriptor": assertions.Match.object_like({
+                "Location": "s3://glue-observability-demo-dashboard/data/",
+                "SerdeInfo": {
+                    "SerializationLibrary": "org.openx.data.jsonserde.JsonSerDe",
+                    "Parameters": {"serialization.format": "json"}
+                }
+            })
+        })
+    })
+
+
+@pytest.mark.parametrize("output_format, serializer, serialization_library", [
+    ("parquet", "ParquetSerDe", "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe"),
+    ("orc", "OrcSerDe", "org.apache.hadoop.hive.ql.io.orc.OrcSerde"),
+])
+def test_columnar_output_format_converts_records_with_the_table_schema(config, output_format, serializer,
+                                                                       serialization_library):
+    config["firehose_output_format"] = output_format
+    app = core.App()
+    sender_stack = MetricsSenderStack(app, "MetricsSenderStack", config=config)
+    catalog_stack = CatalogStack(app, "CatalogStack", config=config)
+    sender_template = assertions.Template.from_stack(sender_stack)
+    catalog_template = assertions.Template.from_stack(catalog_stack)
+
+    sender_template.has_resource_properties("AWS::KinesisFirehose::DeliveryStream", {
+        "ExtendedS3DestinationConfiguration": assertions.Match.object_like({
+            "DataFormatConversionConfiguration": assertions.Match.object_like({
+                "Enabled": True,
+                "InputFormatConfiguration": {"Deserializer": {"OpenXJsonSerDe": {"CaseInsensitive": True}}},
+                "OutputFormatConfiguration": {"Serializer": {serializer: {"Compression": "SNAPPY"}}},
+                "SchemaConfiguration": assertions.Match.object_like({
+                    "DatabaseName": config["glue_database_name"],
+                    "TableName": config["glue_table_name"],
+                    "VersionId": "LATEST"
+                })
+            })
+        })
+    })
+    catalog_template.has_resource_properties("AWS::Glue::Table", {
+        "TableInput": assertions.Match.object_like({
+            "Parameters": assertions.Match.object_like({"classification": output_format}),
+            "StorageDescriptor": assertions.Match.object_like({
+                "Compressed": True,
+                "SerdeInfo": assertions.Match.object_like({"SerializationLibrary": serialization_library})
+            })
+        })
+    })
+
+    # Columnar records are written without the JSON delimiter in inline mode
+    config["firehose_partitioning_mode"] = "inline"
+    inline_template = assertions.Template.from_stack(MetricsSenderStack(core.App(), "MetricsSenderStack", config=config))
+    processors = next(iter(inline_template.find_resources("AWS::KinesisFirehose::DeliveryStream").values()))[
+        "Properties"]["ExtendedS3DestinationConfiguration"]["ProcessingConfiguration"]["Processors"]
+    assert [processor["Type"] for processor in processors] == ["RecordDeAggregation", "MetadataExtraction"]
+
+
+def test_unsupported_output_format_is_rejected(config):
+    config["firehose_output_format"] = "avro"
+    with pytest.raises(ValueError, match="firehose_output_format"):
+        MetricsSenderStack(core.App(), "MetricsSenderStack", config=config)
+
+
+def test_catalog_stack_creates_table_and_crawler(config):
+    app = core.App()
+    stack = CatalogStack(app, "CatalogStack", config=config)
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::Glue::Table", {
+        "TableInput": assertions.Match.object_like({
+            "Name": config["glue_table_name"]
+        })
+    })
+    template.resource_count_is("AWS::Glue::Crawler", 1)
+
+
+def projection_config(config):
+    config["glue_partition_discovery"] = "projection"
+    config["partition_projection_account_ids"] = ["123456789012", "210987654321"]
+    config["partition_projection_regions"] = ["us-east-1"]
+    config["partition_projection_job_names"] = ["job-a", "job-b"]
+    return config
+
+
+def test_catalog_stack_projection_mode_has_no_crawler(config):
+    app = core.App()
+    stack = CatalogStack(app, "CatalogStack", config=projection_config(config))
+    template = assertions.Template.from_stack(stack)
+
+    template.resource_count_is("AWS::Glue::Crawler", 0)
+    template.has_resource_properties("AWS::Glue::Table", {
+        "TableInput": assertions.Match.object_like({
+            "Parameters": {
+                "classification": "json",
+                "projection.enabled": "true",
+                "storage.location.template": "s3://glue-observability-demo-dashboard/data/account_id=${account_id}/"
+                                             "region=${region}/year=${year}/month=${month}/day=${day}/hour=${hour}/",
+                "projection.account_id.type": "enum",
+                "projection.account_id.values": "123456789012,210987654321",
+                "projection.region.type": "enum",
+                "projection.region.values": "us-east-1",
+                "projection.year.type": "date",
+                "projection.year.format": "yyyy",
+                "projection.year.range": "2023,NOW",
+                "projection.year.interval": "1",
+                "projection.year.interval.unit": "YEARS",
+                "projection.month.type": "integer",
+                "projection.month.range": "1,12",
+                "projection.month.digits": "2",
+                "projection.day.type": "integer",
+                "projection.day.range": "1,31",
+                "projection.day.digits": "2",
+                "projection.hour.type": "integer",
+                "projection.hour.range": "0,23",
+                "projection.hour.digits": "2",
+            }
+        })
+    })
+
+
+@pytest.mark.parametrize("config_key", ["partition_projection_account_ids", "partition_projection_regions",
+                                        "partition_projection_job_names"])
+def test_catalog_stack_projection_mode_requires_the_projected_values(config, config_key):
+    projection_config(config)
+    config["partition_scheme"] = DEFAULT_PARTITION_SCHEME[:2] + ["jobname"] + DEFAULT_PARTITION_SCHEME[2:]
+    config[config_key] = []
+    # Athena rejects queries without equality predicates on injected keys
+    with pytest.raises(ValueError, match=config_key):
+        CatalogStack(core.App(), "CatalogStack", config=config)
+
+
+def test_catalog_stack_creates_partition_indexes_one_after_the_other(config):
+    config["glue_partition_indexes"] = [
+        {"name": "account_region", "keys": ["account_id", "region"]},
+        {"name": "date", "keys": ["year", "month", "day"]},
+    ]
+    app = core.App()
+    stack = CatalogStack(app, "CatalogStack", config=config)
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::Glue::Table", {
+        "TableInput": assertions.Match.object_like({
+            "Parameters": assertions.Match.object_like({"partition_filtering.enabled": "true"})
+        })
+    })
+    indexes = template.find_resources("Custom::AWS")
+    assert len(indexes) == 2
+    date_index = next(resource for logical_id, resource in indexes.items() if logical_id.startswith("PartitionIndexdate"))
+    assert any(dependency.startswith("PartitionIndexaccountregion") for dependency in date_index["DependsOn"])
+
+
+def test_catalog_stack_rejects_indexes_on_unknown_keys(config):
+    config["glue_partition_indexes"] = [{"name": "job", "keys": ["jobname"]}]
     app = core.App()
-    stack = AwsGlueCdkObservabilityDashboardStack(app, "aws-glue-cdk-observability-dashboard")
+    with pytest.raises(ValueError):
+        CatalogStack(app, "CatalogStack", config=config)
+
+
+def test_catalog_stack_events_mode_registers_partitions_from_s3_notifications(config):
+    config["glue_partition_discovery"] = "events"
+    app = core.App()
+    stack = CatalogStack(app, "CatalogStack", config=config)
     template = assertions.Template.from_stack(stack)
 
-#     template.has_resource_properties("AWS::SQS::Queue", {
-#         "VisibilityTimeout": 300
-#     })
+    template.resource_count_is("AWS::Glue::Crawler", 0)
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "partition_registrar.lambda_handler"
+    })
+    template.has_resource_properties("Custom::S3BucketNotifications", {
+        "NotificationConfiguration": {
+            "LambdaFunctionConfigurations": [assertions.Match.object_like({
+                "Events": ["s3:ObjectCreated:*"],
+                "Filter": {"Key": {"FilterRules": [{"Name": "prefix", "Value": "data/"}]}}
+            })]
+        }
+    })
+
+
+def test_quicksight_stack_creates_dataset_and_analysis(config):
+    app = core.App()
+    stack = QuickSightStack(app, "QuickSightStack", config=config)
+    template = assertions.Template.from_stack(stack)
+
+    template.resource_count_is("AWS::QuickSight::DataSet", 1)
+    template.resource_count_is("AWS::QuickSight::Analysis", 1)
+    template.resource_count_is("AWS::QuickSight::RefreshSchedule", 1)
+
+
+def test_quicksight_dataset_retention_window_prunes_day_partitions(config):
+    assert " WHERE " not in dataset_sql_query(config)
+
+    config["quicksight_dataset_retention_days"] = 35
+    assert dataset_sql_query(config).endswith(
+        " WHERE concat(year, '-', month, '-', day) >= date_format(date_add('day', -35, current_date), '%Y-%m-%d')")
+
+
+def test_quicksight_dataset_is_refreshed_hourly_by_default(config):
+    app = core.App()
+    stack = QuickSightStack(app, "QuickSightStack", config=config)
+    template = assertions.Template.from_stack(stack)
+
+    dataset = next(iter(template.find_resources("AWS::QuickSight::DataSet").values()))
+    assert "DataSetRefreshProperties" not in dataset["Properties"]
+    template.has_resource_properties("AWS::QuickSight::RefreshSchedule", {
+        "Schedule": {
+            "ScheduleId": "observability_refresh_schedule",
+            "RefreshType": "FULL_REFRESH",
+            "ScheduleFrequency": {"Interval": "HOURLY", "TimeZone": config["quicksight_refresh_time_zone"]}
+        }
+    })
+
+
+def test_incremental_refresh_adds_a_schedule_and_makes_the_full_refresh_daily(config):
+    config["quicksight_incremental_refresh_enabled"] = True
+    app = core.App()
+    stack = QuickSightStack(app, "QuickSightStack", config=config)
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::QuickSight::DataSet", {
+        "DataSetRefreshProperties": {
+            "RefreshConfiguration": {
+                "IncrementalRefresh": {
+                    "LookbackWindow": {"ColumnName": "event_time", "Size": 6, "SizeUnit": "HOUR"}
+                }
+            }
+        }
+    })
+    template.resource_count_is("AWS::QuickSight::RefreshSchedule", 2)
+    template.has_resource_properties("AWS::QuickSight::RefreshSchedule", {
+        "Schedule": {
+            "ScheduleId": "observability_refresh_schedule",
+            "RefreshType": "FULL_REFRESH",
+            "ScheduleFrequency": {"Interval": "DAILY", "TimeOfTheDay": "02:00",
+                                  "TimeZone": config["quicksight_refresh_time_zone"]}
+        }
+    })
+    template.has_resource_properties("AWS::QuickSight::RefreshSchedule", {
+        "Schedule": {
+            "ScheduleId": "observability_incremental_refresh_schedule",
+            "RefreshType": "INCREMENTAL_REFRESH",
+            "ScheduleFrequency": {"Interval": "HOURLY", "TimeZone": config["quicksight_refresh_time_zone"]}
+        }
+    })
+
+
+def test_compaction_stack_schedules_job_and_creates_curated_table(config):
+    app = core.App()
+    stack = CompactionStack(app, "CompactionStack", config=config)
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::Glue::Job", {
+        "Command": assertions.Match.object_like({"Name": "pythonshell"}),
+        "DefaultArguments": assertions.Match.object_like({
+            "--curated_prefix": "curated",
+            "--table_name": config["glue_curated_table_name"]
+        })
+    })
+    template.has_resource_properties("AWS::Glue::Trigger", {
+        "Type": "SCHEDULED",
+        "Schedule": config["compaction_cron_schedule"]
+    })
+    template.has_resource_properties("AWS::Glue::Table", {
+        "TableInput": assertions.Match.object_like({
+            "Name": config["glue_curated_table_name"],
+            "StorageDescriptor": assertions.Match.object_like({
+                "Location": f"s3://{config['s3_bucket_name']}/curated/"
+            })
+        })
+    })
+
+
+def test_rollup_stack_schedules_job_and_creates_rollup_tables(config):
+    app = core.App()
+    stack = RollupStack(app, "RollupStack", config=config)
+    template = assertions.Template.from_stack(stack)
+
+    template.resource_count_is("AWS::Glue::Table", 2)
+    template.has_resource_properties("AWS::Glue::Job", {
+        "DefaultArguments": assertions.Match.object_like({
+            "--hourly_table_name": config["glue_hourly_table_name"],
+            "--daily_table_name": config["glue_daily_table_name"],
+            "--output_location": f"s3://{config['s3_bucket_name']}/rollup/athena-results/"
+        })
+    })
+    template.has_resource_properties("AWS::Glue::Trigger", {
+        "Schedule": config["rollup_cron_schedule"]
+    })
+
+
+def test_quicksight_dataset_can_read_the_hourly_rollup_table(config):
+    config["quicksight_dataset_granularity"] = "hourly"
+    app = core.App()
+    stack = QuickSightStack(app, "QuickSightStack", config=config)
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::QuickSight::DataSet", {
+        "PhysicalTableMap": assertions.Match.object_like({
+            "0986fb70-0481-4065-b80c-5247b01b7524": {
+                "CustomSql": assertions.Match.object_like({
+                    "SqlQuery": assertions.Match.string_like_regexp('FROM "00_observability_demo_db"."metric_data_hourly"')
+                })
+            }
+        })
+    })
+
+
+def test_partition_scheme_is_applied_to_all_stacks(config):
+    projection_config(config)
+    config["partition_scheme"] = ["account_id", "region", "dt", "jobname"]
+    app = core.App()
+    sender_stack = MetricsSenderStack(app, "MetricsSenderStack", config=config)
+    catalog_stack = CatalogStack(app, "CatalogStack", config=config)
+    sender_template = assertions.Template.from_stack(sender_stack)
+    catalog_template = assertions.Template.from_stack(catalog_stack)
+
+    sender_template.has_resource_properties("AWS::KinesisFirehose::DeliveryStream", {
+        "ExtendedS3DestinationConfiguration": assertions.Match.object_like({
+            "Prefix": "data/account_id=!{partitionKeyFromLambda:account_id}/region=!{partitionKeyFromLambda:region}/"
+                      "dt=!{partitionKeyFromLambda:dt}/jobname=!{partitionKeyFromLambda:jobname}/"
+        })
+    })
+    sender_template.has_resource_properties("AWS::Lambda::Function", {
+        "Environment": {"Variables": assertions.Match.object_like({
+            "PARTITION_SCHEME": '["account_id", "region", "dt", "jobname"]'
+        })}
+    })
+    catalog_template.has_resource_properties("AWS::Glue::Table", {
+        "TableInput": assertions.Match.object_like({
+            "PartitionKeys": [{"Name": key, "Type": "string"} for key in config["partition_scheme"]],
+            "Parameters": assertions.Match.object_like({
+                "projection.dt.type": "date",
+                "projection.jobname.type": "enum",
+                "projection.jobname.values": "job-a,job-b",
+                "storage.location.template": "s3://glue-observability-demo-dashboard/data/"
+                                             "account_id=${account_id}/region=${region}/dt=${dt}/jobname=${jobname}/"
+            })
+        })
+    })
+
+    sql_query = dataset_sql_query({**config, "quicksight_dataset_retention_days": 30})
+    assert "date_format(from_unixtime(timestamp / 1000), '%H') AS hour" in sql_query
+    assert " WHERE dt >= " in sql_query
+
+
+def test_partition_scheme_requires_day_resolution(config):
+    config["partition_scheme"] = ["account_id", "region", "year", "month"]
+    with pytest.raises(ValueError, match="time keys"):
+        CatalogStack(core.App(), "CatalogStack", config=config)
+    config["partition_scheme"] = DEFAULT_PARTITION_SCHEME[:2] + ["dt"]
+    with pytest.raises(ValueError, match="default partition_scheme"):
+        RollupStack(core.App(), "RollupStack", config=config)
+
+
+def test_metric_family_partitions_prune_the_dataset(config):
+    projection_config(config)
+    config["firehose_partitioning_mode"] = "inline"
+    config["partition_scheme"] = DEFAULT_PARTITION_SCHEME[:2] + ["metric_family"] + DEFAULT_PARTITION_SCHEME[2:]
+    config["quicksight_dataset_metric_families"] = ["memory"]
+    app = core.App()
+    sender_stack = MetricsSenderStack(app, "MetricsSenderStack", config=config)
+    catalog_stack = CatalogStack(app, "CatalogStack", config=config)
+
+    assertions.Template.from_stack(sender_stack).has_resource_properties("AWS::KinesisFirehose::DeliveryStream", {
+        "ExtendedS3DestinationConfiguration": assertions.Match.object_like({
+            "Prefix": assertions.Match.string_like_regexp(r"/metric_family=!\{partitionKeyFromQuery:metric_family\}/year="),
+            "ProcessingConfiguration": assertions.Match.object_like({
+                "Processors": assertions.Match.array_with([assertions.Match.object_like({
+                    "Type": "MetadataExtraction",
+                    "Parameters": assertions.Match.array_with([{
+                        "ParameterName": "MetadataExtractionQuery",
+                        "ParameterValue": assertions.Match.string_like_regexp(r'then "memory" else')
+                    }])
+                })])
+            })
+        })
+    })
+    assertions.Template.from_stack(catalog_stack).has_resource_properties("AWS::Glue::Table", {
+        "TableInput": assertions.Match.object_like({
+            "Parameters": assertions.Match.object_like({
+                "projection.metric_family.values": "memory,reliability,throughput,disk,utilization,other"
+            })
+        })
+    })
+    assert dataset_sql_query(config).endswith(" WHERE metric_family IN ('memory')")
+
+    config["partition_scheme"] = DEFAULT_PARTITION_SCHEME
+    assert "ELSE 'other' END AS metric_family" in dataset_sql_query(config)
+    config["quicksight_dataset_metric_families"] = ["unknown"]
+    with pytest.raises(ValueError, match="quicksight_dataset_metric_families"):
+        dataset_sql_query(config)
+
+
+def test_wide_table_is_pivoted_by_the_rollup_job_and_read_by_a_job_runs_sheet(config):
+    config["create_rollup_stack"] = True
+    config["rollup_wide_table_enabled"] = True
+    config["quicksight_wide_sheet_enabled"] = True
+    app = core.App()
+    rollup_stack = RollupStack(app, "RollupStack", config=config)
+    quicksight_stack = QuickSightStack(app, "QuickSightStack", config=config)
+    rollup_template = assertions.Template.from_stack(rollup_stack)
+    quicksight_template = assertions.Template.from_stack(quicksight_stack)
+
+    rollup_template.resource_count_is("AWS::Glue::Table", 3)
+    rollup_template.has_resource_properties("AWS::Glue::Job", {
+        "DefaultArguments": assertions.Match.object_like({
+            "--wide_table_name": config["glue_wide_table_name"],
+            "--wide_columns": assertions.Match.string_like_regexp('"name": "worker_utilization_avg"')
+        })
+    })
+    quicksight_template.resource_count_is("AWS::QuickSight::DataSet", 2)
+    quicksight_template.has_resource_properties("AWS::QuickSight::DataSet", {
+        "PhysicalTableMap": {
+            "wide": {
+                "CustomSql": assertions.Match.object_like({
+                    "SqlQuery": assertions.Match.string_like_regexp(
+                        'worker_utilization_avg, .* FROM "00_observability_demo_db"."metric_data_wide"')
+                })
+            }
+        }
+    })
+    # The wide data set keeps its own cadence when incremental refresh makes the main full refresh daily
+    config["quicksight_incremental_refresh_enabled"] = True
+    config["quicksight_wide_refresh_interval"] = "MINUTE30"
+    schedules = assertions.Template.from_stack(QuickSightStack(core.App(), "QuickSightStack", config=config)).find_resources(
+        "AWS::QuickSight::RefreshSchedule")
+    assert {schedule["Properties"]["Schedule"]["ScheduleId"]: schedule["Properties"]["Schedule"]["ScheduleFrequency"]["Interval"]
+            for schedule in schedules.values()} == {
+        "observability_refresh_schedule": "DAILY",
+        "observability_incremental_refresh_schedule": "HOURLY",
+        "observability_wide_refresh_schedule": "MINUTE30",
+    }
+    analysis = next(iter(quicksight_template.find_resources("AWS::QuickSight::Analysis").values()))
+    sheet = analysis["Properties"]["Definition"]["Sheets"][2]
+    assert sheet["SheetId"] == "JOB_RUNS_SHEET"
+    assert len(sheet["Visuals"]) == 10
+    # The wide data set has no Source and Sink columns to filter on
+    assert [control["Dropdown"]["SourceParameterName"] for control in sheet["ParameterControls"] if "Dropdown" in control] == [
+        "Region", "Account", "JobName", "JobRunId"]
+
+    config["rollup_wide_table_enabled"] = False
+    with pytest.raises(ValueError, match="rollup_wide_table_enabled"):
+        QuickSightStack(core.App(), "QuickSightStack", config=config)
@@ -0,0 +1,135 @@
+import json
+import os
+import sys
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import fs
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "aws_glue_cdk_observability_dashboard", "glue_jobs"))
+
+import compaction_job  # noqa: E402
+
+# 2023-10-03T03:00:00Z, 2023-10-01 and 2023-10-02 are closed, 2023-10-03 is not
+NOW = 1696302000
+
+
+def metric_row(metric_name, timestamp, job_run_id="jr_0001"):
+    return {
+        "metric_stream_name": "ObservabilityMetricStream",
+        "namespace": "Glue",
+        "metric_name": metric_name,
+        "dimensions": {"JobName": "job1", "JobRunId": job_run_id, "Type": "gauge"},
+        "timestamp": timestamp,
+        "value": {"max": 10.0, "min": 1.0, "sum": 22.0, "count": 4.0},
+        "unit": "Bytes"
+    }
+
+
+def write_source_file(root, day, hour, name, rows):
+    path = os.path.join(root, "data", "account_id=123456789012", "region=us-east-1",
+                        "year=2023", "month=10", f"day={day}", f"hour={hour}")
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, name), "w", encoding="utf-8") as f:
+        f.write("".join(json.dumps(row) + "\n" for row in rows))
+
+
+def curated_path(root, day):
+    return os.path.join(root, "curated", "account_id=123456789012", "region=us-east-1",
+                        "year=2023", "month=10", f"day={day}")
+
+
+def test_closed_days_are_compacted_into_sorted_parquet(tmp_path):
+    root = str(tmp_path)
+    write_source_file(root, "01", "10", "object-1", [metric_row("glue.driver.aggregate.recordsRead", 1696154460000)])
+    write_source_file(root, "01", "10", "object-2", [metric_row("glue.driver.aggregate.bytesRead", 1696154460000)])
+    write_source_file(root, "01", "09", "object-1", [metric_row("glue.driver.aggregate.bytesRead", 1696150860000)])
+    write_source_file(root, "03", "01", "object-1", [metric_row("glue.driver.aggregate.bytesRead", 1696294860000)])
+
+    compacted = compaction_job.compact(fs.LocalFileSystem(), f"{root}/data", f"{root}/curated", NOW)
+
+    assert compacted == [("123456789012", "us-east-1", "2023", "10", "01")]
+    assert sorted(os.listdir(curated_path(root, "01"))) == ["_SUCCESS", "part-00000.parquet"]
+    assert not os.path.exists(curated_path(root, "03"))
+    rows = pq.read_table(os.path.join(curated_path(root, "01"), "part-00000.parquet")).to_pylist()
+    assert [(row["metric_name"], row["timestamp"]) for row in rows] == [
+        ("glue.driver.aggregate.bytesRead", 1696150860000),
+        ("glue.driver.aggregate.bytesRead", 1696154460000),
+        ("glue.driver.aggregate.recordsRead", 1696154460000),
+    ]
+    assert rows[0]["dimensions"]["JobRunId"] == "jr_0001" and rows[0]["dimensions"]["Source"] is None
+
+
+def test_compacted_days_are_skipped_and_interrupted_runs_are_redone(tmp_path):
+    root = str(tmp_path)
+    write_source_file(root, "02", "10", "object-1", [metric_row("glue.driver.aggregate.bytesRead", 1696240860000 + i)
+                                                     for i in range(5)])
+    filesystem = fs.LocalFileSystem()
+    os.makedirs(curated_path(root, "02"))
+    with open(os.path.join(curated_path(root, "02"), "part-00009.parquet"), "wb") as f:
+        f.write(b"partial")
+
+    compaction_job.compact(filesystem, f"{root}/data", f"{root}/curated", NOW, max_rows_per_file=2)
+    assert sorted(os.listdir(curated_path(root, "02"))) == [
+        "_SUCCESS", "part-00000.parquet", "part-00001.parquet", "part-00002.parquet"]
+
+    os.remove(os.path.join(curated_path(root, "02"), "part-00002.parquet"))
+    compacted = compaction_job.compact(filesystem, f"{root}/data", f"{root}/curated", NOW, max_rows_per_file=2)
+    assert compacted == [("123456789012", "us-east-1", "2023", "10", "02")]
+    assert "part-00002.parquet" not in os.listdir(curated_path(root, "02"))
+
+
+def test_source_files_are_read_into_the_curated_schema(tmp_path):
+    root = str(tmp_path)
+    inline_row = {**metric_row("glue.driver.aggregate.bytesRead", 1696154460000), "account_id": "123456789012"}
+    write_source_file(root, "01", "10", "object-1", [inline_row])
+    write_source_file(root, "01", "11", "object-1", [])
+    parquet_path = os.path.join(root, "data", "account_id=123456789012", "region=us-east-1",
+                                "year=2023", "month=10", "day=01", "hour=10", "object-2.parquet")
+    pq.write_table(pa.Table.from_pylist([{"metric_name": "glue.driver.aggregate.recordsRead", "timestamp": 1696154460000,
+                                          "dimensions": {"Type": "count", "JobName": "job1"}}]), parquet_path)
+    filesystem = fs.LocalFileSystem()
+    partition_path = compaction_job.day_partition_path(f"{root}/data", "123456789012", "us-east-1", "2023", "10", "01")
+
+    json_tables = [compaction_job.read_table(filesystem, path, compaction_job.SOURCE_FORMAT_JSON)
+                   for path in compaction_job.source_files(filesystem, partition_path) if not path.endswith(".parquet")]
+    parquet_table = compaction_job.read_table(filesystem, parquet_path, compaction_job.SOURCE_FORMAT_PARQUET)
+
+    assert [table.num_rows for table in json_tables] == [1, 0]
+    assert all(table.schema == compaction_job.CURATED_SCHEMA for table in json_tables + [parquet_table])
+    row = parquet_table.to_pylist()[0]
+    assert row["dimensions"]["JobName"] == "job1" and row["dimensions"]["JobRunId"] is None
+    assert row["value"] is None
+
+
+class StubGlueClient:
+
+    def __init__(self, existing):
+        self.existing = set(existing)
+        self.created = []
+
+    def get_table(self, DatabaseName, Name):
+        return {"Table": {"StorageDescriptor": {"Columns": [], "Location": "s3://bucket/curated/"}}}
+
+    def batch_create_partition(self, DatabaseName, TableName, PartitionInputList):
+        errors = []
+        for partition_input in PartitionInputList:
+            values = tuple(partition_input["Values"])
+            if values in self.existing:
+                errors.append({"PartitionValues": list(values), "ErrorDetail": {"ErrorCode": "AlreadyExistsException"}})
+            else:
+                self.existing.add(values)
+                self.created.append(partition_input)
+        return {"Errors": errors}
+
+
+def test_register_partitions_skips_existing_partitions():
+    existing = ("123456789012", "us-east-1", "2023", "10", "01")
+    new = ("123456789012", "us-east-1", "2023", "10", "02")
+    client = StubGlueClient([existing])
+
+    compaction_job.register_partitions(client, "db", "metric_data_curated", "s3://bucket/curated", [existing, new])
+
+    assert [partition["Values"] for partition in client.created] == [list(new)]
+    assert client.created[0]["StorageDescriptor"]["Location"] == \
+        "s3://bucket/curated/account_id=123456789012/region=us-east-1/year=2023/month=10/day=02/"
@@ -0,0 +1,589 @@
+import base64
+import json
+import os
+import struct
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "aws_glue_cdk_observability_dashboard", "lambda"))
+
+import firehose_lambda  # noqa: E402
+
+
+def metric_line(metric_name="glue.driver.aggregate.bytesRead", account_id="123456789012", region="us-east-1",
+                timestamp=1696154400000, job_name="job1", job_run_id="jr_0001"):
+    return json.dumps({
+        "metric_stream_name": "ObservabilityMetricStream",
+        "account_id": account_id,
+        "region": region,
+        "namespace": "Glue",
+        "metric_name": metric_name,
+        "dimensions": {"JobName": job_name, "JobRunId": job_run_id, "Type": "gauge"},
+        "timestamp": timestamp,
+        "value": {"max": 10.0, "min": 1.0, "sum": 22.0, "count": 4.0},
+        "unit": "Bytes"
+    }, separators=(",", ":"))
+
+
+def firehose_event(payloads):
+    return {
+        "invocationId": "invocation-1",
+        "deliveryStreamArn": "arn:aws:firehose:us-east-1:123456789012:deliverystream/test",
+        "region": "us-east-1",
+        "records": [
+            {
+                "recordId": f"record-{i}",
+                "approximateArrivalTimestamp": 1696154400000,
+                "data": base64.b64encode(payload if isinstance(payload, bytes) else payload.encode("utf-8")).decode("utf-8")
+            }
+            for i, payload in enumerate(payloads)
+        ]
+    }
+
+
+def protobuf_varint(value):
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def protobuf_field(field, value):
+    if isinstance(value, float):
+        return protobuf_varint(field << 3 | 1) + struct.pack("<d", value)
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return protobuf_varint(field << 3 | 2) + protobuf_varint(len(value)) + value
+
+
+def otlp_key_value(key, value):
+    if isinstance(value, dict):
+        any_value = protobuf_field(6, b"".join(protobuf_field(1, otlp_key_value(k, v)) for k, v in value.items()))
+    else:
+        any_value = protobuf_field(1, value)
+    return protobuf_field(1, key) + protobuf_field(2, any_value)
+
+
+def otlp_request(metric_name="glue.driver.aggregate.bytesRead", account_id="123456789012", region="us-east-1",
+                 timestamp=1696154400000, job_name="job1", job_run_id="jr_0001"):
+    """Size-delimited ExportMetricsServiceRequest as sent by a metric stream in the opentelemetry1.0 format."""
+    resource = b"".join(protobuf_field(1, otlp_key_value(key, value)) for key, value in [
+        ("cloud.provider", "aws"),
+        ("cloud.account.id", account_id),
+        ("cloud.region", region),
+        ("aws.exporter.arn", f"arn:aws:cloudwatch:{region}:{account_id}:metric-stream/ObservabilityMetricStream"),
+    ])
+    data_point = b"".join([
+        protobuf_field(7, otlp_key_value("Namespace", "Glue")),
+        protobuf_field(7, otlp_key_value("MetricName", metric_name)),
+        protobuf_field(7, otlp_key_value("Dimensions", {"JobName": job_name, "JobRunId": job_run_id, "Type": "gauge"})),
+        protobuf_varint(2 << 3 | 1) + struct.pack("<Q", (timestamp - 60000) * 1000000),
+        protobuf_varint(3 << 3 | 1) + struct.pack("<Q", timestamp * 1000000),
+        protobuf_varint(4 << 3 | 1) + struct.pack("<Q", 4),
+        protobuf_field(5, 22.0),
+        protobuf_field(6, protobuf_field(1, 0.0) + protobuf_field(2, 1.0)),
+        protobuf_field(6, protobuf_field(1, 1.0) + protobuf_field(2, 10.0)),
+    ])
+    metric = protobuf_field(1, f"amazonaws.com/Glue/{metric_name}") + protobuf_field(3, "Bytes") + protobuf_field(11, protobuf_field(1, data_point))
+    scope_metrics = protobuf_field(2, metric)
+    request = protobuf_field(1, protobuf_field(1, resource) + protobuf_field(2, scope_metrics))
+    return protobuf_varint(len(request)) + request
+
+
+def decode_lines(record):
+    return [json.loads(line) for line in base64.b64decode(record["data"]).decode("utf-8").splitlines()]
+
+
+def test_transform_removes_partition_fields_and_sets_partition_keys():
+    payload = "\n".join([metric_line(), metric_line(metric_name="glue.driver.aggregate.recordsRead")]) + "\n"
+    output = firehose_lambda.lambda_handler(firehose_event([payload]), None)
+
+    assert len(output["records"]) == 1
+    record = output["records"][0]
+    assert record["recordId"] == "record-0"
+    assert record["result"] == "Ok"
+    assert record["metadata"]["partitionKeys"] == {
+        "account_id": "123456789012",
+        "region": "us-east-1",
+        "year": "2023",
+        "month": "10",
+        "day": "01",
+        "hour": "10"
+    }
+    lines = decode_lines(record)
+    assert [line["metric_name"] for line in lines] == ["glue.driver.aggregate.bytesRead", "glue.driver.aggregate.recordsRead"]
+    assert all("account_id" not in line and "region" not in line for line in lines)
+    assert base64.b64decode(record["data"]).endswith(b"\n")
+
+
+def test_malformed_and_empty_records_do_not_fail_the_batch():
+    event = firehose_event([
+        metric_line() + "\n",
+        metric_line() + "\n{not json\n",
+        '{"namespace":"Glue"}\n',
+        "\n",
+    ])
+
+    output = firehose_lambda.lambda_handler(event, None)
+
+    assert [record["recordId"] for record in output["records"]] == [record["recordId"] for record in event["records"]]
+    assert [record["result"] for record in output["records"]] == ["Ok", "ProcessingFailed", "ProcessingFailed", "Dropped"]
+    assert output["records"][1]["data"] == event["records"][1]["data"]
+
+
+@pytest.mark.parametrize("encoding_mode", [firehose_lambda.ENCODING_MODE_JSON, firehose_lambda.ENCODING_MODE_PASSTHROUGH])
+@pytest.mark.parametrize("bad_line", [
+    # Valid JSON that is not an object
+    "123", '"abc"', "null", "[]",
+    # Partition fields that are not strings
+    metric_line().replace('"account_id":"123456789012"', '"account_id":123'),
+    metric_line().replace('"region":"us-east-1"', '"region":null'),
+    # Timestamps out of the range of time.gmtime
+    metric_line(timestamp=10 ** 20),
+    metric_line().replace('"timestamp":1696154400000', '"timestamp":1e20'),
+])
+def test_valid_json_with_bad_values_only_fails_its_record(monkeypatch, encoding_mode, bad_line):
+    monkeypatch.setattr(firehose_lambda, "TRANSFORM_LINE", {
+        firehose_lambda.ENCODING_MODE_JSON: firehose_lambda.transform_line_json,
+        firehose_lambda.ENCODING_MODE_PASSTHROUGH: firehose_lambda.transform_line_passthrough,
+    }[encoding_mode])
+    event = firehose_event([metric_line() + "\n", bad_line + "\n"])
+
+    output = firehose_lambda.lambda_handler(event, None)
+
+    assert [record["result"] for record in output["records"]] == ["Ok", "ProcessingFailed"]
+    assert output["records"][1]["data"] == event["records"][1]["data"]
+
+
+class StubClientError(Exception):
+    pass
+
+
+class StubFirehoseClient:
+    exceptions = types.SimpleNamespace(ClientError=StubClientError)
+
+    def __init__(self, fail_first=0):
+        self.calls = []
+        self.fail_first = fail_first
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.calls.append((DeliveryStreamName, [record["Data"] for record in Records]))
+        failed = min(self.fail_first, len(Records))
+        self.fail_first -= failed
+        return {
+            "FailedPutCount": failed,
+            "RequestResponses": [{"ErrorCode": "ServiceUnavailableException"}] * failed
+                                + [{"RecordId": "id"}] * (len(Records) - failed)
+        }
+
+
+def test_lines_of_other_partitions_are_reingested(monkeypatch):
+    client = StubFirehoseClient()
+    monkeypatch.setattr(firehose_lambda, "firehose_client", client)
+    other_account = metric_line(account_id="999999999999")
+    next_hour = metric_line(timestamp=1696154400000 + 3600 * 1000)
+    payload = "\n".join([metric_line(), next_hour, metric_line(), other_account]) + "\n"
+
+    output = firehose_lambda.lambda_handler(firehose_event([payload]), None)
+
+    record = output["records"][0]
+    assert record["result"] == "Ok"
+    assert record["metadata"]["partitionKeys"]["account_id"] == "123456789012"
+    assert record["metadata"]["partitionKeys"]["hour"] == "10"
+    assert len(decode_lines(record)) == 2
+    assert len(client.calls) == 1
+    stream_name, reingested = client.calls[0]
+    assert stream_name == "test"
+    assert sorted(reingested) == sorted([(next_hour + "\n").encode("utf-8"), (other_account + "\n").encode("utf-8")])
+
+
+def test_failed_reingestion_marks_source_record_failed(monkeypatch):
+    client = StubFirehoseClient(fail_first=firehose_lambda.REINGEST_MAX_ATTEMPTS)
+    monkeypatch.setattr(firehose_lambda, "firehose_client", client)
+    payload = "\n".join([metric_line(), metric_line(region="eu-west-1")]) + "\n"
+    event = firehose_event([payload, metric_line() + "\n"])
+
+    output = firehose_lambda.lambda_handler(event, None)
+
+    assert [record["result"] for record in output["records"]] == ["ProcessingFailed", "Ok"]
+    assert output["records"][0]["data"] == event["records"][0]["data"]
+    assert len(client.calls) == firehose_lambda.REINGEST_MAX_ATTEMPTS
+
+
+class RegionFailingFirehoseClient(StubFirehoseClient):
+
+    def __init__(self, failing_region):
+        super().__init__()
+        self.failing_region = failing_region.encode("utf-8")
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.calls.append((DeliveryStreamName, [record["Data"] for record in Records]))
+        responses = [{"ErrorCode": "ServiceUnavailableException"} if self.failing_region in record["Data"] else {"RecordId": "id"}
+                     for record in Records]
+        return {"FailedPutCount": sum("ErrorCode" in response for response in responses), "RequestResponses": responses}
+
+
+def test_only_undelivered_lines_of_a_partially_reingested_record_are_failed(monkeypatch):
+    monkeypatch.setattr(firehose_lambda, "firehose_client", RegionFailingFirehoseClient("eu-west-1"))
+    kept_lines = [metric_line(), metric_line()]
+    reingested = metric_line(region="us-west-2")
+    failed = metric_line(region="eu-west-1")
+    event = firehose_event(["\n".join(kept_lines + [reingested, failed]) + "\n"])
+
+    output = firehose_lambda.lambda_handler(event, None)
+
+    record = output["records"][0]
+    assert record["result"] == "ProcessingFailed"
+    assert "metadata" not in record
+    # The us-west-2 line was put back into the stream, so it must not also go to the error output
+    assert base64.b64decode(record["data"]).decode("utf-8") == "\n".join(kept_lines + [failed]) + "\n"
+
+
+def test_record_batches_respect_put_record_batch_limits():
+    payloads = [b"x" * (1024 * 1024)] * 5 + [b"y"] * 600
+    batches = list(firehose_lambda.record_batches(range(len(payloads)), payloads))
+    assert [len(batch) for batch in batches] == [4, 500, 101]
+    assert sum(len(batch) for batch in batches) == len(payloads)
+
+
+def test_payloads_over_the_record_size_limit_are_split_on_line_boundaries(monkeypatch):
+    monkeypatch.setattr(firehose_lambda, "PUT_RECORD_MAX_BYTES", 2 * (len(metric_line()) + 1))
+    client = StubFirehoseClient()
+    payload = ("\n".join([metric_line()] * 5) + "\n").encode("utf-8")
+
+    failed = firehose_lambda.put_record_batches(client, "test", [payload])
+
+    assert failed == {}
+    pieces = client.calls[0][1]
+    assert [piece.count(b"\n") for piece in pieces] == [2, 2, 1]
+    assert b"".join(pieces) == payload
+
+
+class ThrottlingFirehoseClient(StubFirehoseClient):
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.calls.append((DeliveryStreamName, [record["Data"] for record in Records]))
+        raise StubClientError("ThrottlingException")
+
+
+def test_throttled_reingestion_marks_source_record_failed(monkeypatch):
+    client = ThrottlingFirehoseClient()
+    monkeypatch.setattr(firehose_lambda, "firehose_client", client)
+    payload = "\n".join([metric_line(), metric_line(region="eu-west-1")]) + "\n"
+    event = firehose_event([payload, metric_line() + "\n"])
+
+    output = firehose_lambda.lambda_handler(event, None)
+
+    assert [record["result"] for record in output["records"]] == ["ProcessingFailed", "Ok"]
+    assert output["records"][0]["data"] == event["records"][0]["data"]
+    assert len(client.calls) == firehose_lambda.REINGEST_MAX_ATTEMPTS
+
+
+class StubContext:
+
+    def __init__(self, remaining_millis):
+        self.remaining_millis = list(remaining_millis)
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_millis.pop(0) if len(self.remaining_millis) > 1 else self.remaining_millis[0]
+
+
+def test_records_over_the_response_size_limit_are_reingested(monkeypatch):
+    client = StubFirehoseClient()
+    monkeypatch.setattr(firehose_lambda, "firehose_client", client)
+    payload = "\n".join([metric_line()] * 10) + "\n"
+    event = firehose_event([payload] * 5)
+    single_record = firehose_lambda.lambda_handler(firehose_event([payload]), None)["records"][0]
+    monkeypatch.setattr(firehose_lambda, "MAX_RESPONSE_BYTES", 2 * firehose_lambda.response_record_bytes(single_record) + 1)
+
+    output = firehose_lambda.lambda_handler(event, None)
+
+    assert [record["result"] for record in output["records"]] == ["Ok", "Ok", "Dropped", "Dropped", "Dropped"]
+    assert "data" not in output["records"][2]
+    assert client.calls[0][1] == [payload.encode("utf-8")] * 3
+
+
+def test_records_after_the_deadline_are_reingested(monkeypatch):
+    client = StubFirehoseClient()
+    monkeypatch.setattr(firehose_lambda, "firehose_client", client)
+    event = firehose_event([metric_line() + "\n"] * 3)
+    margin = firehose_lambda.DEADLINE_MARGIN_MILLIS
+
+    output = firehose_lambda.lambda_handler(event, StubContext([margin + 1000, margin - 1]))
+
+    assert [record["result"] for record in output["records"]] == ["Ok", "Dropped", "Dropped"]
+    assert len(client.calls[0][1]) == 2
+
+
+def test_failed_reingestion_of_unprocessed_records_only_fails_their_records(monkeypatch):
+    monkeypatch.setattr(firehose_lambda, "firehose_client", RegionFailingFirehoseClient("eu-west-1"))
+    monkeypatch.setattr(firehose_lambda, "MAX_RESPONSE_BYTES", 0)
+    event = firehose_event([metric_line(region="eu-west-1") + "\n", metric_line() + "\n"])
+
+    output = firehose_lambda.lambda_handler(event, None)
+
+    # The second record was put back into the stream, failing the invocation would deliver it twice
+    assert [record["result"] for record in output["records"]] == ["ProcessingFailed", "Dropped"]
+    assert output["records"][0]["data"] == event["records"][0]["data"]
+    assert "data" not in output["records"][1]
+
+
+def test_stdlib_codec_does_not_grow_rolled_up_lines(monkeypatch):
+    _, _, dumps = firehose_lambda.load_json_codec(firehose_lambda.JSON_CODEC_STDLIB)
+    monkeypatch.setattr(firehose_lambda, "json_dumps", dumps)
+    monkeypatch.setattr(firehose_lambda, "ROLLUP_BUCKET_MILLIS", 300 * 1000)
+    line = metric_line()
+
+    output = firehose_lambda.lambda_handler(firehose_event([line + "\n"]), None)
+
+    rolled_up = base64.b64decode(output["records"][0]["data"]).rstrip(b"\n")
+    assert b", " not in rolled_up and b": " not in rolled_up
+    assert len(rolled_up) <= len(line)
+
+
+def test_rollup_merges_datapoints_across_records(monkeypatch):
+    monkeypatch.setattr(firehose_lambda, "ROLLUP_BUCKET_MILLIS", 300 * 1000)
+    start = 1696154400000
+    event = firehose_event([
+        "\n".join([metric_line(timestamp=start), metric_line(timestamp=start, job_name="job2")]) + "\n",
+        metric_line(timestamp=start + 60 * 1000) + "\n",
+        metric_line(timestamp=start + 360 * 1000) + "\n",
+    ])
+
+    output = firehose_lambda.lambda_handler(event, None)
+
+    assert [record["result"] for record in output["records"]] == ["Ok", "Dropped", "Dropped"]
+    rows = decode_lines(output["records"][0])
+    assert [(row["dimensions"]["JobName"], row["timestamp"]) for row in rows] == [
+        ("job1", start), ("job2", start), ("job1", start + 300 * 1000)
+    ]
+    assert rows[0]["value"] == {"max": 10.0, "min": 1.0, "sum": 44.0, "count": 8.0}
+    assert rows[2]["value"] == {"max": 10.0, "min": 1.0, "sum": 22.0, "count": 4.0}
+
+
+def test_rows_that_cannot_be_rolled_up_do_not_fail_the_batch(monkeypatch):
+    monkeypatch.setattr(firehose_lambda, "ROLLUP_BUCKET_MILLIS", 300 * 1000)
+    start = 1696154400000
+    # An OpenTelemetry summary without the 0 and 1 quantiles has no max and min
+    no_max = json.loads(metric_line(timestamp=start))
+    no_max["value"] = {"max": None, "min": None, "sum": 22.0, "count": 4.0}
+    no_metric_name = json.loads(metric_line(timestamp=start))
+    del no_metric_name["metric_name"]
+    no_value = json.loads(metric_line(timestamp=start))
+    del no_value["value"]
+    partial_rows = [json.dumps(row) for row in (no_max, no_metric_name, no_value)]
+    event = firehose_event([
+        metric_line(timestamp=start) + "\n",
+        "\n".join(partial_rows + [metric_line(timestamp=start + 60 * 1000)]) + "\n",
+        '{"account_id":"123456789012","region":"us-east-1","timestamp":1696154400000,"value":\n',
+    ])
+
+    output = firehose_lambda.lambda_handler(event, None)
+
+    assert [record["result"] for record in output["records"]] == ["Ok", "Dropped", "ProcessingFailed"]
+    rows = decode_lines(output["records"][0])
+    assert len(rows) == 4
+    assert rows[0]["value"] == {"max": 10.0, "min": 1.0, "sum": 44.0, "count": 8.0}
+    assert rows[1]["value"] == {"max": None, "min": None, "sum": 22.0, "count": 4.0}
+    assert "metric_name" not in rows[2] and "value" not in rows[3]
+
+
+def test_metric_name_include_and_exclude_lists(monkeypatch):
+    monkeypatch.setattr(firehose_lambda, "METRIC_NAME_INCLUDE", firehose_lambda.parse_metric_names("glue.driver.workerUtilization, glue.error.*"))
+    monkeypatch.setattr(firehose_lambda, "METRIC_NAME_EXCLUDE", firehose_lambda.parse_metric_names("glue.error.ALL"))
+    monkeypatch.setattr(firehose_lambda, "metric_name_selection_cache", {})
+    event = firehose_event([
+        "\n".join([
+            metric_line(metric_name="glue.driver.workerUtilization"),
+            metric_line(metric_name="glue.error.OUT_OF_MEMORY"),
+            metric_line(metric_name="glue.error.ALL"),
+            metric_line(metric_name="glue.driver.aggregate.bytesRead"),
+        ]) + "\n",
+        metric_line(metric_name="glue.driver.aggregate.bytesRead") + "\n",
+    ])
+
+    output = firehose_lambda.lambda_handler(event, None)
+
+    assert [record["result"] for record in output["records"]] == ["Ok", "Dropped"]
+    assert [row["metric_name"] for row in decode_lines(output["records"][0])] == [
+        "glue.driver.workerUtilization", "glue.error.OUT_OF_MEMORY"
+    ]
+
+
+def test_opentelemetry_records_produce_the_same_lines_as_json(monkeypatch):
+    json_output = firehose_lambda.lambda_handler(firehose_event([
+        metric_line() + "\n" + metric_line(metric_name="glue.driver.aggregate.recordsRead") + "\n"
+    ]), None)
+    monkeypatch.setattr(firehose_lambda, "INPUT_FORMAT", firehose_lambda.INPUT_FORMAT_OPENTELEMETRY)
+    otlp_output = firehose_lambda.lambda_handler(firehose_event([
+        otlp_request() + otlp_request(metric_name="glue.driver.aggregate.recordsRead")
+    ]), None)
+
+    assert otlp_output["records"][0]["result"] == "Ok"
+    assert otlp_output["records"][0]["metadata"] == json_output["records"][0]["metadata"]
+    assert decode_lines(otlp_output["records"][0]) == decode_lines(json_output["records"][0])
+
+
+def test_opentelemetry_mode_accepts_reingested_json_and_rejects_truncated_records(monkeypatch):
+    monkeypatch.setattr(firehose_lambda, "INPUT_FORMAT", firehose_lambda.INPUT_FORMAT_OPENTELEMETRY)
+    output = firehose_lambda.lambda_handler(firehose_event([metric_line() + "\n", otlp_request()[:-5]]), None)
+
+    assert [record["result"] for record in output["records"]] == ["Ok", "ProcessingFailed"]
+
+
+def test_invocation_metrics_are_logged_in_embedded_metric_format(monkeypatch, capsys):
+    monkeypatch.setattr(firehose_lambda, "METRICS_NAMESPACE", "GlueObservability/FirehoseLambda")
+    payload = metric_line() + "\n" + metric_line(account_id="210987654321") + "\n"
+    monkeypatch.setattr(firehose_lambda, "firehose_client", StubFirehoseClient())
+    firehose_lambda.lambda_handler(firehose_event([payload, "{not json\n"]), None)
+
+    emf = next(json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"_aws"'))
+    directive = emf["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Namespace"] == "GlueObservability/FirehoseLambda"
+    assert directive["Dimensions"] == [["DeliveryStream"]]
+    assert emf["DeliveryStream"] == "test"
+    assert all(metric["Name"] in emf for metric in directive["Metrics"])
+    assert (emf["InputRecords"], emf["Lines"], emf["BytesIn"]) == (2, 2, len(payload) + len("{not json\n"))
+    assert (emf["PartitionsTouched"], emf["FailedRecords"], emf["ReingestedRecords"]) == (2, 1, 1)
+    assert emf["BytesOut"] > 0 and emf["ParseTime"] >= 0 and emf["EncodeTime"] >= 0
+
+
+def test_one_in_n_invocations_is_profiled(monkeypatch, capsys):
+    monkeypatch.setattr(firehose_lambda, "PROFILE_EVERY_N_INVOCATIONS", 2)
+    monkeypatch.setattr(firehose_lambda, "PROFILE_TRACEMALLOC", True)
+    monkeypatch.setattr(firehose_lambda, "invocation_count", 0)
+    event = firehose_event([metric_line() + "\n"])
+
+    outputs = [firehose_lambda.lambda_handler(event, None) for _ in range(3)]
+
+    profiles = [line for line in capsys.readouterr().out.split("\n") if line.startswith("Profile of InvocationId")]
+    assert len(profiles) == 2
+    assert "tracemalloc peak:" in profiles[0] and "process_records" in profiles[0]
+    assert all(output == outputs[0] for output in outputs)
+
+
+def test_profile_can_be_dumped_to_a_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(firehose_lambda, "PROFILE_EVERY_N_INVOCATIONS", 1)
+    monkeypatch.setattr(firehose_lambda, "PROFILE_OUTPUT", firehose_lambda.PROFILE_OUTPUT_TMP)
+    monkeypatch.setattr(firehose_lambda, "PROFILE_DIRECTORY", str(tmp_path))
+
+    firehose_lambda.lambda_handler(firehose_event([metric_line() + "\n"]), None)
+
+    assert (tmp_path / "firehose_lambda-invocation-1.prof").stat().st_size > 0
+
+
+def test_hour_partition_keys_are_utc_and_cached():
+    hour_bucket = 1696154400000 // firehose_lambda.HOUR_MILLIS
+    keys = firehose_lambda.time_partition_keys(hour_bucket)
+    assert keys == {"year": "2023", "month": "10", "day": "01", "hour": "10"}
+    assert firehose_lambda.time_partition_keys(hour_bucket) is keys
+    assert firehose_lambda.time_partition_keys(hour_bucket + 14) == {"year": "2023", "month": "10", "day": "02", "hour": "00"}
+
+
+def test_time_partition_keys_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(firehose_lambda, "time_partition_keys_cache", {})
+    hour_bucket = 1696154400000 // firehose_lambda.HOUR_MILLIS
+    for bucket in range(hour_bucket, hour_bucket + firehose_lambda.TIME_PARTITION_KEYS_CACHE_SIZE + 1):
+        firehose_lambda.time_partition_keys(bucket)
+    assert len(firehose_lambda.time_partition_keys_cache) == 1
+
+
+def test_partition_keys_are_built_once_per_invocation(monkeypatch):
+    calls = []
+    partition_keys = firehose_lambda.partition_keys
+    monkeypatch.setattr(firehose_lambda, "partition_keys", lambda partition: calls.append(partition) or partition_keys(partition))
+
+    output = firehose_lambda.lambda_handler(firehose_event([metric_line() + "\n"] * 3), None)
+
+    assert [record["result"] for record in output["records"]] == ["Ok"] * 3
+    assert len(calls) == 1
+
+
+def test_daily_scheme_with_job_name_partitions(monkeypatch):
+    monkeypatch.setattr(firehose_lambda, "TIME_PARTITION_KEYS", ["dt"])
+    monkeypatch.setattr(firehose_lambda, "PARTITION_BUCKET_MILLIS", firehose_lambda.DAY_MILLIS)
+    monkeypatch.setattr(firehose_lambda, "PARTITION_BY_JOB_NAME", True)
+    monkeypatch.setattr(firehose_lambda, "time_partition_keys_cache", {})
+    client = StubFirehoseClient()
+    monkeypatch.setattr(firehose_lambda, "firehose_client", client)
+
+    # Two hours of the same day and job share a partition, another job and a job name with '/' do not
+    payload = "\n".join([
+        metric_line(timestamp=1696154400000),
+        metric_line(timestamp=1696154400000 + firehose_lambda.HOUR_MILLIS),
+        metric_line(job_name="job2"),
+        metric_line(job_name="team/job3"),
+    ]) + "\n"
+    output = firehose_lambda.lambda_handler(firehose_event([payload]), None)
+
+    assert output["records"][0]["metadata"]["partitionKeys"] == {
+        "account_id": "123456789012", "region": "us-east-1", "dt": "2023-10-01", "jobname": "job1"}
+    assert len(base64.b64decode(output["records"][0]["data"]).splitlines()) == 2
+    assert len(client.calls[0][1]) == 2
+    partitions = firehose_lambda.transform_payload(payload.encode("utf-8"))
+    assert sorted(partition[3] for partition in partitions) == ["job1", "job2", "team_job3"]
+
+
+def test_metric_family_partitions(monkeypatch):
+    monkeypatch.setattr(firehose_lambda, "PARTITION_BY_METRIC_FAMILY", True)
+    monkeypatch.setattr(firehose_lambda, "METRIC_FAMILIES", [
+        ("memory", firehose_lambda.parse_metric_names("glue.driver.memory.*,glue.ALL.error.OUT_OF_MEMORY_ERROR")),
+        ("reliability", firehose_lambda.parse_metric_names("glue.ALL.error.*")),
+    ])
+    monkeypatch.setattr(firehose_lambda, "metric_family_cache", {})
+
+    payload = "\n".join([
+        metric_line(metric_name="glue.driver.memory.heap.used"),
+        metric_line(metric_name="glue.ALL.error.OUT_OF_MEMORY_ERROR"),
+        metric_line(metric_name="glue.ALL.error.ILLEGAL_ARGUMENT_ERROR"),
+        metric_line(metric_name="glue.driver.aggregate.bytesRead"),
+    ]) + "\n"
+    partitions = firehose_lambda.transform_payload(payload.encode("utf-8"))
+
+    assert {partition[4]: len(lines) for partition, (lines, _) in partitions.items()} == \
+        {"memory": 2, "reliability": 1, "other": 1}
+    assert firehose_lambda.partition_keys(next(iter(partitions)))["metric_family"] == "memory"
+
+
+def test_passthrough_matches_json_encoding():
+    lines = [
+        metric_line().encode("utf-8"),
+        b'{"namespace":"Glue","timestamp":1696154400000,"value":{"max":1.0},"region":"eu-west-1","account_id":"111122223333"}',
+        b'{"account_id":"111122223333","dimensions":{"JobName":"a,\\"region\\":\\"x\\""},"timestamp":1696154400000,"region":"eu-west-1"}',
+    ]
+    for line in lines:
+        passthrough = firehose_lambda.transform_line_passthrough(line)
+        expected = firehose_lambda.transform_line_json(line)
+        assert json.loads(passthrough[0]) == json.loads(expected[0])
+        assert passthrough[1:] == expected[1:]
+
+
+def test_passthrough_falls_back_to_json_for_unexpected_layout():
+    line = b'{"account_id":"111122223333","region":"eu-west-\\u0031","timestamp":1696154400000}'
+    output_line, account_id, region, timestamp = firehose_lambda.transform_line_passthrough(line)
+    assert json.loads(output_line) == {"timestamp": 1696154400000}
+    assert (account_id, region, timestamp) == ("111122223333", "eu-west-1", 1696154400000)
+
+
+def test_passthrough_handles_whitespace():
+    line = b'{ "account_id" : "111122223333", "region": "eu-west-1", "timestamp": 1696154400000 }'
+    output_line, account_id, region, timestamp = firehose_lambda.transform_line_passthrough(line)
+    assert json.loads(output_line) == {"timestamp": 1696154400000}
+    assert (account_id, region, timestamp) == ("111122223333", "eu-west-1", 1696154400000)
+
+
+def test_full_batch_is_transformed():
+    line = metric_line()
+    lines_per_record = 500
+    payload = "\n".join([line] * lines_per_record) + "\n"
+    record_count = max(1, (2 * 1024 * 1024) // len(payload))
+    event = firehose_event([payload] * record_count)
+
+    output = firehose_lambda.lambda_handler(event, None)
+
+    assert [record["result"] for record in output["records"]] == ["Ok"] * record_count
+    assert sum(len(decode_lines(record)) for record in output["records"]) == record_count * lines_per_record
@@ -0,0 +1,121 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "aws_glue_cdk_observability_dashboard", "partition_registrar"))
+
+import partition_registrar  # noqa: E402
+
+
+class StubCatalog:
+    """Glue client holding the partitions of a single table in memory."""
+
+    def __init__(self, existing=(), error_code=None):
+        self.partitions = {tuple(values): None for values in existing}
+        self.error_code = error_code
+        self.get_table_calls = 0
+        self.batch_sizes = []
+
+    def get_table(self, DatabaseName, Name):
+        self.get_table_calls += 1
+        return {"Table": {"StorageDescriptor": {"Columns": [{"Name": "metric_name", "Type": "string"}],
+                                                "Location": "s3://bucket/data/"}}}
+
+    def batch_create_partition(self, DatabaseName, TableName, PartitionInputList):
+        self.batch_sizes.append(len(PartitionInputList))
+        errors = []
+        for partition_input in PartitionInputList:
+            values = tuple(partition_input["Values"])
+            if self.error_code:
+                errors.append({"PartitionValues": list(values), "ErrorDetail": {"ErrorCode": self.error_code}})
+            elif values in self.partitions:
+                errors.append({"PartitionValues": list(values), "ErrorDetail": {"ErrorCode": "AlreadyExistsException"}})
+            else:
+                self.partitions[values] = partition_input["StorageDescriptor"]["Location"]
+        return {"Errors": errors}
+
+
+@pytest.fixture(autouse=True)
+def registrar(monkeypatch):
+    monkeypatch.setattr(partition_registrar, "known_partitions", set())
+    monkeypatch.setattr(partition_registrar, "table_storage_descriptor", None)
+    monkeypatch.setattr(partition_registrar, "DATABASE_NAME", "db")
+    monkeypatch.setattr(partition_registrar, "TABLE_NAME", "metric_data")
+
+
+def s3_event(keys, bucket="glue-observability-demo-dashboard"):
+    return {"Records": [{"s3": {"bucket": {"name": bucket}, "object": {"key": key}}} for key in keys]}
+
+
+def data_key(account_id="123456789012", region="us-east-1", hour="10", name="object-1"):
+    return f"data/account_id={account_id}/region={region}/year=2023/month=10/day=01/hour={hour}/{name}"
+
+
+def test_new_partitions_are_created_once(monkeypatch):
+    catalog = StubCatalog()
+    monkeypatch.setattr(partition_registrar, "glue_client", catalog)
+
+    result = partition_registrar.lambda_handler(s3_event([data_key(), data_key(name="object-2"), data_key(hour="11")]), None)
+    assert result == {"partitions": 2, "created": 2}
+    assert catalog.partitions[("123456789012", "us-east-1", "2023", "10", "01", "10")] == \
+        "s3://glue-observability-demo-dashboard/data/account_id=123456789012/region=us-east-1/year=2023/month=10/day=01/hour=10/"
+
+    # Known partitions are skipped without calling the catalog
+    result = partition_registrar.lambda_handler(s3_event([data_key(name="object-3")]), None)
+    assert result == {"partitions": 1, "created": 0}
+    assert catalog.batch_sizes == [2]
+    assert catalog.get_table_calls == 1
+
+
+def test_partitions_registered_elsewhere_become_known(monkeypatch):
+    catalog = StubCatalog(existing=[("123456789012", "us-east-1", "2023", "10", "01", "10")])
+    monkeypatch.setattr(partition_registrar, "glue_client", catalog)
+
+    assert partition_registrar.lambda_handler(s3_event([data_key()]), None)["created"] == 0
+    assert ("123456789012", "us-east-1", "2023", "10", "01", "10") in partition_registrar.known_partitions
+
+
+def test_keys_outside_the_layout_are_ignored_and_encoded_keys_are_decoded(monkeypatch):
+    catalog = StubCatalog()
+    monkeypatch.setattr(partition_registrar, "glue_client", catalog)
+
+    result = partition_registrar.lambda_handler(s3_event([
+        "error/processing-failed/2023/10/01/10/object-1",
+        data_key(region="us-east-1").replace("=", "%3D"),
+    ]), None)
+
+    assert result == {"partitions": 1, "created": 1}
+
+
+def test_batches_respect_the_batch_create_partition_limit(monkeypatch):
+    catalog = StubCatalog()
+    monkeypatch.setattr(partition_registrar, "glue_client", catalog)
+
+    keys = [data_key(account_id=f"{i:012d}") for i in range(150)]
+    assert partition_registrar.lambda_handler(s3_event(keys), None)["created"] == 150
+    assert catalog.batch_sizes == [100, 50]
+
+
+def test_catalog_errors_fail_the_invocation(monkeypatch):
+    monkeypatch.setattr(partition_registrar, "glue_client", StubCatalog(error_code="InternalServiceException"))
+
+    with pytest.raises(RuntimeError):
+        partition_registrar.lambda_handler(s3_event([data_key()]), None)
+    assert not partition_registrar.known_partitions
+
+
+def test_partition_path_follows_the_partition_scheme(monkeypatch):
+    catalog = StubCatalog()
+    monkeypatch.setattr(partition_registrar, "glue_client", catalog)
+    monkeypatch.setattr(partition_registrar, "PARTITION_KEYS", ["account_id", "region", "dt", "jobname"])
+    monkeypatch.setattr(partition_registrar, "PARTITION_PATH_PATTERN",
+                        partition_registrar.partition_path_pattern(partition_registrar.PARTITION_KEYS))
+
+    result = partition_registrar.lambda_handler(s3_event([
+        "data/account_id=123456789012/region=us-east-1/dt=2023-10-01/jobname=job1/object-1",
+        data_key(),
+    ]), None)
+
+    assert result == {"partitions": 1, "created": 1}
+    assert list(catalog.partitions) == [("123456789012", "us-east-1", "2023-10-01", "job1")]
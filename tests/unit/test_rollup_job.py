@@ -0,0 +1,152 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "aws_glue_cdk_observability_dashboard", "glue_jobs"))
+
+import rollup_job  # noqa: E402
+
+# 2023-10-03T01:30:00Z
+NOW = 1696296600
+
+
+class StubAthenaClient:
+
+    def __init__(self, glue_client, states=("RUNNING", "SUCCEEDED")):
+        self.glue_client = glue_client
+        self.states = states
+        self.queries = []
+
+    def start_query_execution(self, QueryString, WorkGroup, ResultConfiguration):
+        self.queries.append(QueryString)
+        # INSERT INTO registers the partitions that it writes
+        table_name = QueryString.split('"')[3]
+        values = QueryString.split("year = '")[1].replace("' AND month = '", " ").replace("' AND day = '", " ") \
+            .replace("' AND hour = '", " ").split("'")[0].split()
+        self.glue_client.partitions[table_name][tuple(values)] = f"s3://bucket/rollup/{table_name}/{'/'.join(values)}/"
+        return {"QueryExecutionId": f"query-{len(self.queries)}"}
+
+    def get_query_execution(self, QueryExecutionId):
+        state = self.states[0]
+        self.states = self.states[1:] or self.states
+        return {"QueryExecution": {"Status": {"State": state, "StateChangeReason": "reason"}}}
+
+
+class StubPaginator:
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return self.pages(**kwargs)
+
+
+class StubGlueClient:
+
+    def __init__(self, partitions):
+        self.partitions = partitions
+        self.deleted = []
+
+    def get_paginator(self, name):
+        return StubPaginator(lambda DatabaseName, TableName: [{"Partitions": [
+            {"Values": list(values), "StorageDescriptor": {"Location": location}}
+            for values, location in self.partitions[TableName].items()
+        ]}])
+
+    def batch_delete_partition(self, DatabaseName, TableName, PartitionsToDelete):
+        for partition in PartitionsToDelete:
+            del self.partitions[TableName][tuple(partition["Values"])]
+            self.deleted.append((TableName, tuple(partition["Values"])))
+
+
+class StubS3Client:
+
+    def __init__(self):
+        self.deleted = []
+
+    def get_paginator(self, name):
+        return StubPaginator(lambda Bucket, Prefix: [{"Contents": [{"Key": Prefix + "part-0.parquet"}]}])
+
+    def delete_objects(self, Bucket, Delete):
+        self.deleted.extend(s3_object["Key"] for s3_object in Delete["Objects"])
+
+
+def run_rollup(glue_client, athena_client, s3_client, **kwargs):
+    rollup_job.rollup(athena_client, glue_client, s3_client, NOW, "db", "metric_data", "metric_data_hourly",
+                      "metric_data_daily", "primary", "s3://bucket/rollup/athena-results/", closed_after_minutes=90,
+                      lookback_hours=3, hourly_retention_days=2, daily_retention_days=400, sleep=lambda seconds: None,
+                      **kwargs)
+
+
+def test_missing_closed_hours_and_days_are_rolled_up():
+    glue_client = StubGlueClient({
+        "metric_data_hourly": {("2023", "10", "02", "21"): "s3://bucket/rollup/hourly/21/"},
+        "metric_data_daily": {},
+    })
+    athena_client = StubAthenaClient(glue_client)
+
+    run_rollup(glue_client, athena_client, StubS3Client())
+
+    # Closed hours are 21, 22 and 23 of 2023-10-02, hour 21 is already rolled up
+    assert [query.split("WHERE ")[1].split(" GROUP")[0] for query in athena_client.queries] == [
+        "year = '2023' AND month = '10' AND day = '02' AND hour = '22'",
+        "year = '2023' AND month = '10' AND day = '02' AND hour = '23'",
+        "year = '2023' AND month = '10' AND day = '02'",
+    ]
+    assert athena_client.queries[0].startswith('INSERT INTO "db"."metric_data_hourly" SELECT account_id, region')
+    assert 'FROM "db"."metric_data" ' in athena_client.queries[0]
+    assert athena_client.queries[2].startswith('INSERT INTO "db"."metric_data_daily" SELECT account_id, region')
+    assert "'00' AS hour, year, month, day FROM \"db\".\"metric_data_hourly\"" in athena_client.queries[2]
+
+
+def test_expired_partitions_are_deleted():
+    glue_client = StubGlueClient({
+        "metric_data_hourly": {
+            ("2023", "09", "30", "10"): "s3://bucket/rollup/hourly/year=2023/month=09/day=30/hour=10/",
+            ("2023", "10", "02", "21"): "s3://bucket/rollup/hourly/21/",
+            ("2023", "10", "02", "22"): "s3://bucket/rollup/hourly/22/",
+            ("2023", "10", "02", "23"): "s3://bucket/rollup/hourly/23/",
+        },
+        "metric_data_daily": {("2023", "10", "02"): "s3://bucket/rollup/daily/02/"},
+    })
+    s3_client = StubS3Client()
+
+    run_rollup(glue_client, StubAthenaClient(glue_client), s3_client)
+
+    assert glue_client.deleted == [("metric_data_hourly", ("2023", "09", "30", "10"))]
+    assert s3_client.deleted == ["rollup/hourly/year=2023/month=09/day=30/hour=10/part-0.parquet"]
+
+
+def test_failed_query_raises():
+    glue_client = StubGlueClient({"metric_data_hourly": {}, "metric_data_daily": {}})
+    athena_client = StubAthenaClient(glue_client, states=("FAILED",))
+
+    with pytest.raises(RuntimeError, match="FAILED: reason"):
+        run_rollup(glue_client, athena_client, StubS3Client())
+
+
+def test_closed_hours_are_pivoted_into_the_wide_table():
+    glue_client = StubGlueClient({
+        "metric_data_hourly": {},
+        "metric_data_daily": {},
+        "metric_data_wide": {("2023", "10", "02", "22"): "s3://bucket/rollup/wide/22/"},
+    })
+    athena_client = StubAthenaClient(glue_client)
+
+    run_rollup(glue_client, athena_client, StubS3Client(), wide_table_name="metric_data_wide", wide_columns=[
+        {"name": "worker_utilization_avg", "metric_name": "glue.driver.workerUtilization", "statistic": "avg"},
+        {"name": "driver_oom_count", "metric_name": "glue.driver.error.OUT_OF_MEMORY_ERROR", "statistic": "count"},
+    ])
+
+    wide_queries = [query for query in athena_client.queries if '"metric_data_wide"' in query]
+    assert [query.split("WHERE year = '")[1].split(" AND metric_name")[0] for query in wide_queries] == [
+        "2023' AND month = '10' AND day = '02' AND hour = '21'",
+        "2023' AND month = '10' AND day = '02' AND hour = '23'",
+    ]
+    assert "timestamp - timestamp % 60000 AS timestamp, sum(value.sum) FILTER (WHERE metric_name = " \
+           "'glue.driver.workerUtilization') / sum(value.count) FILTER (WHERE metric_name = " \
+           "'glue.driver.workerUtilization') AS worker_utilization_avg, sum(value.count) FILTER " \
+           "(WHERE metric_name = 'glue.driver.error.OUT_OF_MEMORY_ERROR') AS driver_oom_count, year" in wide_queries[0]
+    assert "AND metric_name IN ('glue.driver.error.OUT_OF_MEMORY_ERROR', 'glue.driver.workerUtilization') " \
+           "GROUP BY account_id, region, dimensions.jobname, dimensions.jobrunid" in wide_queries[0]